@@ -0,0 +1,15 @@
+#!/bin/bash
+# Runs the language pipeline benchmarks against recorded analyzer fixtures.
+# The fixtures are recorded from a running analyzer the first time. To
+# re-record them, start the analyzer and run:
+#python3 src/tests/benchmark.py record
+# To make the current tree the new baseline:
+#python3 src/tests/benchmark.py run -output src/tests/fixtures/baseline.json
+if [ ! -f src/tests/fixtures/analyzer_fixture.json ]; then
+    python3 src/tests/benchmark.py record || exit 1
+fi
+if [ -f src/tests/fixtures/baseline.json ]; then
+    python3 src/tests/benchmark.py run -baseline src/tests/fixtures/baseline.json "$@"
+else
+    python3 src/tests/benchmark.py run "$@"
+fi
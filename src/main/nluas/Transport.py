@@ -11,8 +11,9 @@
 #
 # Add TransportWarning exception for stuff that should be safely ignorable.
 #
-# Maybe multiple subscribes should be allowed? Currently, setting up
-# a second subscribe to the same port throws an exception.
+# Maybe multiple subscribe_all() callbacks should be allowed, as they
+# are for subscribe()? Currently, a second subscribe_all() throws an
+# exception.
 #
 # Changes:
 #
@@ -30,6 +31,11 @@
 # Pyre.set_port() is broken in the current Pyre implementation. If
 # you want to do multiple federations, use e.g.:
 # t = Transport(name, prefix='foo')
+#
+# Messages are encoded with the best codec that the sender and all
+# receivers advertised (see transport_codecs.py). To restrict a
+# Transport to particular codecs, use e.g.:
+# t = Transport(name, codecs=['json'])
 
 
 # ------
@@ -39,7 +45,9 @@
 from __future__ import print_function
 
 import collections
+import concurrent.futures
 import datetime
+import heapq
 import inspect
 import ipaddress
 import json
@@ -48,12 +56,61 @@ import os
 import re
 import sys
 import threading
+import time
 import uuid
 
 from pyre import Pyre
 import zmq
 
-VERSION = 0.1
+from nluas import transport_codecs
+from nluas import transport_metrics
+from nluas import transport_reliable
+from nluas import transport_routes
+from nluas import transport_shm
+from nluas.transport_reliable import DELIVERED, FAILED
+
+VERSION = 0.2
+
+# Pyre header in which a Transport advertises the codecs it can decode
+# (comma separated, most preferred first). See transport_codecs.py.
+CODECS_HEADER = 'X-TRANSPORT-CODECS'
+
+# Environment variable choosing the Transport backend. See
+# Transport.__new__().
+BACKEND_ENV = 'NLUAS_TRANSPORT'
+
+# Pyre header listing optional protocol features a Transport supports
+# (comma separated). WHISPER_FEATURE means it accepts messages sent to
+# it by WHISPER.
+FEATURES_HEADER = 'X-TRANSPORT-FEATURES'
+WHISPER_FEATURE = 'whisper'
+
+# SHM_FEATURE means a Transport can read shared-memory frames (see
+# transport_shm.py) from peers whose HOST_HEADER matches its own.
+SHM_FEATURE = 'shm'
+HOST_HEADER = 'X-TRANSPORT-HOST'
+
+# PRIORITY_FEATURE means a Transport accepts priority frames (see
+# transport_codecs.py and Transport.send()).
+PRIORITY_FEATURE = 'priority'
+
+# BATCH_FEATURE means a Transport accepts batch frames (see
+# transport_codecs.py and Transport.flush()).
+BATCH_FEATURE = 'batch'
+
+# COMPRESS_FEATURE means a Transport accepts compressed frames (see
+# transport_codecs.py). ZDICT_FEATURE, followed by '-' and the
+# transport_codecs.ZDICT_ID, means it has that preset dictionary.
+COMPRESS_FEATURE = 'zlib'
+ZDICT_FEATURE = 'zdict'
+
+# A request with this payload is answered by the Transport itself, with
+# its stats() (see Transport.remote_stats()).
+STATS_REQUEST = '__stats__'
+
+# Likewise answered by the Transport itself, with None (see
+# Transport.sync()).
+PING_REQUEST = '__ping__'
 
 logger = logging.getLogger('Transport')
 
@@ -91,128 +148,856 @@ class TransportSecurityError(TransportError):
     '''Raised if a sender's IP address isn't valid according to Transport.is_valid_ip()'''
     pass
 
+class TransportTimeout(TransportError):
+    '''Set on the future returned by Transport.request() if no reply arrived in time'''
+    pass
+
+class TransportRemoteError(TransportError):
+    '''Set on the future returned by Transport.request() if the remote couldn't answer the request'''
+    pass
+
+# Returned by Transport.get().
+TransportEnvelope = collections.namedtuple('TransportEnvelope', ['object', 'uuid', 'name', 'ip', 'datetime'])
+
+# Default number of messages an inbox holds (see Transport.open_inbox())
+# before it starts dropping the oldest.
+INBOX_SIZE = 1024
+
+# While requests with a timeout or reliable messages are outstanding,
+# the read thread checks their deadlines at least this often (in
+# seconds).
+TICK = 0.1
+
+# How long (in seconds) a receiver may hold back acks for reliable
+# messages, so that a burst of them is acknowledged at once.
+ACK_DELAY = 0.02
+
+# Overflow policies for subscriptions with a bounded queue (see
+# Transport.subscribe()). BLOCK makes the dispatch thread wait for room,
+# DROP_OLDEST discards the oldest queued message, and REJECT discards
+# the incoming message.
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+REJECT = 'reject'
+
+# Message priorities (see Transport.send()), most urgent first.
+# Received messages of each priority wait in their own queue, and
+# control messages are always handed to the callbacks first.
+
+PRIORITY_CONTROL = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+
+# Default size (in bytes) at which a batch of messages is sent without
+# waiting for batch_delay (see Transport.flush()).
+BATCH_SIZE = 65536
+
+# What a Transport knows about another Pyre node, from its ENTER and
+# JOIN events. codecs is None for nodes that didn't advertise any (old
+# Transports and plain Pyre nodes such as the bridge client); they're
+# sent plain JSON.
+
+class _Peer():
+    def __init__(self, sid, name, ip, codecs, features, host):
+        self.sid = sid
+        self.name = name
+        self.ip = ip
+        self.codecs = codecs
+        self.features = features
+        self.host = host
+        self.groups = set()
+# class _Peer
+
+######################################################################
+#
+# A received message, passed from the read thread to the callbacks.
+# The payload is decoded the first time a callback asks for it, so a
+# message nobody is subscribed to is never decoded, and a message with
+# several subscribers (e.g. subscribe() and subscribe_all()) is decoded
+# once, and they all get the same object.
+#
+
+_UNDECODED = object()
+
+class _Envelope():
+    __slots__ = ('sid', 'name', 'ip', 'channel', 'data', 'datetime', '_object', '_decode', '_lock')
+
+    def __init__(self, sid, name, ip, channel, data, now, obj=_UNDECODED, decode=transport_codecs.decode):
+        # obj, if given, is the already decoded payload. Otherwise
+        # decode(data) returns it.
+        self.sid = sid
+        self.name = name
+        self.ip = ip
+        self.channel = channel
+        self.data = data
+        self.datetime = now
+        self._object = obj
+        self._decode = decode
+        self._lock = threading.Lock()
+    # __init__()
+
+    def object(self):
+        '''Return the decoded payload, decoding it if this is the first call.'''
+        if self._object is _UNDECODED:
+            with self._lock:
+                if self._object is _UNDECODED:
+                    self._object = self._decode(self.data)
+                    self.data = None
+        return self._object
+    # object()
+# class _Envelope
+
+def _resolve(future, result=None, exception=None):
+    '''Complete future with result or exception, unless it was cancelled.'''
+    if future.set_running_or_notify_cancel():
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+# _resolve()
+
+def _takes_keywords(callback):
+    '''Return True if callback accepts **kw.'''
+    try:
+        return inspect.getfullargspec(callback).varkw is not None
+    except AttributeError:
+        # Python 2
+        return inspect.getargspec(callback).keywords is not None
+# _takes_keywords()
+
+######################################################################
+#
+# A subscription is a callback plus, unless it's called inline in the
+# read thread, a bounded queue of messages waiting for it. Messages are
+# handed to the callback one at a time and in order, either by a
+# dedicated worker thread (executor='thread') or by a task submitted to
+# an executor such as a concurrent.futures.ThreadPoolExecutor. At most
+# one such task is queued or running per subscription.
+#
+
+class _Subscription():
+    def __init__(self, transport, callback, executor=None, max_queue=None, overflow=BLOCK):
+        if overflow not in (BLOCK, DROP_OLDEST, REJECT):
+            raise TransportError(transport, 'Unknown overflow policy "%s"'%(overflow))
+        self.transport = transport
+        self.callback = callback
+        # Resolved once here rather than for every message.
+        self.keywords = _takes_keywords(callback)
+        self.executor = executor
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._draining = False
+        self._closed = False
+        if executor == 'thread':
+            self._thread = threading.Thread(target=self._worker)
+            self._thread.daemon = True
+            self._thread.start()
+    # __init__()
+
+    def dispatch(self, envelope):
+        '''Called from the dispatch thread with each _Envelope for this subscription.'''
+        if self.executor is None:
+            self.deliver(envelope)
+            return
+        submit = False
+        with self._cond:
+            if self.max_queue is not None and len(self._queue) >= self.max_queue:
+                if self.overflow == BLOCK:
+                    while len(self._queue) >= self.max_queue and not self._closed:
+                        self._cond.wait()
+                elif self.overflow == DROP_OLDEST:
+                    self._queue.popleft()
+                    self.transport._metrics.count('dropped')
+                    logger.warning('Transport subscription queue full, dropped oldest message')
+                else:
+                    self.transport._metrics.count('dropped')
+                    logger.warning('Transport subscription queue full, rejected message')
+                    return
+            if self._closed:
+                return
+            self._queue.append(envelope)
+            if self.executor == 'thread':
+                self._cond.notify_all()
+            elif not self._draining:
+                self._draining = True
+                submit = True
+        if submit:
+            self.executor.submit(self._drain)
+    # dispatch()
+
+    def close(self):
+        '''Stop accepting messages. Messages already queued are still delivered.'''
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+    # close()
+
+    def deliver(self, envelope):
+        '''Call the callback with envelope's ntuple, and metadata if it takes **kw.'''
+        obj = envelope.object()
+        start = time.time()
+        try:
+            if self.keywords:
+                self.callback(obj, uuid=envelope.sid, name=envelope.name, ip=envelope.ip, datetime=envelope.datetime)
+            else:
+                self.callback(obj)
+        finally:
+            self.transport._metrics.callback(envelope.name, time.time() - start)
+    # deliver()
+
+    def depth(self):
+        '''Return the number of messages waiting for the callback.'''
+        return len(self._queue)
+    # depth()
+
+    def _next(self, wait):
+        # Pop the next queued message (or None), and wake the read
+        # thread in case it's blocked on a full queue.
+        with self._cond:
+            while wait and not self._queue and not self._closed:
+                self._cond.wait()
+            if not self._queue:
+                self._draining = False
+                return None
+            envelope = self._queue.popleft()
+            self._cond.notify_all()
+            return envelope
+    # _next()
+
+    def _worker(self):
+        envelope = self._next(True)
+        while envelope is not None:
+            self._run(envelope)
+            envelope = self._next(True)
+    # _worker()
+
+    def _drain(self):
+        envelope = self._next(False)
+        while envelope is not None:
+            self._run(envelope)
+            envelope = self._next(False)
+    # _drain()
+
+    def _run(self, envelope):
+        try:
+            self.deliver(envelope)
+        except Exception:
+            logger.exception('Exception in Transport callback %s', self.callback)
+    # _run()
+# class _Subscription
+
+######################################################################
+#
+# An inbox buffers the messages from one remote until they're taken
+# with Transport.recv() and friends. Only the dispatch thread appends,
+# and it takes no lock to do so; consumers take the Transport's inbox
+# condition, and the dispatch thread only takes it to wake them up if
+# any are waiting. Each entry is (arrival number, _Envelope), so that
+# recv_any() can take the oldest message over all inboxes.
+#
+
+class _Inbox():
+    def __init__(self, max_size):
+        self.queue = collections.deque(maxlen=max_size)
+        self.dropped = 0
+    # __init__()
+
+    def append(self, entry):
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+        self.queue.append(entry)
+    # append()
+# class _Inbox
+
+######################################################################
+#
+# Priority lanes. The read thread only sorts received messages into a
+# queue per priority, and a dispatch thread hands them to the
+# subscriptions, inboxes and responders, always from the most urgent
+# non-empty queue. So a PRIORITY_CONTROL message (e.g. a stop command)
+# waits for at most the one callback that's already running, however
+# many normal and bulk messages are queued, and the read thread keeps
+# reading (and answering acks and replies) while callbacks run.
+#
+
+class _Lanes():
+    def __init__(self, count):
+        self._queues = [collections.deque() for i in range(count)]
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._worker)
+        self._thread.daemon = True
+        self._thread.start()
+    # __init__()
+
+    def put(self, priority, func, arg):
+        '''Queue func(arg) in the lane for priority.'''
+        with self._cond:
+            self._queues[priority].append((func, arg))
+            self._cond.notify()
+    # put()
+
+    def depths(self):
+        '''Return the number of items waiting in each lane.'''
+        return [len(q) for q in self._queues]
+    # depths()
+
+    def close(self):
+        '''Stop the dispatch thread once the control lane is empty. Anything else still queued is dropped, and the count logged.'''
+        with self._cond:
+            self._closed = True
+            dropped = sum(len(q) for q in self._queues[PRIORITY_CONTROL + 1:])
+            for q in self._queues[PRIORITY_CONTROL + 1:]:
+                q.clear()
+            self._cond.notify()
+        if dropped:
+            logger.warning('Transport closed with %d queued messages, dropped them', dropped)
+    # close()
+
+    def join(self):
+        '''Wait for the dispatch thread to finish, unless called from it (e.g. by a callback that quits).'''
+        if threading.current_thread() is not self._thread:
+            self._thread.join()
+    # join()
+
+    def _next(self):
+        with self._cond:
+            while True:
+                for q in self._queues:
+                    if q:
+                        return q.popleft()
+                if self._closed:
+                    return None
+                self._cond.wait()
+    # _next()
+
+    def _worker(self):
+        item = self._next()
+        while item is not None:
+            func, arg = item
+            try:
+                func(arg)
+            except Exception:
+                logger.exception('Exception dispatching Transport message')
+            item = self._next()
+    # _worker()
+# class _Lanes
+
+######################################################################
+#
+# Send-side batching. Frames for the same destination are collected
+# until the first of them has waited delay seconds or they add up to
+# size bytes, and then sent as one batch frame by a flush thread (or
+# by the sending thread, if the batch is full). Frames that aren't
+# batched flush their destination's batch first, so messages to one
+# destination stay in order. Transmitting is done with the condition
+# held for the same reason.
+#
+# Transports that don't handle pyre events in a thread of their own
+# (see AsyncTransport) mustn't have another thread send on pyre
+# either. They pass a timer, which calls flush_due() at the right time
+# from their own thread, instead of having a flush thread.
+#
+
+class _Batcher():
+    def __init__(self, transmit, delay, size, timer=None):
+        # transmit(dest, frame, sid) sends frame to dest, or WHISPERs
+        # it to the peer sid if that's not None. timer(seconds, func),
+        # if given, calls func after seconds, in place of the flush
+        # thread.
+        self._transmit = transmit
+        self.delay = delay
+        self.size = size
+        # (dest, sid) => [frames, bytes, deadline]
+        self._batches = collections.OrderedDict()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._timer = timer
+        if timer is None:
+            self._thread = threading.Thread(target=self._worker)
+            self._thread.daemon = True
+            self._thread.start()
+    # __init__()
+
+    def add(self, dest, sid, frame):
+        '''Add frame to the batch for dest.'''
+        with self._cond:
+            key = (dest, sid)
+            batch = self._batches.get(key)
+            if batch is None:
+                batch = self._batches[key] = [[], 0, time.time() + self.delay]
+                if self._timer is None:
+                    self._cond.notify()
+                else:
+                    self._timer(self.delay, self.flush_due)
+            batch[0].append(frame)
+            batch[1] += len(frame) + 4
+            if batch[1] >= self.size:
+                self._send(key)
+    # add()
+
+    def send(self, dest, sid, frame):
+        '''Transmit frame right away, after the batch for dest.'''
+        with self._cond:
+            for key in [key for key in self._batches if key[0] == dest]:
+                self._send(key)
+            self._transmit(dest, frame, sid)
+    # send()
+
+    def flush(self):
+        '''Send every batch now.'''
+        with self._cond:
+            for key in list(self._batches):
+                self._send(key)
+    # flush()
+
+    def flush_due(self):
+        '''Send the batches that have waited delay seconds.'''
+        with self._cond:
+            self._send_due(time.time())
+    # flush_due()
+
+    def close(self):
+        '''Send every batch, and stop the flush thread.'''
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self.flush()
+    # close()
+
+    def _send(self, key):
+        # Called with self._cond held.
+        frames = self._batches.pop(key)[0]
+        self._transmit(key[0], frames[0] if len(frames) == 1 else transport_codecs.encode_batch(frames), key[1])
+    # _send()
+
+    def _send_due(self, now):
+        # Called with self._cond held.
+        for key in [key for key, batch in self._batches.items() if batch[2] <= now]:
+            try:
+                self._send(key)
+            except Exception:
+                logger.exception('Exception sending Transport batch to %s', key[0])
+    # _send_due()
+
+    def _worker(self):
+        with self._cond:
+            while not self._closed:
+                now = time.time()
+                self._send_due(now)
+                if self._batches:
+                    self._cond.wait(max(min(batch[2] for batch in self._batches.values()) - now, 0.001))
+                else:
+                    self._cond.wait()
+    # _worker()
+# class _Batcher
+
 ######################################################################
 #
 # The main class for Transport. On creation, sets up a thread to
 # listen for incoming messages.
 #
 
-class Transport():
+class Transport(object):
     '''Message transport mechanisms for LCAS'''
 
-    def send(self, dest, ntuple):
+    # Whether to handle pyre events in a read thread. Subclasses that
+    # handle them some other way (see async_transport.py) set this to
+    # False and call _handle_event() themselves.
+    _threaded = True
+
+    # Notes on send
+    #
+    # priority is PRIORITY_CONTROL, PRIORITY_NORMAL or PRIORITY_BULK.
+    # Receivers queue messages by priority and hand the most urgent
+    # ones to their callbacks first, so e.g. a stop command sent with
+    # PRIORITY_CONTROL isn't stuck behind a backlog of data. Messages of
+    # one priority from one sender arrive in order; messages of
+    # different priorities may overtake each other. Receivers that
+    # predate priorities treat every message as PRIORITY_NORMAL.
+
+    def send(self, dest, ntuple, priority=PRIORITY_NORMAL):
         '''Send given ntuple to Transport named dest. If dest isn't listening for messages from this Transport, the message will (currently) be silently ignored.'''
         if self._prefix is not None:
             dest = self._prefix + dest
-        self._pyre.shout(dest, json.dumps(ntuple).encode('utf-8'))
+        self._send_to(dest, lambda codec: transport_codecs.encode(ntuple, codec), priority=priority, batch=True)
     # send()
 
-    def broadcast(self, ntuple):
+    def broadcast(self, ntuple, priority=PRIORITY_NORMAL):
         '''Send given ntuple to Transport all destinations. If the destination isn't listening then the message will (currently) be silently ignored.'''
-        self._pyre.shout(self._globalchannel, json.dumps(ntuple).encode('utf-8'))
+        self._send_to(self._globalchannel, lambda codec: transport_codecs.encode(ntuple, codec), broadcast=True, priority=priority, batch=True)
     # broadcast()
 
     # Notes on subscribe
     #
-    # The callback is called in the same thread that listens for pyre
-    # messages, so the callback should start a new thread if it's
-    # going to block or take a long time to run.
+    # By default, the callback is called in the same thread that
+    # listens for pyre messages, so a callback that blocks or takes a
+    # long time to run holds up every other message (including QUIT).
+    # Such callbacks should pass executor='thread', which gives the
+    # subscription its own worker thread, or an executor object with a
+    # submit() method (e.g. concurrent.futures.ThreadPoolExecutor).
+    # Either way, messages are queued and the callback sees them one at
+    # a time, in order. If max_queue is given, the queue is bounded and
+    # overflow (BLOCK, DROP_OLDEST or REJECT) says what to do when a
+    # message arrives and the queue is full.
     #
     # The callback must take one positional argument, the tuple, and
     # can OPTIONALLY take a keyword argument (e.g. **kw). I use the
-    # inspect module to detect this. May be too clever for my own
-    # good.
+    # inspect module to detect this (once, when subscribing). May be
+    # too clever for my own good.
     #
-    # There can be only one callback for a given remote. If you call
-    # subscribe again with the same remote, it raises an error.
-
-    def subscribe(self, remote, callback):
-        '''When a message is sent from a Transport named remote to this transport, call the passed callback with the ntuple as the first argument. If the callback takes **kw, it will also pass additional metadata such as the Transport name, UUID, and IP of the sender.'''
+    # The tuple is decoded once per message, so if both a subscribe()
+    # and a subscribe_all() callback get a message, they get the same
+    # object. Callbacks that modify it should copy it first.
+    #
+    # remote may also be a glob, e.g. 'Solver*' for every Transport
+    # whose name starts with Solver, or 'Solver[0-9]'. Any number of
+    # callbacks may be subscribed to the same remote or to overlapping
+    # patterns; each message is passed to all of the callbacks whose
+    # remote matches its sender, in the order they were subscribed (see
+    # transport_routes.py). The callbacks for a sender are looked up
+    # once, not for every message.
+
+    def subscribe(self, remote, callback, executor=None, max_queue=None, overflow=BLOCK):
+        '''When a message is sent from a Transport named remote (or whose name matches the glob remote) to this transport, call the passed callback with the ntuple as the first argument. If the callback takes **kw, it will also pass additional metadata such as the Transport name, UUID, and IP of the sender. See the notes above for executor, max_queue and overflow.'''
         if self._prefix is not None:
             remote = self._prefix + remote
-        if remote in self._subscribers:
-            raise TransportError(self, 'Transport.subscribe() was called a second time with the same remote (\"%s\"). You must call Transport.unsubscribe() before setting a new callback.'%(remote))
-        self._subscribers[remote] = callback
+        self._subscribers.add(remote, _Subscription(self, callback, executor, max_queue, overflow))
     # subscribe()
 
-    def unsubscribe(self, remote):
-        '''Stop listening for messages from remote.'''
+    def unsubscribe(self, remote, callback=None):
+        '''Stop listening for messages from remote (the same name or glob passed to subscribe()). If callback is given, only that callback is unsubscribed.'''
         if self._prefix is not None:
             remote = self._prefix + remote
-        if remote in self._subscribers:
-            del self._subscribers[remote]
+        which = None if callback is None else lambda sub: sub.callback == callback
+        for sub in self._subscribers.remove(remote, which):
+            sub.close()
     # unsubscribe()
 
-    def subscribe_all(self, callback):
+    def subscribe_all(self, callback, executor=None, max_queue=None, overflow=BLOCK):
         '''Call callback every time a message is sent from any remote Transport to this Transport.'''
         if self._subscribe_all is not None:
             raise TransportError(self, 'Transport.subscribe_all() was called a second time. You must call Transport.unsubscribe_all() before setting a new callback.')
-        self._subscribe_all = callback
+        self._subscribe_all = _Subscription(self, callback, executor, max_queue, overflow)
     # subscribe_all()
 
     def unsubscribe_all(self):
+        if self._subscribe_all is not None:
+            self._subscribe_all.close()
         self._subscribe_all = None
     # unsubscribe_all()
 
-    # Notes on get()
+    # Notes on request
+    #
+    # request() sends payload to the Transport named dest, tagged with a
+    # correlation id, and returns a concurrent.futures.Future that the
+    # matching reply resolves. Any number of requests may be
+    # outstanding, to one or many remotes. The remote answers with
+    # respond(); if it has no responder, or the handler raises, the
+    # future fails with TransportRemoteError. If timeout (seconds) is
+    # given and no reply arrives in time, it fails with
+    # TransportTimeout. Futures are resolved, and their done callbacks
+    # run, in the read thread.
     #
-    # If you already subscribe to remote, temporarly overrides
-    # the subscribe. The subscribed callback will NOT be called.
-    # The subscription is replaced after get() returns.
+    # Requests and replies are control frames (see transport_codecs.py),
+    # so they're never passed to subscribe() callbacks.
 
-    def get(self, remote):
-        '''Block waiting for a message from a Transport named remote. Returns python namedtuple containing fields object, uuid, name, ip, datetime.'''
+    def request(self, dest, payload, timeout=None):
+        '''Send payload to the Transport named dest, which should answer with respond(). Returns a concurrent.futures.Future for the reply.'''
+        return self._request(dest, payload, timeout)[1]
+    # request()
+
+    def respond(self, handler, remote=None, executor=None, max_queue=None, overflow=BLOCK):
+        '''Answer request()s from the Transport named remote (or from any Transport without its own responder, if remote is None) with the return value of handler(payload). Like subscribe() callbacks, handler may take **kw. executor, max_queue and overflow are as for subscribe().'''
+        if remote is not None and self._prefix is not None:
+            remote = self._prefix + remote
+        if remote in self._responders:
+            raise TransportError(self, 'Transport.respond() was called a second time for remote "%s". You must call Transport.unrespond() first.'%(remote))
+        keywords = _takes_keywords(handler)
+
+        def answer(body, **kw):
+            try:
+                if keywords:
+                    reply = {'reply': body['request'], 'payload': handler(body['payload'], **kw)}
+                else:
+                    reply = {'reply': body['request'], 'payload': handler(body['payload'])}
+            except Exception as e:
+                logger.exception('Exception in Transport responder %s', handler)
+                reply = {'reply': body['request'], 'error': '%s: %s'%(type(e).__name__, e)}
+            self._send_control(kw['name'], reply)
+        # answer()
+
+        self._responders[remote] = _Subscription(self, answer, executor, max_queue, overflow)
+    # respond()
+
+    def unrespond(self, remote=None):
+        '''Stop answering requests from remote (or the catch-all responder if remote is None).'''
+        if remote is not None and self._prefix is not None:
+            remote = self._prefix + remote
+        if remote in self._responders:
+            self._responders.pop(remote).close()
+    # unrespond()
+
+    # Notes on send_reliable
+    #
+    # send() is fire and forget: a message sent before dest has been
+    # discovered, or during a disconnect, is lost. send_reliable()
+    # numbers each message to dest and resends it (when dest joins, and
+    # then with backoff) until dest acknowledges it or it has been sent
+    # transport_reliable.RETRIES times. The receiver passes messages to
+    # its callbacks in order and drops duplicates, so a reliable message
+    # arrives at most once. At most transport_reliable.WINDOW messages
+    # per dest are kept; beyond that the oldest is given up on.
+    #
+    # If status is given, status(seq, DELIVERED or FAILED) is called
+    # (from the read thread) once the outcome for message seq is known.
+    # reliable_stats() returns counts of what happened so far.
+    #
+    # Both ends must be Transports that support this; older Transports
+    # ignore reliable messages.
+
+    def send_reliable(self, dest, ntuple, status=None):
+        '''Send given ntuple to Transport named dest, resending it until dest acknowledges it. Returns the message's sequence number. See notes above.'''
+        if self._prefix is not None:
+            dest = self._prefix + dest
+        with self._reliablelock:
+            sender = self._outgoing.get(dest)
+            if sender is None:
+                sender = self._outgoing[dest] = transport_reliable.Sender()
+            seq, dropped = sender.add(ntuple, status, time.time())
+            base = sender.base()
+            self._reliablestats['sent'] += 1
+            self._reliablestats['failed'] += len(dropped)
+            buffered = sum(len(s.pending) for s in self._outgoing.values())
+            self._reliablestats['max_buffered'] = max(self._reliablestats['max_buffered'], buffered)
+        self._report(dropped, FAILED)
+        self._send_reliable(dest, seq, base, ntuple)
+        return seq
+    # send_reliable()
+
+    def reliable_stats(self):
+        '''Return a dict of counts for reliable delivery: messages sent, retransmits, delivered, failed, duplicates received, and messages buffered now and at most.'''
+        with self._reliablelock:
+            stats = dict(self._reliablestats)
+            stats['buffered'] = sum(len(s.pending) for s in self._outgoing.values())
+        return stats
+    # reliable_stats()
+
+    # Notes on stats
+    #
+    # stats() returns a dict (of dicts, lists and numbers, so it can be
+    # sent as a reply) with:
+    #   uptime     seconds since the Transport was created
+    #   channels   per channel sent to or received on, and
+    #   peers      per sender name: msgs_in, bytes_in, msgs_out,
+    #              bytes_out, and the same per second over the last
+    #              10-20 seconds (msgs_in_rate, ...)
+    #   encode,    count, total, mean and max seconds spent encoding
+    #   decode     and decoding messages
+    #   callbacks  the same for callbacks, per sender name
+    #   queues     messages waiting in each priority lane, and per
+    #              subscribed remote or pattern ('*' includes
+    #              subscribe_all()), responder and inbox
+    #   ignored    messages received that nothing was subscribed to
+    #   dropped    messages dropped by full subscription queues and
+    #              inboxes
+    #   compressed frames sent compressed, and the bytes that saved
+    #   saved      (see compress_threshold)
+    #   reliable   reliable_stats()
+    #   shm        shared-memory segments and bytes still held, if any
+    #
+    # Any Transport answers a request whose payload is STATS_REQUEST
+    # with its stats(), so remote_stats() works even on agents that
+    # don't call respond(). If stats_interval was given to the
+    # constructor, the stats are also logged (at INFO, as JSON) that
+    # often.
+
+    def stats(self):
+        '''Return a dict of traffic counts, rates, timings, queue depths and drops for this Transport.'''
+        stats = self._metrics.snapshot()
+        key = lambda name: '*' if name is None else name
+        subs = collections.defaultdict(int)
+        for pattern, sub in self._subscribers.items():
+            subs[pattern] += sub.depth()
+        if self._subscribe_all is not None:
+            subs['*'] += self._subscribe_all.depth()
+        inboxes = dict(self._inboxes)
+        stats['queues'] = {
+            'lanes': self._lanes.depths() if self._lanes is not None else [],
+            'subscriptions': dict(subs),
+            'responders': dict((key(name), sub.depth()) for name, sub in dict(self._responders).items()),
+            'inboxes': dict((name, len(inbox.queue)) for name, inbox in inboxes.items()),
+        }
+        stats['dropped'] += sum(inbox.dropped for inbox in inboxes.values())
+        stats['reliable'] = self.reliable_stats()
+        if self._segments is not None:
+            stats['shm'] = self._segments.in_use()
+        return stats
+    # stats()
+
+    def remote_stats(self, dest, timeout=None):
+        '''Ask the Transport named dest for its stats(). Returns a future, as request() does.'''
+        return self.request(dest, STATS_REQUEST, timeout)
+    # remote_stats()
+
+    # Notes on inboxes
+    #
+    # An alternative to callbacks for agents that would rather poll.
+    # Once open_inbox(remote) is called, every message from remote is
+    # kept until it's taken with recv(), recv_any() or recv_batch(), in
+    # the order it arrived. An inbox holds at most max_size messages;
+    # after that the oldest are dropped (and counted, see
+    # inbox_dropped()). Inboxes are independent of subscriptions: a
+    # message from a remote with both is passed to the callback AND
+    # kept in the inbox.
+    #
+    # recv() and recv_batch() open the inbox if it isn't already, so
+    # the first call can only see messages that arrive after it. The
+    # messages are returned as TransportEnvelope namedtuples, and are
+    # decoded in the thread that receives them.
+    #
+    # timeout is in seconds. None waits forever, 0 doesn't wait.
 
+    def open_inbox(self, remote, max_size=INBOX_SIZE):
+        '''Start keeping messages from the Transport named remote for recv(). See notes above.'''
         if self._prefix is not None:
             remote = self._prefix + remote
+        self._open_inbox(remote, max_size)
+    # open_inbox()
 
-        # The final python namedtuple to be returned needs to be shared
-        # between get_callback() and get(). In python3, you can use
-        # nonlocal, but in python2 you need a trick (storing in a
-        # data structure). The actual value to be returned will
-        # be ret[0].
-        ret = [ None ]
+    def close_inbox(self, remote):
+        '''Stop keeping messages from remote, discarding any that haven't been received.'''
+        if self._prefix is not None:
+            remote = self._prefix + remote
+        with self._inboxcond:
+            self._inboxes.pop(remote, None)
+    # close_inbox()
 
-        # The event e will get set when a message is read by the
-        # readthread.
-        e = threading.Event()
+    def inbox_dropped(self, remote):
+        '''Return the number of messages from remote dropped because its inbox was full.'''
+        if self._prefix is not None:
+            remote = self._prefix + remote
+        inbox = self._inboxes.get(remote)
+        return inbox.dropped if inbox is not None else 0
+    # inbox_dropped()
+
+    def recv(self, remote, timeout=None):
+        '''Return the oldest message from the Transport named remote as a TransportEnvelope, waiting up to timeout seconds for one. Returns None on timeout.'''
+        batch = self.recv_batch(remote, 1, timeout)
+        return batch[0] if batch else None
+    # recv()
+
+    def recv_batch(self, remote, max_n, timeout=0):
+        '''Return a list of up to max_n of the oldest messages from remote, waiting up to timeout seconds (by default, not at all) for there to be at least one.'''
+        if self._prefix is not None:
+            remote = self._prefix + remote
+        inbox = self._open_inbox(remote, INBOX_SIZE)
+        with self._inboxcond:
+            if not self._wait_inbox(lambda: inbox.queue, timeout):
+                return []
+            entries = [inbox.queue.popleft() for i in range(min(max_n, len(inbox.queue)))]
+        return [self._unpack(envelope) for seq, envelope in entries]
+    # recv_batch()
+
+    def recv_any(self, timeout=None):
+        '''Return the oldest message in any open inbox as a TransportEnvelope, waiting up to timeout seconds for one. Returns None on timeout.'''
+        def oldest():
+            heads = [inbox.queue for inbox in self._inboxes.values() if inbox.queue]
+            return min(heads, key=lambda q: q[0][0]) if heads else None
+        with self._inboxcond:
+            if not self._wait_inbox(oldest, timeout):
+                return None
+            seq, envelope = oldest().popleft()
+        return self._unpack(envelope)
+    # recv_any()
 
-        # This function is a callback used to detect the next message.
-        # It stores the message in a Python namedtuple and sets the
-        # event.
+    # Notes on get()
+    #
+    # get() is recv() without a timeout. It no longer touches the
+    # subscription for remote (if any), which still gets every message.
 
-        def get_callback(tup, **kw):
-            ret[0] = collections.namedtuple('TransportEnvelope', ['object', 'uuid', 'name', 'ip', 'datetime'])(tup, kw['uuid'], kw['name'], kw['ip'], kw['datetime'])
-            # Inform get() that ret is ready to be returned.
-            e.set()
-        # get_callback()
+    def get(self, remote):
+        '''Block waiting for a message from a Transport named remote. Returns python namedtuple containing fields object, uuid, name, ip, datetime.'''
+        return self.recv(remote)
+    # get()
 
-        # Store the old callback, if any
-        oldcb = self._subscribers.get(remote, None)
+    # Notes on wait_for_peers
+    #
+    # Until pyre discovery has found a Transport, messages to it are
+    # silently lost. wait_for_peers() returns as soon as the named
+    # Transports have ENTERed and JOINed both their own channel and the
+    # federation's global channel, so that send() and broadcast() reach
+    # them.
+    #
+    # barrier() is a rendezvous: each Transport named in parties calls
+    # barrier() with the same name (parties may include the caller),
+    # and none of them returns until all of them have. It can be
+    # reused; the nth call waits for the nth call of every other party.
+    # A barrier that timed out leaves the parties out of step, so give
+    # the next one a new name.
+    #
+    # sync() returns once the named Transports (by default, every
+    # Transport in the federation) have received everything this one
+    # sent them so far: it sends each a PING_REQUEST, whose reply comes
+    # back after everything sent before it was read.
+    #
+    # All three return False if timeout (in seconds) passes first.
 
-        # Set the subscription
-        self._subscribers[remote] = get_callback
+    def wait_for_peers(self, names, timeout=None):
+        '''Block until the Transports named in names can be sent to. Returns False if that hasn't happened within timeout seconds.'''
+        return self._wait(self._await_peers(self._prefixed(names)), timeout)
+    # wait_for_peers()
 
-        # Wait for the callback to be called.
-        e.wait()
+    def barrier(self, name, parties, timeout=None):
+        '''Block until every Transport named in parties has called barrier(name, ...) as often as this one. Returns False on timeout.'''
+        return self._wait(self._barrier(name, self._prefixed(parties)), timeout)
+    # barrier()
 
-        # Restore the old subscription, if any.
-        if oldcb is not None:
-            self._subscribers[remote] = oldcb
-        else:
-            del self._subscribers[remote]
+    def sync(self, names=None, timeout=None):
+        '''Block until the Transports named in names (default all of the federation) have received everything sent to them so far. Returns False on timeout.'''
+        return self._wait(self._sync(names, timeout), timeout)
+    # sync()
 
-        # Return the namedtuple.
-        return ret[0]
-    # get()
+    # Notes on flush
+    #
+    # If the Transport was created with batch_delay (in seconds),
+    # normal and bulk priority messages sent to a Transport that
+    # accepts batches are held for up to batch_delay, and all of those
+    # for the same destination in that time are sent as one frame,
+    # which the receiver unpacks. This saves per-message overhead for
+    # chatty streams, at the cost of up to batch_delay latency. A batch
+    # is sent early once it reaches batch_size bytes, and flush() sends
+    # every batch now. Messages to one destination stay in order, but
+    # messages to different destinations (including broadcasts) may
+    # overtake each other.
+
+    def flush(self):
+        '''Send any batched messages now.'''
+        if self._batcher is not None:
+            self._batcher.flush()
+    # flush()
 
     def quit_federation(self):
         '''Send a quit message to all agents in this federation, and then close down the Transport.'''
         if self._run:
+            self.flush()
             self._pyre.shouts(self._globalchannel, u"QUIT")
+            self.close()
+
+    def close(self):
+        '''Close down this Transport, without telling the rest of the federation to quit.'''
+        if self._run:
+            self.flush()
             self._run = False
-            # Wait for the readthread to finish
-            self._readthread.join()
+            # Wait for the readthread to finish, and the dispatch thread
+            # it closes. A callback may be what's closing us: the read
+            # thread can't join itself, and _Lanes.join skips its own.
+            if threading.current_thread() is not self._readthread:
+                self._readthread.join()
+                self._lanes.join()
             # Tell Pyre to shut down
             self._pyre.stop()
 
@@ -223,17 +1008,94 @@ class Transport():
     ######################################################################
     # All private methods below here
 
-    def __init__(self, myname, port=None, prefix=None):
+    # Notes on __new__
+    #
+    # Transport(name, loopback=True), or setting the environment
+    # variable NLUAS_TRANSPORT=loopback, makes a LoopbackTransport
+    # instead (see loopback_transport.py). It has the same API, but
+    # only talks to other LoopbackTransports in the same process.
+
+    def __new__(cls, *args, **kw):
+        if cls is Transport and (kw.get('loopback') or os.environ.get(BACKEND_ENV) == 'loopback'):
+            from nluas.loopback_transport import LoopbackTransport
+            cls = LoopbackTransport
+        return object.__new__(cls)
+    # __new__()
+
+    # Notes on __init__
+    #
+    # codecs restricts the codecs this Transport accepts (see
+    # transport_codecs.py). whisper=False asks peers not to WHISPER to
+    # it (see _send_to()). If shm_threshold is given, messages of at
+    # least that many bytes to Transports on the same host are handed
+    # over in shared memory (see transport_shm.py). If stats_interval
+    # is given, stats() are logged every stats_interval seconds. For
+    # batch_delay and batch_size, see flush(). If compress_threshold is
+    # given, frames of at least that many bytes are compressed for
+    # peers that accept it (see _send_to()).
+    #
+    # proxy=True makes a stand-in for a Transport on the other side of
+    # a bridge (see bridge_client.py). It ignores control messages such
+    # as requests and reliable messages, which the bridge forwards to
+    # the Transport it stands in for, so that one answers or acknowledges
+    # them instead.
+
+    def __init__(self, myname, port=None, prefix=None, codecs=None, whisper=True, loopback=False, shm_threshold=None, stats_interval=None,
+                 batch_delay=None, batch_size=BATCH_SIZE, compress_threshold=None, proxy=False):
         # NOTE: Seems to be a bug in Pyre where you can't set the port.
         if port is not None:
             raise NotImplementedError('There is a bug in Pyre that prevents setting of the discovery port. If you require multiple federations of Pyre components, use prefix instead of port in Transport constructor.')
 
-        # dict of remote name to callback. See subscribe method above.
-        self._subscribers = {}
+        # Shared-memory segments we've sent and that are still held by
+        # a receiver, or None if we don't send any.
+        self._shm_threshold = shm_threshold
+        self._segments = None
+        if shm_threshold is not None and transport_shm.available:
+            self._segments = transport_shm.Segments()
 
-        # Callback for all message (or None if none registered)
+        # Smallest frame to compress, or None to never compress.
+        self._compress_threshold = compress_threshold
+
+        # Whether this is a bridge proxy. See the notes above.
+        self._proxy = proxy
+
+        # transport_routes.Routes of remote names and patterns to
+        # _Subscriptions. See subscribe method above.
+        self._subscribers = transport_routes.Routes()
+
+        # _Subscription for all messages (or None if none registered)
         self._subscribe_all = None
 
+        # dict of remote name (or None for any remote) to _Subscription
+        # answering its requests. See respond().
+        self._responders = {}
+
+        # dict of remote name to _Inbox, and the condition consumers
+        # wait on. See open_inbox().
+        self._inboxes = {}
+        self._inboxcond = threading.Condition()
+        self._inboxwaiters = 0
+        self._inboxcount = 0
+
+        # Outstanding requests: correlation id => Future, and a heap of
+        # (deadline, correlation id) for those with a timeout. Entries
+        # for answered requests are left in the heap until they expire.
+        self._requests = {}
+        self._deadlines = []
+        self._requestcount = 0
+        self._requestlock = threading.Lock()
+
+        # Reliable delivery (see send_reliable()): a
+        # transport_reliable.Sender per destination name, a Receiver per
+        # sender UUID, the acks we owe (sender UUID => (name, ack)) and
+        # when they're due, and counts.
+        self._outgoing = {}
+        self._incoming = {}
+        self._acks = {}
+        self._ackdue = None
+        self._reliablestats = collections.Counter(sent=0, retransmits=0, delivered=0, failed=0, duplicates=0, max_buffered=0)
+        self._reliablelock = threading.Lock()
+
         self._prefix = prefix
 
         # Attach the federation name as a prefix to both this channel
@@ -246,22 +1108,85 @@ class Transport():
         else:
             self._globalchannel = "GLOBAL"
 
+        # Dict of (UUIDs => _Peer) that have sent a valid ENTER message,
+        # of names => set of UUIDs of the peers with that name, and of
+        # groups => set of UUIDs of the peers that joined it.
+        self._peers = {}
+        self._names = {}
+        self._groups = {}
+        self._peerlock = threading.Lock()
+
+        # wait_for_peers() calls waiting for names to be discovered, as
+        # lists of [set of names still missing, Future].
+        self._peerwaiters = []
+
+        # Barriers (see barrier()): how often each has been called,
+        # the names that arrived at each (barrier name, generation), and
+        # (set of names, Future) for those this Transport is waiting at.
+        self._barriercounts = {}
+        self._arrivals = {}
+        self._barrierwaits = {}
+        self._barrierlock = threading.Lock()
+
+        # Counters for stats(), and the decoder that times decoding.
+        self._metrics = transport_metrics.Metrics()
+        self._decode = self._metrics.decoder(transport_codecs.decode)
+        self._statsinterval = stats_interval
+        self._statsdue = None if stats_interval is None else time.time() + stats_interval
+
+        self._run = True
+
+        # _Lanes that received messages are dispatched from, or None to
+        # dispatch them as they're read (see _enqueue()).
+        self._lanes = None
+
+        # _Batcher for outgoing messages, or None to send each one as
+        # it's sent.
+        self._batcher = None
+        if batch_delay is not None:
+            self._batcher = _Batcher(self._transmit, batch_delay, batch_size, None if self._threaded else self._call_later)
+
+        self._start(myname, codecs, whisper)
+    # __init__()
+
+    def _start(self, myname, codecs, whisper):
+        '''Join the pyre network as myname and start handling its events.'''
+
+        # Codecs this Transport can decode, most preferred first.
+        # Defaults to all of the installed ones.
+        if codecs is None:
+            codecs = transport_codecs.available()
+        for c in codecs:
+            if c not in transport_codecs.CODECS:
+                raise TransportError(None, 'Unknown or uninstalled codec "%s"'%(c))
+        self._codecs = list(codecs)
+
         self._pyre = Pyre(myname)
-        if port is not None:
-            self._pyre.set_port(port)
+        self._pyre.set_header(CODECS_HEADER, ','.join(self._codecs))
+        # Peers may WHISPER to us unless whisper is False (e.g. for
+        # bridge proxies, whose traffic must be overheard).
+        features = []
+        if whisper:
+            features.append(WHISPER_FEATURE)
+        if transport_shm.available:
+            features.append(SHM_FEATURE)
+        features.append(PRIORITY_FEATURE)
+        features.append(BATCH_FEATURE)
+        features.append(COMPRESS_FEATURE)
+        if transport_codecs.ZDICT_ID is not None:
+            features.append(self._zdict_feature())
+        self._pyre.set_header(FEATURES_HEADER, ','.join(features))
+        self._pyre.set_header(HOST_HEADER, transport_shm.HOST_ID)
 
         self._pyre.join(myname)
         self._pyre.join(self._globalchannel)
         self._pyre.start()
 
-        # Dict of (UUIDs => IP addresses) that have sent a valid ENTER message
-        self._uuid2ip = {}
-
-        self._run = True
-
-        self._readthread = threading.Thread(target=self._readworker)
-        self._readthread.start()
-    # __init__()
+        if self._threaded:
+            self._lanes = _Lanes(PRIORITY_BULK + 1)
+            self._readthread = threading.Thread(target=self._readworker)
+            self._readthread.start()
+    # _start()
 
     # Handle pyre messages. Run in self._readthread
     def _readworker(self):
@@ -277,58 +1202,88 @@ class Transport():
         poller.register(sock, zmq.POLLIN)
 
         while self._run:
-            # Wait until a message is received OR one second timeout.
-            items = dict(poller.poll(1000))
+            # Wait until a message is received, OR one second timeout,
+            # OR it's time to check request deadlines.
+            items = dict(poller.poll(self._tick()))
             if not (sock in items and items[sock] == zmq.POLLIN):
                 # This should only happen if we time out.
                 continue
             # There's an event waiting. Read and process it.
-            event = self._pyre.recv()
-            logger.debug('Transport %s-%s received event %s'%(self._pyre.uuid(), self._pyre.name(), event))
-            eventtype = event[0].decode('utf-8')
-            # Sender's uuid and name
-            sid = uuid.UUID(bytes=event[1])
-            name = event[2].decode('utf-8')
-            # Make sure we've seen matching ENTER for all events
-            if eventtype != 'ENTER' and sid not in self._uuid2ip:
-                raise TransportProtocolError(self, 'Received event %s with no matching ENTER.'%(event))
-                continue
+            self._handle_event(self._pyre.recv())
 
-            if eventtype == 'ENTER':
-                # Changed
-                url = event[4].decode('utf-8')
-                self._ENTER(sid, name, url)
-            elif eventtype == 'JOIN':
-                channel = event[3].decode('utf-8')
-                self._JOIN(sid, name, channel)
-            elif eventtype == 'SHOUT':
-                channel = event[3].decode('utf-8')
-                message = event[4].decode('utf-8')
-                if channel == self._globalchannel and message == "QUIT":
-                    # Set ourself to stop running, close down pyre, exit
-                    # worker thread.
-                    self._run = False
-                    self._pyre.stop()
-                    break
-                else:
-                    self._SHOUT(sid, name, channel, message)
-            elif eventtype == 'WHISPER':
-                message = event[3].decode('utf-8')
-                self._WHISPER(sid, name, message)
-            elif eventtype == 'LEAVE':
-                channel = event[3].decode('utf-8')
-                self._LEAVE(sid, name, channel)
-            elif eventtype == 'EXIT':
-                self._EXIT(sid, name)
-            else:
-                raise TransportProtocolError(self, 'Illegal event type in event %s'%(event))
+        self._cleanup()
     # _readworker()
 
+    def _handle_event(self, event):
+        '''Process one pyre event. Called from the read thread (or, for AsyncTransport, the event loop).'''
+        logger.debug('Transport %s-%s received event %s', self._pyre.uuid(), self._pyre.name(), event)
+        eventtype = event[0].decode('utf-8')
+        # Sender's uuid and name
+        sid = uuid.UUID(bytes=event[1])
+        name = event[2].decode('utf-8')
+        # Make sure we've seen matching ENTER for all events
+        if eventtype != 'ENTER' and sid not in self._peers:
+            raise TransportProtocolError(self, 'Received event %s with no matching ENTER.'%(event))
+
+        if eventtype == 'ENTER':
+            # Changed
+            headers = json.loads(event[3].decode('utf-8'))
+            url = event[4].decode('utf-8')
+            self._ENTER(sid, name, url, headers)
+        elif eventtype == 'JOIN':
+            channel = event[3].decode('utf-8')
+            self._JOIN(sid, name, channel)
+        elif eventtype == 'SHOUT':
+            channel = event[3].decode('utf-8')
+            # The message is decoded only if there's a callback for it.
+            message = event[4]
+            if channel == self._globalchannel and message == b"QUIT":
+                # Set ourself to stop running, close down pyre. The
+                # read loop exits when it sees self._run is False.
+                self._run = False
+                self._pyre.stop()
+            else:
+                self._SHOUT(sid, name, channel, message)
+        elif eventtype == 'WHISPER':
+            message = event[3]
+            self._WHISPER(sid, name, message)
+        elif eventtype == 'LEAVE':
+            channel = event[3].decode('utf-8')
+            self._LEAVE(sid, name, channel)
+        elif eventtype == 'EXIT':
+            self._EXIT(sid, name)
+        else:
+            raise TransportProtocolError(self, 'Illegal event type in event %s'%(event))
+    # _handle_event()
+
+    def _cleanup(self):
+        '''Called once the Transport has shut down.'''
+        if self._batcher is not None:
+            self._batcher.close()
+        if self._lanes is not None:
+            self._lanes.close()
+        # Let the subscriptions' worker threads exit once they've handed
+        # over what's already queued.
+        subs = [sub for pattern, sub in self._subscribers.items()] + list(self._responders.values())
+        if self._subscribe_all is not None:
+            subs.append(self._subscribe_all)
+        for sub in subs:
+            sub.close()
+        if self._segments is not None:
+            self._segments.close()
+        # Nothing will answer outstanding requests now.
+        with self._requestlock:
+            pending = list(self._requests.values())
+            self._requests.clear()
+        for future in pending:
+            _resolve(future, exception=TransportError(self, 'Transport closed before the reply arrived'))
+    # _cleanup()
+
     # The following methods are named for the pyre event that this
     # instance has received. They are called automatically from the
     # worker thread that's listening for events.
 
-    def _ENTER(self, sid, name, url):
+    def _ENTER(self, sid, name, url, headers):
         # We expect all connections to be tcp on some port. This regular
         # expression is used to extract the ip part.
         urlmatch = re.match('tcp://([0-9.]+):[0-9]+$', url)
@@ -336,7 +1291,13 @@ class Transport():
             ip = urlmatch.group(1)
             if is_valid_ip(ip):
                 # Everything looks good. Add to list of valid uuids.
-                self._uuid2ip[sid] = ip
+                codecs = headers.get(CODECS_HEADER)
+                if codecs is not None:
+                    codecs = codecs.split(',')
+                features = set(headers.get(FEATURES_HEADER, '').split(','))
+                with self._peerlock:
+                    self._peers[sid] = _Peer(sid, name, ip, codecs, features, headers.get(HOST_HEADER))
+                    self._names.setdefault(name, set()).add(sid)
             else:
                 raise TransportSecurityError(self, 'Message from invalid IP address %s in ENTER %s %s %s. Check the function is_valid_ip() in Transport.py.'%(ip, sid, name, url))
         else:
@@ -344,41 +1305,533 @@ class Transport():
     # _ENTER()
 
     def _JOIN(self, sid, name, channel):
-        pass
+        with self._peerlock:
+            self._peers[sid].groups.add(channel)
+            self._groups.setdefault(channel, set()).add(sid)
+        # A destination we have reliable messages for just appeared.
+        # Don't wait for the retransmit timers.
+        with self._reliablelock:
+            sender = self._outgoing.get(channel)
+            resend = sender.resend_all(time.time()) if sender is not None else []
+            base = sender.base() if sender is not None else None
+        for seq, obj in resend:
+            self._send_reliable(channel, seq, base, obj)
+        if self._peerwaiters:
+            self._peers_changed()
     # _JOIN()
 
     def _SHOUT(self, sid, name, channel, message):
-        now = datetime.datetime.now()
-        logger.debug('In _SHOUT with %s %s %s %s'%(sid, name, channel, message)) #???
-        if name in self._subscribers:
-            logger.debug('got a subscription')
-            cb = self._subscribers[name]
-            self._call_callback(cb, sid, name, channel, message, now)
-        if self._subscribe_all is not None:
-            cb = self._subscribe_all
-            self._call_callback(cb, sid, name, channel, message, now)
+        if transport_codecs.is_batch(message):
+            for frame in transport_codecs.split_batch(message):
+                self._SHOUT(sid, name, channel, frame)
+            return
+        self._metrics.received(channel, name, len(message))
+        priority, message = transport_codecs.split_priority(message, PRIORITY_NORMAL)
+        if transport_shm.is_descriptor(message):
+            self._SHARED(sid, name, channel, message, priority)
+            return
+        if transport_codecs.is_control(message):
+            self._CONTROL(sid, name, channel, message[1:])
+            return
+        # Messages nobody is subscribed to are dropped before doing
+        # any other work.
+        if self._wants(name):
+            self._enqueue(priority, self._dispatch, _Envelope(sid, name, self._peers[sid].ip, channel, message, datetime.datetime.now(), decode=self._decode))
+        else:
+            self._metrics.count('ignored')
     # _SHOUT()
 
-    def _call_callback(self, cb, sid, name, channel, message, now):
-        if inspect.getargspec(cb).keywords is None:
-            cb(json.loads(message))
+    def _SHARED(self, sid, name, channel, message, priority=PRIORITY_NORMAL):
+        # A frame handed over in shared memory. Released without
+        # decoding if nobody is subscribed.
+        try:
+            payload = transport_shm.SharedPayload(message, lambda segment: self._send_control(name, {'release': segment}))
+        except (OSError, ValueError):
+            logger.warning('Shared memory message from %s %s is no longer available', sid, name)
+            return
+        envelope = _Envelope(sid, name, self._peers[sid].ip, channel, None, datetime.datetime.now(), decode=self._metrics.decoder(lambda data: payload.decode()))
+        if payload.is_control():
+            self._control(envelope)
+        elif self._wants(name):
+            self._enqueue(priority, self._dispatch, envelope)
         else:
-            cb(message, uuid=sid, name=name, ip=self._uuid2ip[sid], datetime=now)
-    # _call_callback
+            self._metrics.count('ignored')
+            payload.release()
+    # _SHARED()
+
+    def _enqueue(self, priority, func, envelope):
+        '''Call func(envelope) from the dispatch thread, after anything more urgent, or right away if there isn't one.'''
+        if self._lanes is None:
+            func(envelope)
+        else:
+            self._lanes.put(priority, func, envelope)
+    # _enqueue()
+
+    def _wants(self, name):
+        '''True if anything will receive messages from the Transport named name.'''
+        return bool(self._subscribers.match(name)) or self._subscribe_all is not None or name in self._inboxes
+    # _wants()
+
+    def _dispatch(self, envelope):
+        '''Pass a received message to the subscriptions and inbox for its sender.'''
+        subs = self._subscribers.match(envelope.name)
+        suball = self._subscribe_all
+        inbox = self._inboxes.get(envelope.name)
+        if inbox is not None:
+            self._inboxcount += 1
+            inbox.append((self._inboxcount, envelope))
+            if self._inboxwaiters > 0:
+                with self._inboxcond:
+                    self._inboxcond.notify_all()
+        for sub in subs:
+            sub.dispatch(envelope)
+        if suball is not None:
+            suball.dispatch(envelope)
+    # _dispatch()
+
+    def _open_inbox(self, remote, max_size):
+        # remote already includes the prefix, if any.
+        inbox = self._inboxes.get(remote)
+        if inbox is None:
+            with self._inboxcond:
+                inbox = self._inboxes.setdefault(remote, _Inbox(max_size))
+        return inbox
+    # _open_inbox()
+
+    def _wait_inbox(self, ready, timeout):
+        '''Wait, holding self._inboxcond, until ready() is true or timeout seconds pass. Returns whether ready() is true.'''
+        deadline = None if timeout is None else time.time() + timeout
+        self._inboxwaiters += 1
+        try:
+            while not ready():
+                if deadline is None:
+                    self._inboxcond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._inboxcond.wait(remaining)
+            return True
+        finally:
+            self._inboxwaiters -= 1
+    # _wait_inbox()
+
+    def _unpack(self, envelope):
+        return TransportEnvelope(envelope.object(), envelope.sid, envelope.name, envelope.ip, envelope.datetime)
+    # _unpack()
+
+    def _CONTROL(self, sid, name, channel, message):
+        self._control(_Envelope(sid, name, self._peers[sid].ip, channel, message, datetime.datetime.now(), decode=self._decode))
+    # _CONTROL()
+
+    def _control(self, envelope):
+        '''Handle a received control message (an RPC request or reply).'''
+        name = envelope.name
+        body = envelope.object()
+        if self._proxy:
+            # The bridge forwards it to the Transport we stand in for.
+            return
+        if 'release' in body:
+            if self._segments is not None:
+                self._segments.release(body['release'], envelope.sid)
+        elif 'rel' in body:
+            self._receive_reliable(envelope, body)
+        elif 'barrier' in body:
+            key = (body['barrier'], body['gen'])
+            with self._barrierlock:
+                self._arrivals.setdefault(key, set()).add(name)
+            self._check_barrier(key)
+        elif 'ack' in body:
+            if body['to'] == self._pyre.uuid().hex:
+                with self._reliablelock:
+                    sender = self._outgoing.get(name)
+                    delivered = sender.ack(body['ack']) if sender is not None else []
+                    self._reliablestats['delivered'] += len(delivered)
+                self._report(delivered, DELIVERED)
+        elif 'reply' in body:
+            with self._requestlock:
+                future = self._requests.pop(body['reply'], None)
+            # None if it expired, or if the request came from another
+            # Transport with the same name as this one.
+            if future is not None:
+                if 'error' in body:
+                    _resolve(future, exception=TransportRemoteError(self, 'Request to %s failed: %s'%(name, body['error'])))
+                else:
+                    _resolve(future, body['payload'])
+        elif 'request' in body:
+            sub = self._responders.get(name, self._responders.get(None))
+            if body['payload'] == STATS_REQUEST:
+                self._send_control(name, {'reply': body['request'], 'payload': self.stats()})
+            elif body['payload'] == PING_REQUEST:
+                self._send_control(name, {'reply': body['request'], 'payload': None})
+            elif sub is not None:
+                self._enqueue(PRIORITY_CONTROL, sub.dispatch, envelope)
+            else:
+                self._send_control(name, {'reply': body['request'], 'error': 'No responder for %s'%(name)})
+        else:
+            raise TransportProtocolError(self, 'Malformed control message from %s %s'%(envelope.sid, name))
+    # _control()
+
+    def _request(self, dest, payload, timeout):
+        '''Send a request. Returns its correlation id and future.'''
+        if self._prefix is not None:
+            dest = self._prefix + dest
+        future = concurrent.futures.Future()
+        with self._requestlock:
+            self._requestcount += 1
+            cid = '%s-%d'%(self._pyre.uuid().hex, self._requestcount)
+            self._requests[cid] = future
+            if timeout is not None:
+                heapq.heappush(self._deadlines, (time.time() + timeout, cid))
+        self._send_control(dest, {'request': cid, 'payload': payload})
+        return cid, future
+    # _request()
+
+    def _prefixed(self, names):
+        if self._prefix is None:
+            return list(names)
+        return [self._prefix + name for name in names]
+    # _prefixed()
+
+    def _wait(self, future, timeout):
+        '''Return the result of future (True if it's None), or False if it isn't done within timeout seconds, in which case it's cancelled.'''
+        try:
+            result = future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            return False
+        return True if result is None else result
+    # _wait()
+
+    def _peer_ready(self, name):
+        '''True if a Transport named name (prefix included) has joined its own and the global channel. Called with self._peerlock held.'''
+        members = self._groups.get(self._globalchannel, ())
+        return any(sid in members for sid in self._groups.get(name, ()))
+    # _peer_ready()
+
+    def _await_peers(self, names):
+        '''Return a Future that's resolved once every Transport in names (prefix included) is ready.'''
+        future = concurrent.futures.Future()
+        with self._peerlock:
+            waiting = set(name for name in names if not self._peer_ready(name))
+            if waiting:
+                self._peerwaiters.append([waiting, future])
+        if not waiting:
+            _resolve(future)
+        return future
+    # _await_peers()
+
+    def _peers_changed(self):
+        '''Resolve the futures of wait_for_peers() calls whose peers are all ready now.'''
+        ready = []
+        with self._peerlock:
+            for waiter in list(self._peerwaiters):
+                waiter[0] = set(name for name in waiter[0] if not self._peer_ready(name))
+                if not waiter[0] or waiter[1].cancelled():
+                    self._peerwaiters.remove(waiter)
+                    ready.append(waiter[1])
+        for future in ready:
+            _resolve(future)
+    # _peers_changed()
+
+    def _barrier(self, name, parties):
+        '''Arrive at barrier name. Returns a Future that's resolved once every Transport in parties (prefix included) has too.'''
+        others = set(parties) - set([self._pyre.name()])
+        future = concurrent.futures.Future()
+        with self._barrierlock:
+            gen = self._barriercounts[name] = self._barriercounts.get(name, 0) + 1
+            key = (name, gen)
+            self._barrierwaits[key] = (others, future)
+        # Tell the others once they can hear it.
+        peers = self._await_peers(others)
+        def arrive(f):
+            if not f.cancelled():
+                for party in others:
+                    self._send_control(party, {'barrier': name, 'gen': gen})
+        # arrive()
+        peers.add_done_callback(arrive)
+        def forget(f):
+            if f.cancelled():
+                peers.cancel()
+                with self._barrierlock:
+                    self._barrierwaits.pop(key, None)
+                    self._arrivals.pop(key, None)
+        # forget()
+        future.add_done_callback(forget)
+        self._check_barrier(key)
+        return future
+    # _barrier()
+
+    def _check_barrier(self, key):
+        '''Resolve the barrier waited at for key (barrier name, generation) if everyone has arrived.'''
+        with self._barrierlock:
+            wait = self._barrierwaits.get(key)
+            if wait is None or not wait[0] <= self._arrivals.get(key, set()):
+                return
+            del self._barrierwaits[key]
+            self._arrivals.pop(key, None)
+        _resolve(wait[1])
+    # _check_barrier()
+
+    def _sync(self, names, timeout):
+        '''Send a PING_REQUEST to each Transport in names (default all of the federation). Returns a Future that's resolved with False if any timed out, and True otherwise, once all are answered.'''
+        # Batched messages have to go out before the pings.
+        self.flush()
+        if names is None:
+            with self._peerlock:
+                names = set(self._peers[sid].name for sid in self._groups.get(self._globalchannel, ())
+                            if self._peers[sid].codecs is not None)
+            if self._prefix is not None:
+                names = [name[len(self._prefix):] for name in names]
+        futures = [self._request(name, PING_REQUEST, timeout)[1] for name in names]
+        done = concurrent.futures.Future()
+        remaining = [len(futures)]
+        lock = threading.Lock()
+        def answered(f):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            _resolve(done, not any(isinstance(f.exception(), TransportTimeout) for f in futures))
+        # answered()
+        if not futures:
+            _resolve(done, True)
+        for f in futures:
+            f.add_done_callback(answered)
+        return done
+    # _sync()
+
+    def _forget_request(self, cid):
+        '''Stop waiting for the reply to request cid.'''
+        with self._requestlock:
+            self._requests.pop(cid, None)
+    # _forget_request()
+
+    def _send_control(self, dest, body):
+        # dest already includes the prefix, if any.
+        self._send_to(dest, lambda codec: transport_codecs.encode_control(body, codec))
+    # _send_control()
+
+    # Notes on _send_to
+    #
+    # A message for dest is WHISPERed straight to it if dest is exactly
+    # one Transport that accepts WHISPERs, and nobody else has joined
+    # the dest group (e.g. a bridge client, which forwards what it
+    # overhears there). Otherwise, including while we haven't yet seen
+    # dest's JOIN, it's SHOUTed to the dest group as before.
+    #
+    # The frame is encoded with the best codec shared by dest and every
+    # other member of the dest group, or plain JSON if any of them
+    # didn't advertise codecs.
+    #
+    # If this Transport has a shm_threshold, a frame at least that big
+    # goes in shared memory when every member of the dest group is a
+    # Transport on this host that reads shared memory.
+    #
+    # Otherwise, if this Transport has a compress_threshold, a frame at
+    # least that big is compressed when every member accepts compressed
+    # frames, using the template dictionary if they all have the same
+    # one as us. Frames that compression doesn't shrink go as they are.
+    # Bridge clients don't accept compressed frames; they compress on
+    # the bridge link instead (see bridge_client.py).
+
+    def _send_to(self, dest, encode, broadcast=False, priority=PRIORITY_NORMAL, batch=False):
+        '''Send the frame returned by encode(codec) to the Transport(s) named dest (prefix included), or to the global channel dest if broadcast. If batch, the frame may be batched.'''
+        with self._peerlock:
+            sids = set(self._peers) if broadcast else self._names.get(dest, set())
+            peers = [self._peers[sid] for sid in sids]
+            members = self._groups.get(dest, set())
+            direct = (not broadcast and len(peers) == 1 and WHISPER_FEATURE in peers[0].features
+                      and members == sids)
+            shared = (self._segments is not None and len(members) > 0
+                      and all(SHM_FEATURE in self._peers[sid].features and self._peers[sid].host == transport_shm.HOST_ID
+                              for sid in members))
+            prioritized = (priority != PRIORITY_NORMAL and len(members) > 0
+                           and all(PRIORITY_FEATURE in self._peers[sid].features for sid in members))
+            batch = (batch and self._batcher is not None and priority != PRIORITY_CONTROL and len(members) > 0
+                     and all(BATCH_FEATURE in self._peers[sid].features for sid in members))
+            compress = (self._compress_threshold is not None and len(members) > 0
+                        and all(COMPRESS_FEATURE in self._peers[sid].features for sid in members))
+            zdict = compress and all(self._zdict_feature() in self._peers[sid].features for sid in members)
+            members = set(members)
+            # Everyone who gets the frame has to be able to decode it,
+            # including other members of the dest group (e.g. bridge
+            # clients, which advertise no codecs).
+            receivers = [self._peers[sid] for sid in sids | members if sid in self._peers]
+        start = time.time()
+        frame = encode(self._codec_for(receivers))
+        if shared and len(frame) >= self._shm_threshold:
+            encoded = time.time()
+            frame = self._segments.put(frame, members)
+        elif compress and len(frame) >= self._compress_threshold:
+            size = len(frame)
+            frame = transport_codecs.compress(frame, zdict)
+            encoded = time.time()
+            if len(frame) < size:
+                self._metrics.count('compressed')
+                self._metrics.count('saved', size - len(frame))
+        else:
+            encoded = time.time()
+        self._metrics.sent(dest, len(frame), encoded - start, set(peer.name for peer in receivers))
+        if prioritized:
+            frame = transport_codecs.encode_priority(frame, priority)
+        sid = peers[0].sid if direct else None
+        if self._batcher is None:
+            self._transmit(dest, frame, sid)
+        elif batch and len(frame) < self._batcher.size:
+            self._batcher.add(dest, sid, frame)
+        else:
+            self._batcher.send(dest, sid, frame)
+    # _send_to()
+
+    def _zdict_feature(self):
+        return '%s-%s'%(ZDICT_FEATURE, transport_codecs.ZDICT_ID)
+    # _zdict_feature()
+
+    def _call_later(self, seconds, func):
+        '''Call func after seconds, from the thread that handles pyre events. Subclasses that aren't _threaded must define it.'''
+        raise NotImplementedError()
+    # _call_later()
+
+    def _transmit(self, dest, frame, sid):
+        if sid is not None:
+            self._pyre.whisper(sid, frame)
+        else:
+            self._pyre.shout(dest, frame)
+    # _transmit()
+
+    def _send_reliable(self, dest, seq, base, obj):
+        self._send_control(dest, {'rel': seq, 'base': base, 'from': self._pyre.uuid().hex, 'payload': obj})
+    # _send_reliable()
+
+    def _receive_reliable(self, envelope, body):
+        with self._reliablelock:
+            receiver = self._incoming.get(envelope.sid)
+            if receiver is None:
+                receiver = self._incoming[envelope.sid] = transport_reliable.Receiver()
+            ready, duplicate = receiver.receive(body['rel'], body['base'], body['payload'])
+            if duplicate:
+                self._reliablestats['duplicates'] += 1
+            self._acks[envelope.sid] = (envelope.name, body['from'], receiver.acked())
+            if self._ackdue is None:
+                self._ackdue = time.time() + ACK_DELAY
+        if ready and self._wants(envelope.name):
+            for obj in ready:
+                self._enqueue(PRIORITY_NORMAL, self._dispatch, _Envelope(envelope.sid, envelope.name, envelope.ip, envelope.channel, None, envelope.datetime, obj))
+    # _receive_reliable()
+
+    def _report(self, outcomes, status):
+        '''Call the status callbacks in outcomes, a list of (seq, callback or None).'''
+        for seq, callback in outcomes:
+            if callback is not None:
+                try:
+                    callback(seq, status)
+                except Exception:
+                    logger.exception('Exception in Transport status callback %s', callback)
+    # _report()
+
+    def _tick(self):
+        '''Expire requests, send acks that are due, and resend or give up on unacknowledged reliable messages. Returns how long (in ms) the caller may wait before calling again.'''
+        wait = min(self._expire_requests(), self._dump_stats())
+        if not (self._outgoing or self._acks):
+            return wait
+        now = time.time()
+        acks, resend, failed = [], [], []
+        with self._reliablelock:
+            if self._ackdue is not None and self._ackdue <= now:
+                acks = list(self._acks.values())
+                self._acks.clear()
+                self._ackdue = None
+            for dest, sender in self._outgoing.items():
+                due, gaveup = sender.due(now)
+                resend.extend((dest, seq, sender.base(), obj) for seq, obj in due)
+                failed.extend(gaveup)
+            self._reliablestats['retransmits'] += len(resend)
+            self._reliablestats['failed'] += len(failed)
+            waits = [t for t in [self._ackdue] + [s.next_due() for s in self._outgoing.values()] if t is not None]
+        for name, sender_id, ack in acks:
+            self._send_control(name, {'ack': ack, 'to': sender_id})
+        for dest, seq, base, obj in resend:
+            self._send_reliable(dest, seq, base, obj)
+        self._report(failed, FAILED)
+        if waits:
+            wait = min(wait, TICK * 1000, max((min(waits) - now) * 1000, 1))
+        return int(max(wait, 1))
+    # _tick()
+
+    def _dump_stats(self):
+        '''Log stats() if they're due. Returns how long (in ms) the caller may wait before calling again.'''
+        if self._statsdue is None:
+            return 1000
+        now = time.time()
+        if now >= self._statsdue:
+            self._statsdue = now + self._statsinterval
+            logger.info('Transport %s stats: %s', self._pyre.name(), json.dumps(self.stats(), sort_keys=True))
+        return int(max(min(1000, (self._statsdue - now) * 1000), 1))
+    # _dump_stats()
+
+    def _expire_requests(self):
+        '''Fail requests whose deadline has passed. Returns how long (in ms) the read thread may wait before calling again.'''
+        expired = []
+        with self._requestlock:
+            now = time.time()
+            while self._deadlines and self._deadlines[0][0] <= now:
+                future = self._requests.pop(heapq.heappop(self._deadlines)[1], None)
+                if future is not None:
+                    expired.append(future)
+            if self._deadlines:
+                wait = min(1000, TICK * 1000, (self._deadlines[0][0] - now) * 1000)
+            else:
+                wait = 1000
+        for future in expired:
+            _resolve(future, exception=TransportTimeout(self, 'Request timed out'))
+        return int(max(wait, 1))
+    # _expire_requests()
+
+    def _codec_for(self, peers):
+        '''Return the best codec that this Transport and all peers share, or None (meaning plain JSON) if there are no peers or any of them is an old Transport.'''
+        if len(peers) == 0 or any(p.codecs is None for p in peers):
+            return None
+        return transport_codecs.best_common([self._codecs] + [p.codecs for p in peers])
+    # _codec_for()
 
 
     def _WHISPER(self, sid, name, message):
-        raise TransportProtocolError(self, 'Unexpected WHISPER from %s %s'%(sid, name))
+        # Sent to us directly by _send_to(), so handled just like a
+        # SHOUT to our own group.
+        self._SHOUT(sid, name, self._pyre.name(), message)
     # _WHISPER()
 
     def _LEAVE(self, sid, name, channel):
-        pass
+        with self._peerlock:
+            self._leave(self._peers[sid], channel)
     # _LEAVE()
 
+    def _leave(self, peer, channel):
+        # Called with self._peerlock held.
+        peer.groups.discard(channel)
+        members = self._groups.get(channel)
+        if members is not None:
+            members.discard(peer.sid)
+            if len(members) == 0:
+                del self._groups[channel]
+    # _leave()
+
     def _EXIT(self, sid, name):
         # Remove sid from list of valid uuids. This should
         # never be an error since we check in _readworker().
-        del self._uuid2ip[sid]
+        with self._peerlock:
+            peer = self._peers.pop(sid)
+            if self._segments is not None:
+                self._segments.drop_holder(sid)
+            for channel in list(peer.groups):
+                self._leave(peer, channel)
+            self._names[peer.name].discard(sid)
+            if len(self._names[peer.name]) == 0:
+                del self._names[peer.name]
+        with self._reliablelock:
+            self._incoming.pop(sid, None)
+            self._acks.pop(sid, None)
     # _EXIT()
 # class Transport
 
@@ -0,0 +1,272 @@
+######################################################################
+#
+# File: async_transport.py
+#
+# An asyncio front end to Transport.
+#
+# AsyncTransport is a Transport whose pyre events are handled by an
+# asyncio event loop instead of a read thread: the loop watches the
+# pyre socket's file descriptor, so all callbacks, inboxes and futures
+# are serviced on the loop's thread. Messages can then be consumed
+# with e.g.:
+#
+#   t = AsyncTransport('ProblemSolver')
+#   async for envelope in t.messages('AgentUI'):
+#       reply = await t.request('Robot', envelope.object, timeout=5)
+#
+# Requires python 3.6 or later. The plain Transport API (send,
+# subscribe, ...) still works, but blocking calls such as get() and
+# recv() with a timeout would block the event loop and should not be
+# used.
+#
+# Messages are handled in the order they're read, whatever their
+# priority (see Transport.send()); the event loop is the only thread
+# that could queue them. Likewise, batches (see Transport.flush()) are
+# sent from the loop, not from a flush thread.
+#
+
+# ------
+# See LICENSE.txt for licensing information.
+# ------
+
+import asyncio
+import collections
+
+import zmq
+
+from nluas.Transport import *
+from nluas.Transport import _takes_keywords, logger
+
+# Default number of messages a messages() iterator buffers before it
+# starts dropping the oldest.
+QUEUE_SIZE = 1024
+
+class AsyncTransport(Transport):
+    '''A Transport driven by an asyncio event loop.'''
+
+    _threaded = False
+
+    def __init__(self, myname, port=None, prefix=None, codecs=None, whisper=True, loop=None, stats_interval=None,
+                 batch_delay=None, batch_size=BATCH_SIZE, compress_threshold=None):
+        # dict of remote name (None for all) to list of queues of the
+        # messages() iterators over it.
+        self._streams = collections.defaultdict(list)
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        Transport.__init__(self, myname, port, prefix, codecs, whisper, stats_interval=stats_interval,
+                           batch_delay=batch_delay, batch_size=batch_size, compress_threshold=compress_threshold)
+        self._sock = self._pyre.socket()
+        self._fd = self._sock.getsockopt(zmq.FD)
+        self._loop.add_reader(self._fd, self._on_readable)
+        # The FD is edge triggered, so events that arrived before
+        # add_reader() wouldn't wake the loop.
+        self._loop.call_soon(self._on_readable)
+        # Reliable delivery timers (see Transport._tick()).
+        self._tickhandle = None
+        self._schedule_tick()
+    # __init__()
+
+    async def send(self, dest, ntuple, priority=PRIORITY_NORMAL):
+        '''Send given ntuple to Transport named dest.'''
+        Transport.send(self, dest, ntuple, priority)
+    # send()
+
+    async def broadcast(self, ntuple, priority=PRIORITY_NORMAL):
+        '''Send given ntuple to all Transports.'''
+        Transport.broadcast(self, ntuple, priority)
+    # broadcast()
+
+    async def request(self, dest, payload, timeout=None):
+        '''Send payload to the Transport named dest and return its reply (see Transport.request()). Raises TransportTimeout if no reply arrives within timeout seconds. If the awaiting task is cancelled, the request is forgotten and a late reply is ignored.'''
+        cid, future = self._request(dest, payload, None)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future, loop=self._loop), timeout)
+        except asyncio.TimeoutError:
+            raise TransportTimeout(self, 'Request to %s timed out'%(dest))
+        finally:
+            self._forget_request(cid)
+    # request()
+
+    def send_reliable(self, dest, ntuple, status=None):
+        '''As Transport.send_reliable().'''
+        seq = Transport.send_reliable(self, dest, ntuple, status)
+        self._schedule_tick()
+        return seq
+    # send_reliable()
+
+    def respond(self, handler, remote=None, executor=None, max_queue=None, overflow=BLOCK):
+        '''As Transport.respond(), but handler may also be a coroutine function, in which case each request is answered from its own task.'''
+        if not asyncio.iscoroutinefunction(handler):
+            return Transport.respond(self, handler, remote, executor, max_queue, overflow)
+        keywords = _takes_keywords(handler)
+
+        def answer(payload, **kw):
+            # Runs the coroutine as a task and returns a future for its
+            # result, which _send_reply() waits for.
+            if keywords:
+                return asyncio.ensure_future(handler(payload, **kw), loop=self._loop)
+            return asyncio.ensure_future(handler(payload), loop=self._loop)
+        # answer()
+
+        return Transport.respond(self, answer, remote, executor, max_queue, overflow)
+    # respond()
+
+    async def messages(self, remote=None, max_size=QUEUE_SIZE):
+        '''Asynchronously iterate over the messages from the Transport named remote (or from all Transports if remote is None), as TransportEnvelope namedtuples. Only messages that arrive after the iteration starts are seen. If more than max_size are waiting, the oldest are dropped. The iteration ends when the Transport shuts down. If you break out of it early, call aclose() on the iterator so it stops buffering.'''
+        if remote is not None and self._prefix is not None:
+            remote = self._prefix + remote
+        queue = collections.deque(maxlen=max_size)
+        waiter = [None]
+        entry = (queue, waiter)
+        self._streams[remote].append(entry)
+        try:
+            while True:
+                while not queue:
+                    if not self._run:
+                        return
+                    waiter[0] = self._loop.create_future()
+                    await waiter[0]
+                envelope = queue.popleft()
+                if envelope is None:
+                    return
+                yield self._unpack(envelope)
+        finally:
+            self._streams[remote].remove(entry)
+            if not self._streams[remote]:
+                del self._streams[remote]
+    # messages()
+
+    async def wait_for_peers(self, names, timeout=None):
+        '''As Transport.wait_for_peers().'''
+        return await self._await(self._await_peers(self._prefixed(names)), timeout)
+    # wait_for_peers()
+
+    async def barrier(self, name, parties, timeout=None):
+        '''As Transport.barrier().'''
+        return await self._await(self._barrier(name, self._prefixed(parties)), timeout)
+    # barrier()
+
+    async def sync(self, names=None, timeout=None):
+        '''As Transport.sync().'''
+        return await self._await(self._sync(names, timeout), timeout)
+    # sync()
+
+    def stats(self):
+        '''As Transport.stats(), plus the messages waiting in messages() iterators, per remote name ('*' for all).'''
+        stats = Transport.stats(self)
+        stats['queues']['streams'] = dict(('*' if remote is None else remote, sum(len(queue) for queue, waiter in entries))
+                                          for remote, entries in self._streams.items())
+        return stats
+    # stats()
+
+    def quit_federation(self):
+        '''Send a quit message to all agents in this federation, and then close down the Transport.'''
+        if self._run:
+            self.flush()
+            self._pyre.shouts(self._globalchannel, u"QUIT")
+            self.close()
+    # quit_federation()
+
+    def close(self):
+        '''Close down this Transport, without telling the rest of the federation to quit.'''
+        if self._run:
+            self.flush()
+            self._run = False
+            self._pyre.stop()
+            self._shutdown()
+    # close()
+
+    ######################################################################
+    # All private methods below here
+
+    def _on_readable(self):
+        # Handle every event that's waiting; the loop will only call
+        # again once more arrive.
+        while self._run and self._sock.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+            # Nothing may escape: events still waiting would sit there
+            # until the next one arrives.
+            try:
+                self._handle_event(self._pyre.recv())
+            except Exception:
+                logger.exception('Exception handling pyre event')
+        if not self._run:
+            # Got a QUIT, which has already stopped pyre.
+            self._shutdown()
+        else:
+            # Handling the events may have left acks to send.
+            self._schedule_tick()
+    # _on_readable()
+
+    def _shutdown(self):
+        self._loop.remove_reader(self._fd)
+        if self._tickhandle is not None:
+            self._tickhandle.cancel()
+        self._cleanup()
+        for entries in list(self._streams.values()):
+            for queue, waiter in entries:
+                queue.append(None)
+                self._wake(waiter)
+    # _shutdown()
+
+    def _wants(self, name):
+        return name in self._streams or None in self._streams or Transport._wants(self, name)
+    # _wants()
+
+    def _dispatch(self, envelope):
+        for queue, waiter in self._streams.get(envelope.name, []) + self._streams.get(None, []):
+            queue.append(envelope)
+            self._wake(waiter)
+        Transport._dispatch(self, envelope)
+    # _dispatch()
+
+    def _send_control(self, dest, body):
+        # Replies from coroutine responders are futures; send them once
+        # they're done.
+        if 'reply' in body and isinstance(body.get('payload'), asyncio.Future):
+            task = body['payload']
+            task.add_done_callback(lambda t: self._send_reply(dest, body['reply'], t))
+        else:
+            Transport._send_control(self, dest, body)
+    # _send_control()
+
+    def _send_reply(self, dest, cid, task):
+        if task.cancelled():
+            reply = {'reply': cid, 'error': 'Cancelled'}
+        elif task.exception() is not None:
+            e = task.exception()
+            reply = {'reply': cid, 'error': '%s: %s'%(type(e).__name__, e)}
+        else:
+            reply = {'reply': cid, 'payload': task.result()}
+        Transport._send_control(self, dest, reply)
+    # _send_reply()
+
+    async def _await(self, future, timeout):
+        # As Transport._wait(), without blocking the loop.
+        try:
+            result = await asyncio.wait_for(asyncio.wrap_future(future, loop=self._loop), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True if result is None else result
+    # _await()
+
+    def _schedule_tick(self):
+        if self._tickhandle is not None:
+            self._tickhandle.cancel()
+        self._tickhandle = self._loop.call_later(self._tick() / 1000.0, self._on_tick)
+    # _schedule_tick()
+
+    def _on_tick(self):
+        self._tickhandle = None
+        if self._run:
+            self._schedule_tick()
+    # _on_tick()
+
+    def _call_later(self, seconds, func):
+        # Batches are flushed from the loop, like everything else.
+        self._loop.call_later(seconds, func)
+    # _call_later()
+
+    def _wake(self, waiter):
+        if waiter[0] is not None and not waiter[0].done():
+            waiter[0].set_result(None)
+    # _wake()
+# class AsyncTransport
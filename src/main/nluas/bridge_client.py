@@ -51,32 +51,63 @@
 # The client/server communicate with a low level socket, which
 # introduces some complexity in the code. Specifically, the objects
 # have to be serialized (using json), and we have to handle framing
-# ourselves. Framing is done by sending an ascii count of the
-# serialized object's size in bytes followed by a newline (\n)
-# followed by the bytes in the serialized object.
+# ourselves. The wire formats are described at the top of
+# bridge_server.py. The client asks for the BINARY format when it
+# connects, and falls back to the LEGACY one (an ascii count of the
+# serialized object's size in bytes, a newline, and the serialized
+# object) if the server is too old to answer. BridgeConnection reads
+# as much as the server has sent at once and splits it into messages,
+# and writes each batch of messages with one vectored send.
+#
+# Messages from local Transports are unpacked from batch and priority
+# frames, and keep their priority across the bridge. Control frames
+# (e.g. request() and its reply, or a barrier()) are forwarded as
+# CONTROL messages, if the server is new enough to route them, and the
+# proxy of their sender passes them on. Proxies don't answer control
+# messages themselves (see Transport's proxy argument), so a request()
+# is answered, and a send_reliable() acknowledged, by the remote
+# Transport it was meant for. Shared-memory frames aren't forwarded.
+#
+# Compression happens on the bridge link rather than between
+# Transports. The client advertises no Transport features, so local
+# Transports send it uncompressed frames; if the server speaks the
+# COMPRESSED wire format, the client compresses each message of at
+# least -compress_threshold bytes before sending it over the bridge,
+# and decompresses what it receives. The server passes compressed
+# messages on as they are to other COMPRESSED clients.
 #
 
 from __future__ import print_function
 
 from six.moves import input
-import six
 
 import argparse
 import json
 import logging
-import select
 import signal
 import socket
 import sys
 import threading
+import time
 import uuid
+import zlib
 
 from pyre import Pyre
 import zmq
 
 from nluas import Transport
+from nluas import bridge_server
+from nluas import transport_codecs
+from nluas import transport_shm
+
+VERSION = 0.2
 
-VERSION = 0.1
+# Most buffers to pass to one sendmsg() call (the usual IOV_MAX).
+MAX_IOV = 1024
+
+# Default -compress_threshold: smallest message (in bytes of JSON) to
+# compress on the bridge link.
+COMPRESS_THRESHOLD = 512
 
 class Global:
     '''Stores globals. There should be no instances of Global.'''
@@ -84,14 +115,10 @@ class Global:
     # A Pyre object used to listen into local traffic
     pyre = None
 
-    # A socket to the bridge server
+    # A socket to the bridge server, and the BridgeConnection that
+    # reads and writes it.
     bridgesocket = None
-
-    # Lock objects for interacting with the bridgesocket.
-    # Not currently needed, but if performance is an issue,
-    # the code could be upgraded to multithread.
-    readlock = threading.Lock()
-    writelock = threading.Lock()
+    bridge = None
 
     # Dict of local channel name -> count of clients on channel.
     # When count goes to 0, the bridge client can leave channel
@@ -110,6 +137,121 @@ class Global:
 
 # end class Globals
 
+class BridgeConnection(object):
+    '''Buffered reading and writing of messages on the socket to the bridge server, in the wire format agreed with it.'''
+
+    def __init__(self, sock, bufsize=65536, compress_threshold=COMPRESS_THRESHOLD):
+        self.sock = sock
+        self.version = bridge_server.LEGACY
+        # Received bytes are in buf[start:end].
+        self._buf = bytearray(bufsize)
+        self._start = 0
+        self._end = 0
+        self._handshaking = False
+        # Smallest message to compress, or None to never compress, and
+        # counts of messages sent compressed and the bytes that saved.
+        self.compress_threshold = compress_threshold
+        self.compressed = 0
+        self.saved = 0
+        # Tells the server's answer to our HELLO from other clients'
+        # HELLOs, which old servers forward.
+        self._nonce = uuid.uuid4().hex
+        # Not currently needed, but if performance is an issue, the
+        # code could be upgraded to multithread.
+        self._writelock = threading.Lock()
+
+    def handshake(self, timeout):
+        '''Ask the server for the newest wire format, and wait up to timeout seconds for its answer. Older servers don't answer, and the connection stays LEGACY. Returns the other messages received in the meantime, as for recv().'''
+        self._handshaking = True
+        self.send(['HELLO', bridge_server.PROTOCOL_VERSION, self._nonce], Transport.PRIORITY_CONTROL)
+        received = []
+        deadline = time.time() + timeout
+        try:
+            while self._handshaking and time.time() < deadline:
+                self.sock.settimeout(max(deadline - time.time(), 0.001))
+                received.extend(self.recv())
+        except socket.timeout:
+            pass
+        finally:
+            self.sock.settimeout(None)
+            self._handshaking = False
+        return received
+
+    def recv(self):
+        '''Read whatever the server has sent. Returns a list of (message, priority), one for each message completed, which may be empty. Raises EOFError if the server has closed the connection, and ValueError if it sent something that isn't a message.'''
+        if self._start == self._end:
+            self._start = self._end = 0
+        elif self._end == len(self._buf):
+            if self._start > 0:
+                # Move the partial frame to the front.
+                n = self._end - self._start
+                self._buf[:n] = self._buf[self._start:self._end]
+                self._start, self._end = 0, n
+            else:
+                # It doesn't fit at all.
+                self._buf.extend(bytearray(len(self._buf)))
+        n = self.sock.recv_into(memoryview(self._buf)[self._end:])
+        if n == 0:
+            raise EOFError('Bridge server closed the connection')
+        self._end += n
+        messages = []
+        while True:
+            found = bridge_server.next_frame(self._buf, self._start, self._end, self.version)
+            if found is None:
+                break
+            start, end, priority, compressed = found
+            self._start = end
+            data = bytes(self._buf[start:end])
+            if compressed:
+                data = bridge_server.decompress(data)
+            message = json.loads(data.decode('utf-8'))
+            if not isinstance(message, list) or not message:
+                raise ValueError('Not a bridge message: %r'%(message,))
+            if message[0] == 'HELLO':
+                # The server's answer to handshake(), if it has our
+                # nonce. Everything after it is in the agreed format.
+                # (Old servers forward other clients' HELLOs, which are
+                # ignored.)
+                if self._handshaking and message[2:3] == [self._nonce]:
+                    self.version = message[1]
+                    self._handshaking = False
+                continue
+            messages.append((message, priority))
+        return messages
+
+    def send(self, message, priority=Transport.PRIORITY_NORMAL):
+        '''Send message to the server.'''
+        self.send_all([(message, priority)])
+
+    def send_all(self, messages):
+        '''Send a list of (message, priority) to the server, in as few system calls as possible.'''
+        parts = []
+        compress = self.version >= bridge_server.COMPRESSED and self.compress_threshold is not None
+        for message, priority in messages:
+            body = json.dumps(message).encode('utf-8')
+            compressed = False
+            if compress and len(body) >= self.compress_threshold:
+                small = zlib.compress(body)
+                if len(small) < len(body):
+                    self.compressed += 1
+                    self.saved += len(body) - len(small)
+                    body, compressed = small, True
+            parts.append(bridge_server.frame_header(len(body), self.version, priority, compressed))
+            parts.append(body)
+        with self._writelock:
+            if not hasattr(self.sock, 'sendmsg'):
+                self.sock.sendall(b''.join(parts))
+                return
+            i = 0
+            while i < len(parts):
+                sent = self.sock.sendmsg(parts[i:i + MAX_IOV])
+                while i < len(parts) and sent >= len(parts[i]):
+                    sent -= len(parts[i])
+                    i += 1
+                if sent:
+                    parts[i] = memoryview(parts[i])[sent:]
+# end class BridgeConnection
+
 def main(argv):
 
     #if six.PY3:
@@ -125,6 +267,13 @@ def main(argv):
     # Create the bridge socket
     Global.bridgesocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     Global.bridgesocket.connect((Global.args.host, Global.args.port))
+    Global.bridge = BridgeConnection(Global.bridgesocket, compress_threshold=Global.args.compress_threshold or None)
+    try:
+        received = Global.bridge.handshake(Global.args.handshake_timeout)
+    except (EOFError, ValueError) as e:
+        logging.warning('Bridge server connection failed (%s). Exiting.'%(e))
+        client_quit()
+    logging.info('Bridge server wire format version %d'%(Global.bridge.version))
 
     # Create a pyre instance
     Global.pyre = Pyre()
@@ -140,6 +289,9 @@ def main(argv):
 
     logging.warning('Starting bridge client to server at %s:%d'%(Global.args.host, Global.args.port))
 
+    for rec, priority in received:
+        remote_message(rec, priority)
+
     while True:
         items = dict(poller.poll())
         logging.debug('Got items =%s'%(items))
@@ -157,32 +309,20 @@ def main(argv):
                 print('Unrecognized command %s'%(message))
 
         if Global.bridgesocket.fileno() in items:
-            # Got a message from the remote.
-            rec = server_recv()
-            logging.debug('Got remote data %s'%(rec))
-            if rec[0] == 'JOIN':
-                channel = rec[1]
-                # If we don't already have a proxy object, create one.
-                if channel not in Global.proxies:
-                    t = Transport.Transport(channel)
-                    Global.pyre.join(channel)
-                    Global.proxies[channel] = t
-                    Global.proxy_uuids[t._pyre.uuid()] = t
-                    logging.info('Creating bridge proxy %s'%(channel))
-            elif rec[0] == 'LEAVE':
-                # Don't actually know how to handle this.
-                pass
-            elif rec[0] == 'SHOUT':
-                # Use the proxy object to relay the message.
-                name = rec[1]
-                channel = rec[2]
-                message = rec[3]
-                if Global.localchannelcount.get(channel, 0) > 0:
-                    logging.debug('Bridge proxy shout %s %s %s'%(name, channel, message))
-                    Global.proxies[name].send(channel, message)
-            else:
-                logging.warning('Unexpected msg %s from client.'%(rec))
-            
+            # Got messages from the remote.
+            try:
+                received = Global.bridge.recv()
+            except EOFError:
+                logging.warning('Bridge server closed the connection. Exiting.')
+                client_quit()
+            except ValueError as e:
+                # A truncated or corrupt frame. There's no telling where
+                # the next one starts, so give up on the connection.
+                logging.warning('Bad data from the bridge server (%s). Exiting.'%(e))
+                client_quit()
+            for rec, priority in received:
+                remote_message(rec, priority)
+
         if Global.pyre.socket() in items:
             # Got a message on Pyre.
             event = Global.pyre.recv()
@@ -201,7 +341,7 @@ def main(argv):
                 if Global.localchannelcount.get(channel,0) == 0:
                     Global.pyre.join(channel)
                     Global.localchannelcount[channel] = 0
-                    server_send(['JOIN', channel])
+                    Global.bridge.send(['JOIN', channel], Transport.PRIORITY_CONTROL)
                     logging.debug('Bridge client joining local channel %s'%(channel))
                 Global.localchannelcount[channel] += 1
             elif eventtype == 'LEAVE':
@@ -209,60 +349,79 @@ def main(argv):
                 Global.localchannelcount[channel] -= 1
                 if Global.localchannelcount[channel] == 0:
                     Global.pyre.leave(channel)
-                    server_send(['LEAVE', channel])
+                    Global.bridge.send(['LEAVE', channel], Transport.PRIORITY_CONTROL)
                     logging.debug('Bridge client leaving channel %s'%(channel))
             elif eventtype == 'SHOUT':
                 channel = event[3].decode('utf-8')
                 
                 # Quit if federation QUIT message received.
-                if event[4] == u'QUIT':
+                if event[4] == b'QUIT':
                     logging.warning('Bridge client received a local QUIT message. Exiting.')
                     client_quit()
                 # Since the server communicates with json, we
-                # need to un-json the message (which server_send
-                # will re-json). There's probably a more elegant way
-                # to do this.
-                if six.PY3:
-                    decoded = event[4].decode('utf-8')
-                    server_send(['SHOUT', name, channel, decoded])
-                else:
-                    message = json.loads(event[4].decode('utf-8'))
-                    server_send(['SHOUT', name, channel, message])
+                # need to decode the message (which send_all()
+                # will re-json). Local Transports may have used any
+                # of the codecs in transport_codecs.
+                Global.bridge.send_all([([kind, name, channel, message], priority)
+                                        for kind, message, priority in local_messages(event[4])])
 # end main()
 
-# server_send and server_recv taken almost directly from
-# https://github.com/mdebbar/jsonsocket
-#
-# The complexity is to handle framing -- send/receive over sockets
-# isn't atomic. See top of this file for comments.
-
-def server_send(msg):
-    serialized = json.dumps(msg)
-    with Global.writelock:
-        Global.bridgesocket.send(six.b('%d\n'%(len(serialized))))
-        Global.bridgesocket.sendall(six.b(serialized))
-
-def server_recv():
-    length_str = ''
-    next_offset = 0
-    with Global.readlock:
-        # Get the length
-        char = Global.bridgesocket.recv(1)
-        while char != six.b('\n'):
-            length_str += char.decode('utf-8')
-            char = Global.bridgesocket.recv(1)
-        total = int(length_str)
-
-        # use a memoryview to receive the data chunk by chunk efficiently
-        view = memoryview(bytearray(total))
-        while total - next_offset > 0:
-            recv_size = Global.bridgesocket.recv_into(view[next_offset:], total - next_offset)
-            next_offset += recv_size
-
-    # Convert back to a python object
-    deserialized = json.loads(view.tobytes().decode('utf-8'))
-    return deserialized
-# end server_recv()
+def remote_message(rec, priority):
+    '''Handle a message from the bridge server.'''
+    logging.debug('Got remote data %s'%(rec))
+    if rec[0] == 'JOIN':
+        channel = rec[1]
+        # If we don't already have a proxy object, create one.
+        if channel not in Global.proxies:
+            # Local Transports mustn't WHISPER to the proxy, or
+            # we wouldn't overhear their messages to forward.
+            t = Transport.Transport(channel, whisper=False, proxy=True)
+            Global.pyre.join(channel)
+            Global.proxies[channel] = t
+            Global.proxy_uuids[t._pyre.uuid()] = t
+            logging.info('Creating bridge proxy %s'%(channel))
+    elif rec[0] == 'LEAVE':
+        # Don't actually know how to handle this.
+        pass
+    elif rec[0] == 'SHOUT':
+        # Use the proxy object to relay the message.
+        name = rec[1]
+        channel = rec[2]
+        message = rec[3]
+        if Global.localchannelcount.get(channel, 0) > 0:
+            logging.debug('Bridge proxy shout %s %s %s'%(name, channel, message))
+            Global.proxies[name].send(channel, message, priority)
+    elif rec[0] == 'CONTROL':
+        # A control message, such as a request() or its reply, from
+        # name to a local Transport.
+        name = rec[1]
+        channel = rec[2]
+        if Global.localchannelcount.get(channel, 0) > 0 and name in Global.proxies:
+            logging.debug('Bridge proxy control %s %s %s'%(name, channel, rec[3]))
+            Global.proxies[name]._send_control(channel, rec[3])
+    else:
+        logging.warning('Unexpected msg %s from client.'%(rec))
+# end remote_message()
+
+def local_messages(frame):
+    '''Return (kind, message, priority) for each message in a frame SHOUTed by a local Transport, where kind is 'SHOUT' or 'CONTROL'.'''
+    if transport_codecs.is_batch(frame):
+        return [m for f in transport_codecs.split_batch(frame) for m in local_messages(f)]
+    priority, frame = transport_codecs.split_priority(frame, Transport.PRIORITY_NORMAL)
+    if transport_shm.is_descriptor(frame):
+        logging.debug('Not forwarding a shared memory frame')
+        return []
+    if transport_codecs.is_control(frame):
+        body = transport_codecs.decode(frame[1:])
+        # Older servers send every message to every client, and older
+        # clients don't know what to do with CONTROL messages.
+        if Global.bridge.version < bridge_server.BINARY or 'release' in body:
+            logging.debug('Not forwarding control message %s'%(body))
+            return []
+        # Reliable messages keep their place among normal ones.
+        return [('CONTROL', body, Transport.PRIORITY_NORMAL if 'rel' in body else Transport.PRIORITY_CONTROL)]
+    return [('SHOUT', transport_codecs.decode(frame), priority)]
+# end local_messages()
 
 def client_quit():
     '''Quit the bridge_client without throwing any errors.'''
@@ -292,6 +451,8 @@ def parse_arguments(strs):
                         choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
                         default='WARNING',
                         help='Logging level (default %(default)s)')
+    parser.add_argument('-compress_threshold', type=int, default=COMPRESS_THRESHOLD, help='Compress messages of at least this many bytes on the bridge link, if the server supports it. Use 0 to never compress. Defaults to %(default)s.')
+    parser.add_argument('-handshake_timeout', type=float, default=2.0, help='Seconds to wait for the server to agree on a wire format before using the legacy one. Defaults to %(default)s.')
     parser.add_argument('-version', '--version', action='version', version=str(VERSION))
     Global.args = parser.parse_args(strs)
 # end parse_arguments()
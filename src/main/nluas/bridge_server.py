@@ -5,145 +5,537 @@
 #
 # Initial Version: Dec 9, 2015 Adam Janin
 #
-# The bridge server simply listens for messages from
-# bridge clients, and then sends the received message
-# to all connected clients.
+# The bridge server listens for messages from bridge clients, and
+# forwards each message to the other clients that need it.
 #
-# It knows nothing about federations, so you should
-# have a separate server for each federation.
+# Bridge clients send a JOIN message when the first Transport on
+# their subnet joins a channel, and a LEAVE message when the last one
+# leaves (see bridge_client.py). The server keeps track of which
+# clients have joined each channel, and forwards a SHOUT (or a CONTROL,
+# which carries a Transport control message such as a request() from
+# one proxied Transport to another) only to the clients that have
+# joined its channel, so each client's traffic
+# scales with what its subnet listens to rather than with everything
+# on the bridge. JOIN and LEAVE messages are forwarded to every other
+# client, so they can create proxies, and a client that connects is
+# sent a JOIN for every channel the other clients have already joined.
 #
+# Messages are forwarded as they were received. The server only
+# looks at the start of each message for its type and channel; the
+# payload of a SHOUT or CONTROL is never decoded.
 #
-# TODO:
+# Each message is JSON text, in one of three wire formats:
+#   LEGACY      the message's length in ASCII digits, a newline, and the
+#               message. Used by older bridge clients and
+#               TransportBridge.cpp.
+#   BINARY      the message's length as 4 big-endian bytes, its priority
+#               as 1 byte, and the message.
+#   COMPRESSED  as BINARY, but if the top bit (ZLIB_FLAG) of the
+#               priority byte is set, the message is compressed with
+#               zlib. Clients compress big messages (see bridge_client's
+#               -compress_threshold), which cuts WAN traffic.
+# Every connection starts out LEGACY. A client that speaks BINARY
+# sends ["HELLO", version, nonce] before anything else, where nonce is
+# a string of its choosing, and waits for the server's ["HELLO",
+# version, nonce] with the newest format they both speak and the same
+# nonce; everything after that, in both directions, is in that format.
+# (Servers older than BINARY forward each client's HELLO to the other
+# clients, so a client only takes a HELLO with its own nonce as the
+# answer.) The server frames each message it forwards in its
+# recipient's format. A compressed message goes as it is to COMPRESSED
+# clients; the server only decompresses as much of it as it needs to
+# route it, plus all of it once for any older clients it goes to.
 #
-# Support python3
+# The server runs on an asyncio event loop, so one slow or busy client
+# doesn't hold up reading from the others. Frames for each client wait
+# in a queue of their own, which is written as fast as the client
+# takes it. A queue holds at most -max_queue_bytes; -overflow says
+# what to do with a client whose queue is full:
+#   disconnect   close the connection (it can reconnect and catch up)
+#   drop_oldest  discard the oldest queued frames of the same priority
+#   reject       discard the new frame
+#   shed         discard queued frames of the lowest priority first,
+#                oldest first, but never any more urgent than the new
+#                frame
+# JOIN and LEAVE messages are CONTROL priority, and are queued even
+# when the queue is full. SHOUTs and CONTROLs have the priority of
+# their BINARY frame, or NORMAL priority if they came LEGACY. The
+# 'stats' command (and -stats_interval) reports each client's queue.
+#
+# It knows nothing about federations, so you should
+# have a separate server for each federation.
 #
-
-from six.moves import input
 
 import argparse
+import asyncio
+import collections
+import json
 import logging
-import select
+import re
 import signal
 import socket
+import struct
 import sys
+import time
+import zlib
 
-VERSION = 0.1
+VERSION = 0.3
 
 # Command line arguments (argparse object). Created in parse_arguments()
 Args = None
 
-# Dictionary of client socket -> address
-ClientSockets = {}
+# The Bridge of connected clients. Created in main().
+Clients = None
+
+# The asyncio server, and a Future that's set to stop it. Global so
+# server_quit() can find them.
+Server = None
+Stop = None
+
+# time.time() of the last connection or message, for -timeout.
+LastActivity = None
+
+# The start of a message: its type, its first string argument (the
+# channel of a JOIN or LEAVE, the sender's name of a SHOUT or CONTROL),
+# and for a SHOUT or CONTROL its second (the channel). Anything else is
+# parsed in full.
+_HEADER = re.compile(br'\s*\[\s*"(JOIN|LEAVE|SHOUT|CONTROL)"\s*,\s*("(?:[^"\\]|\\.)*")(?:\s*,\s*("(?:[^"\\]|\\.)*"))?')
+
+# Wire formats, oldest first. See the top of this file.
+LEGACY, BINARY, COMPRESSED = 1, 2, 3
+PROTOCOL_VERSION = COMPRESSED
+
+# Priority byte bit marking a compressed message (COMPRESSED format),
+# and how much of one to decompress to find its type and channel.
+ZLIB_FLAG = 0x80
+_ROUTE_BYTES = 1024
+
+# Longest allowed LEGACY length prefix, and the header of a BINARY
+# frame.
+_MAX_PREFIX = 20
+_BINARY_HEADER = struct.Struct('>IB')
+
+# Frame priorities, most urgent first. Same as Transport's
+# PRIORITY_CONTROL, PRIORITY_NORMAL and PRIORITY_BULK.
+CONTROL, NORMAL, BULK = range(3)
+
+# -overflow policies. See the top of this file.
+OVERFLOW = ['disconnect', 'drop_oldest', 'reject', 'shed']
+
+# Most bytes handed to a client's socket at a time. The rest stay in
+# its queue, where they can still be dropped.
+WRITE_CHUNK = 65536
+
+class Client(object):
+    '''A connected bridge client and its queue of frames to write.'''
+
+    def __init__(self, reader, writer, max_queue_bytes=None, overflow='shed'):
+        if overflow not in OVERFLOW:
+            raise ValueError('Unknown overflow policy "%s"'%(overflow))
+        self.reader = reader
+        self.writer = writer
+        self.address = writer.get_extra_info('peername')[:2]
+        self.max_queue_bytes = max_queue_bytes
+        self.overflow = overflow
+        # Wire format of the frames this client sends and is sent.
+        self.version = LEGACY
+        # Channels this client has joined.
+        self.channels = set()
+        # A deque of frames per priority, and their total size.
+        self.queue = [collections.deque() for p in (CONTROL, NORMAL, BULK)]
+        self.queued = 0
+        self.ready = asyncio.Event()
+        self.closed = False
+        # Counts for stats().
+        self.sent = 0
+        self.sent_bytes = 0
+        self.dropped = 0
+        self.max_queued = 0
+
+    def send(self, frame, priority=NORMAL):
+        '''Queue frame (bytes, length prefix included) to be written to this client, unless its queue is full (see -overflow).'''
+        if self.closed:
+            return
+        if self.max_queue_bytes is not None and priority != CONTROL and self.queued + len(frame) > self.max_queue_bytes:
+            if self.overflow == 'disconnect':
+                logging.warning('Disconnecting %s: %d bytes queued'%(self, self.queued))
+                self.close()
+                return
+            if self.overflow == 'drop_oldest':
+                self._drop(len(frame), [priority])
+            elif self.overflow == 'shed':
+                self._drop(len(frame), range(BULK, priority - 1, -1))
+            if self.queued + len(frame) > self.max_queue_bytes:
+                self.dropped += 1
+                return
+        self.queue[priority].append(frame)
+        self.queued += len(frame)
+        self.max_queued = max(self.max_queued, self.queued)
+        self.ready.set()
+
+    def hello(self, version, nonce=None):
+        '''Answer the client's HELLO (echoing its nonce, if any) with the newest wire format we both speak, and use it from now on.'''
+        if self.version == LEGACY:
+            version = max(LEGACY, min(version, PROTOCOL_VERSION))
+            answer = ['HELLO', version] if nonce is None else ['HELLO', version, nonce]
+            self.send(encode_frame(json.dumps(answer).encode('utf-8')), CONTROL)
+            self.version = version
+
+    async def write(self):
+        '''Write queued frames, most urgent first, as fast as the client reads them.'''
+        try:
+            while not self.closed:
+                if not self.queued:
+                    self.ready.clear()
+                    await self.ready.wait()
+                    continue
+                frames = self._take(WRITE_CHUNK)
+                self.writer.writelines(frames)
+                await self.writer.drain()
+        except (ConnectionError, OSError):
+            self.close()
+
+    def close(self):
+        '''Stop writing and close the connection. The reader sees end of file.'''
+        if not self.closed:
+            self.closed = True
+            self.ready.set()
+            for lane in self.queue:
+                self.dropped += len(lane)
+                lane.clear()
+            self.queued = 0
+            try:
+                self.writer.close()
+            except Exception:
+                pass  # silently ignore problems closing a client.
+
+    def stats(self):
+        '''Return a dict of this client's queue and counts.'''
+        return {'version': self.version, 'queued': sum(len(lane) for lane in self.queue), 'queued_bytes': self.queued,
+                'max_queued_bytes': self.max_queued, 'sent': self.sent, 'sent_bytes': self.sent_bytes,
+                'dropped': self.dropped, 'channels': len(self.channels)}
+
+    def _take(self, size):
+        # Remove and return frames, most urgent first, totalling at
+        # least one frame and at most about size bytes.
+        frames = []
+        taken = 0
+        for lane in self.queue:
+            while lane and (not frames or taken + len(lane[0]) <= size):
+                frame = lane.popleft()
+                frames.append(frame)
+                taken += len(frame)
+        self.queued -= taken
+        self.sent += len(frames)
+        self.sent_bytes += taken
+        return frames
+
+    def _drop(self, needed, priorities):
+        # Drop the oldest frames of each of priorities in turn until
+        # there's room for needed more bytes.
+        for priority in priorities:
+            lane = self.queue[priority]
+            while lane and self.queued + needed > self.max_queue_bytes:
+                self.queued -= len(lane.popleft())
+                self.dropped += 1
+
+    def __str__(self):
+        return '%s:%d'%self.address
+# class Client
+
+class Bridge(object):
+    '''The connected clients, and the channels each has joined.'''
+
+    def __init__(self):
+        self.clients = set()
+        # Dict of channel -> set of the Clients that joined it.
+        self.channels = {}
+
+    def connect(self, client):
+        '''Add client. Returns the frames to send it first: a JOIN for each channel other clients have joined.'''
+        self.clients.add(client)
+        return [encode_frame(json.dumps(['JOIN', channel]).encode('utf-8'), client.version, CONTROL) for channel in sorted(self.channels)]
+
+    def disconnect(self, client):
+        '''Remove client and its channels.'''
+        self.clients.discard(client)
+        for channel in client.channels:
+            self._leave(client, channel)
+        client.channels = set()
+
+    def route(self, client, frame, start, priority=NORMAL):
+        '''Return the clients that frame from client, whose message starts at offset start, should be forwarded to, and its priority.'''
+        kind, channel = parse_header(frame, start)
+        if kind in ('SHOUT', 'CONTROL'):
+            return [c for c in self.channels.get(channel, ()) if c is not client], priority
+        if kind == 'HELLO':
+            # Rare enough to parse in full for the nonce.
+            message = json.loads(frame[start:].decode('utf-8'))
+            client.hello(channel, message[2] if len(message) > 2 else None)
+            return [], CONTROL
+        if kind == 'JOIN':
+            client.channels.add(channel)
+            self.channels.setdefault(channel, set()).add(client)
+        elif kind == 'LEAVE':
+            if channel in client.channels:
+                client.channels.discard(channel)
+                self._leave(client, channel)
+        else:
+            logging.warning('Ignoring unexpected message from %s'%(client))
+            return [], NORMAL
+        return [c for c in self.clients if c is not client], CONTROL
+
+    def stats(self):
+        '''Return a dict of client address => Client.stats(), plus the number of channels.'''
+        return {'channels': len(self.channels), 'clients': dict((str(c), c.stats()) for c in self.clients)}
+
+    def _leave(self, client, channel):
+        members = self.channels.get(channel)
+        if members is not None:
+            members.discard(client)
+            if not members:
+                del self.channels[channel]
+# class Bridge
+
+def frame_header(length, version=LEGACY, priority=NORMAL, compressed=False):
+    '''Return the bytes that go before a message of length bytes in the given wire format. compressed (COMPRESSED format only) marks the message as compressed.'''
+    if version >= BINARY:
+        return _BINARY_HEADER.pack(length, priority | ZLIB_FLAG if compressed else priority)
+    return b'%d\n'%(length)
+# end frame_header()
 
-# Global so server_quit() can find it.
-ServerSocket = None
+def encode_frame(message, version=LEGACY, priority=NORMAL, compressed=False):
+    '''Return message (bytes) as a frame in the given wire format.'''
+    return frame_header(len(message), version, priority, compressed) + message
+# end encode_frame()
+
+def next_frame(buf, pos=0, limit=None, version=LEGACY):
+    '''Find the frame at offset pos of buf (up to offset limit, if given). Returns (start, end, priority, compressed): the offsets of its message and of the end of the frame, its priority (NORMAL if it's LEGACY), and whether the message is compressed. Returns None if the whole frame isn't there yet, and raises ValueError if buf doesn't have a frame at pos.'''
+    if limit is None:
+        limit = len(buf)
+    compressed = False
+    if version >= BINARY:
+        if limit - pos < _BINARY_HEADER.size:
+            return None
+        length, priority = _BINARY_HEADER.unpack_from(buf, pos)
+        if version >= COMPRESSED and priority & ZLIB_FLAG:
+            compressed = True
+            priority &= ~ZLIB_FLAG
+        if priority > BULK:
+            raise ValueError('Bad priority %d'%(priority))
+        start = pos + _BINARY_HEADER.size
+    else:
+        newline = buf.find(b'\n', pos, min(limit, pos + _MAX_PREFIX + 1))
+        if newline < 0:
+            if limit - pos > _MAX_PREFIX:
+                raise ValueError('Bad length prefix %r'%(bytes(buf[pos:pos + _MAX_PREFIX])))
+            return None
+        length = int(buf[pos:newline])
+        if length < 0:
+            raise ValueError('Bad length prefix %r'%(bytes(buf[pos:newline])))
+        start = newline + 1
+        priority = NORMAL
+    if start + length > limit:
+        return None
+    return start, start + length, priority, compressed
+# end next_frame()
+
+def decompress(message, max_length=0):
+    '''Return compressed message decompressed (only its first max_length bytes, if max_length isn't 0). Raises ValueError if it's corrupt.'''
+    try:
+        return zlib.decompressobj().decompress(message, max_length)
+    except zlib.error as e:
+        raise ValueError('Bad compressed message: %s'%(e))
+# end decompress()
+
+def parse_header(frame, start=0):
+    '''Return the type and channel of the message at offset start of frame (or for a HELLO, its version), or (None, None) if it's not a JOIN, LEAVE, SHOUT, CONTROL or HELLO.'''
+    m = _HEADER.match(frame, start)
+    try:
+        if m is not None:
+            kind = m.group(1).decode('ascii')
+            if kind in ('SHOUT', 'CONTROL'):
+                if m.group(3) is not None:
+                    return kind, json.loads(m.group(3).decode('utf-8'))
+            else:
+                return kind, json.loads(m.group(2).decode('utf-8'))
+        # Not in the expected layout. Parse all of it.
+        message = json.loads(frame[start:].decode('utf-8'))
+        if message[0] in ('SHOUT', 'CONTROL'):
+            return message[0], message[2]
+        if message[0] in ('JOIN', 'LEAVE'):
+            return message[0], message[1]
+        if message[0] == 'HELLO':
+            return message[0], int(message[1])
+    except (ValueError, TypeError, IndexError, KeyError):
+        pass
+    return None, None
+# end parse_header()
 
 def main(argv):
 
-    global ClientSockets, ServerSocket, Args
+    global Clients, Server, Stop, LastActivity
 
     parse_arguments(argv[1:])
     setup_logging()
 
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    Clients = Bridge()
+    Stop = loop.create_future()
+    LastActivity = time.time()
+
     # If the user presses ctrl-C, exit cleanly.
-    signal.signal(signal.SIGINT, lambda s, f: server_quit())
+    loop.add_signal_handler(signal.SIGINT, server_quit)
 
     # Create the server socket.
-    ServerSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    ServerSocket.bind((Args.host, Args.port))
-    ServerSocket.listen(5)
-    (ignore, port) = ServerSocket.getsockname()
+    Server = loop.run_until_complete(asyncio.start_server(serve_client, Args.host or None, Args.port))
+    port = Server.sockets[0].getsockname()[1]
     if Args.host == '':
         host = socket.getfqdn()
     else:
         host = Args.host
     logging.warning('Server listening on %s:%d'%(host, port))
 
-    # Listen for connections and/or messages from clients
-    while True:
-        sockets = list(ClientSockets.keys())
-        sockets.append(ServerSocket)
-        sockets.append(sys.stdin)
-        # sockets now contain all the current client sockets plus
-        # the server socket plus stdin.
-        if Args.timeout > 0:
-            si,so,se = select.select(sockets, [], [], Args.timeout)
-        else:
-            si,so,se = select.select(sockets, [], [])
+    try:
+        loop.add_reader(sys.stdin, read_command)
+    except (ValueError, OSError):
+        pass  # No usable stdin (e.g. run in the background).
+    if Args.timeout > 0:
+        loop.create_task(watch_timeout())
+    if Args.stats_interval > 0:
+        loop.create_task(log_stats())
+
+    loop.run_until_complete(Stop)
+
+    # Close all clients and the server.
+    for client in list(Clients.clients):
+        client.close()
+    Server.close()
+    loop.run_until_complete(Server.wait_closed())
+    logging.info('Server quitting')
+    sys.exit(0)
+# end main()
 
-        # If si is empty, timeout occurred.
-        if len(si) == 0:
-            logging.warning('Server timed out')
-            server_quit()
-            break
 
-        if sys.stdin in si:
-            # Got something on stdin.
-            command = input()
-            if command == 'quit':
-                server_quit()
+async def serve_client(reader, writer):
+    '''Read messages from one client until it disconnects, forwarding each.'''
+    global LastActivity
+    client = Client(reader, writer, Args.max_queue_bytes, Args.overflow)
+    logging.info('Got connection from %s'%(client))
+    LastActivity = time.time()
+    for frame in Clients.connect(client):
+        client.send(frame, CONTROL)
+    writing = asyncio.ensure_future(client.write())
+    buf = bytearray()
+    try:
+        while True:
+            data = await reader.read(Args.blocksize)
+            if not data:
                 break
-            elif command == 'help':
-                print('\nValid commands are quit and help.\n')
-            else:
-                logging.warning('Unknown command on stdin: "%s"'%(command))
-
-        if ServerSocket in si:
-            # New connection. Add to ClientSockets.
-            (clientsocket, address) = ServerSocket.accept()
-            logging.info("Got connection from %s:%d"%address)
-            ClientSockets[clientsocket] = address
-            continue
-
-        # Now, for each client, check if it's sent a message
-        for client in ClientSockets:
-            if client in si:
-                try:
-                    rec = client.recv(Args.blocksize)
-                except:
-                    rec = None
-                if rec == b'' or rec == 0 or rec == '' or rec is None:
-                    # Client disconnected
-                    logging.info("%s:%d disconnected"%ClientSockets[client])
-                    try:
-                        client.shutdown(socket.SHUT_RDWR)
-                        client.close()
-                    except:
-                        pass  # silently ignore problems closing a cleient.
-                    del ClientSockets[client]
-                    # Since ClientSockets has changed, the "for client"
-                    # iterator must be exited.
+            LastActivity = time.time()
+            buf += data
+            pos = 0
+            while True:
+                # The wire format can change after each frame (see
+                # Client.hello()).
+                found = next_frame(buf, pos, version=client.version)
+                if found is None:
                     break
-                logging.debug('Got data "%s"'%(rec))
-                # Client sent something. Forward to all clients
-                # except the client that sent it.
-                for c in ClientSockets:
-                    if c != client:
-                        logging.debug('Sending data to %s:%d'%ClientSockets[c])
-                        c.sendall(rec)
-        # end for client
-    # end while True
-# end main()
+                start, end, priority, compressed = found
+                frame = bytes(buf[pos:end])
+                logging.debug('Got data "%s"'%(frame))
+                forward(client, frame, start - pos, priority, compressed)
+                pos = end
+            del buf[:pos]
+    except ValueError as e:
+        logging.warning('Dropping %s: %s'%(client, e))
+    except (ConnectionError, OSError):
+        pass
+    finally:
+        # Client disconnected
+        logging.info('%s disconnected'%(client))
+        Clients.disconnect(client)
+        client.close()
+        writing.cancel()
+# end serve_client()
 
 
-def server_quit():
-    '''Close all clients and the server'''
-    global ClientSockets, ServerSocket, Args
+def forward(client, frame, start, priority, compressed=False):
+    '''Send the frame client sent, whose message starts at offset start, to the clients that need it, each in its own wire format. If compressed, the message is compressed, and only COMPRESSED clients are sent it that way.'''
+    if compressed:
+        # Usually the type and channel are in the first few bytes.
+        message = decompress(frame[start:], _ROUTE_BYTES)
+        whole = len(message) < _ROUTE_BYTES
+        if not whole and parse_header(message)[0] is None:
+            message = decompress(frame[start:])
+            whole = True
+        clients, priority = Clients.route(client, message, 0, priority)
+        frames = {COMPRESSED: frame}
+    else:
+        clients, priority = Clients.route(client, frame, start, priority)
+        message, whole = None, False
+        frames = {client.version: frame}
+    for c in clients:
+        logging.debug('Sending data to %s'%(c))
+        f = frames.get(c.version)
+        if f is None:
+            if not whole:
+                message = decompress(frame[start:]) if compressed else frame[start:]
+                whole = True
+            f = frames[c.version] = encode_frame(message, c.version, priority)
+        c.send(f, priority)
+# end forward()
 
-    for c in ClientSockets:
-        c.shutdown(socket.SHUT_RDWR)
-        c.close()
 
-    if ServerSocket is not None:
-        ServerSocket.shutdown(socket.SHUT_RDWR)
-        ServerSocket.close()
-    logging.info('Server quitting')
-    sys.exit(0)
+def read_command():
+    '''Handle a command typed on stdin.'''
+    command = sys.stdin.readline()
+    if command == '':
+        # End of file. Stop listening.
+        asyncio.get_event_loop().remove_reader(sys.stdin)
+        return
+    command = command.strip()
+    if command == 'quit':
+        server_quit()
+    elif command == 'stats':
+        print(json.dumps(Clients.stats(), indent=2, sort_keys=True))
+    elif command == 'help':
+        print('\nValid commands are quit, stats and help.\n')
+    else:
+        logging.warning('Unknown command on stdin: "%s"'%(command))
+# end read_command()
+
+
+async def watch_timeout():
+    '''Quit the server once there's been no activity for -timeout seconds.'''
+    while True:
+        remaining = LastActivity + Args.timeout - time.time()
+        if remaining <= 0:
+            logging.warning('Server timed out')
+            server_quit()
+            return
+        await asyncio.sleep(remaining)
+# end watch_timeout()
+
+
+async def log_stats():
+    '''Log the clients' stats every -stats_interval seconds.'''
+    while True:
+        await asyncio.sleep(Args.stats_interval)
+        logging.info('Stats %s'%(json.dumps(Clients.stats(), sort_keys=True)))
+# end log_stats()
+
+
+def server_quit():
+    '''Stop the server. main() closes all clients and the server.'''
+    if Stop is not None and not Stop.done():
+        Stop.set_result(None)
 # end server_quit()
 
 
 def parse_arguments(strs):
-    parser = argparse.ArgumentParser(description='Start a bridge server that listens for bridge client connections. When a bridge client sends a message to the server, the server echos to all other clients. Version %s.'%(VERSION))
+    parser = argparse.ArgumentParser(description='Start a bridge server that listens for bridge client connections. When a bridge client sends a message to the server, the server forwards it to the other clients that have joined its channel. Version %s.'%(VERSION))
     parser.add_argument('-port', type=int, default=7417, help='Server port to listen on. Use 0 to assign an unused non-root port. Defaults to %(default)s.')
     parser.add_argument('-host', default='', help='Which host IP to listen on. Typical settings are "localhost" if you only want connections from this host, the fully qualified host name, or blank if you want to accept connections sent to any interface the local host uses. Defaults to %(default)s.')
     parser.add_argument('-timeout', type=int, default=0, help='If the server has no activity after this amount of time, it automatically exits. Use 0 to never exit. Default is %(default)s.')
@@ -152,7 +544,10 @@ def parse_arguments(strs):
                         default='INFO',
                         help='Logging level (default %(default)s)')
     parser.add_argument('-version', '--version', action='version', version=str(VERSION))
-    parser.add_argument('-blocksize', type=int, default=1024, help='Read at most this many bytes when a socket has data available. Only useful for debugging. Default is %(default)s.')
+    parser.add_argument('-max_queue_bytes', type=int, default=16 * 1024 * 1024, help='Most bytes to queue for a client that isn\'t keeping up. Default is %(default)s.')
+    parser.add_argument('-overflow', choices=OVERFLOW, default='shed', help='What to do when a client\'s queue is full (see the top of bridge_server.py). Default is %(default)s.')
+    parser.add_argument('-stats_interval', type=float, default=0, help='Log each client\'s queue and counts this often, in seconds. Use 0 to never log them. Default is %(default)s.')
+    parser.add_argument('-blocksize', type=int, default=65536, help='Read at most this many bytes when a socket has data available. Only useful for debugging. Default is %(default)s.')
     global Args
     Args = parser.parse_args(strs)
 # end parse_arguments()
@@ -161,7 +556,7 @@ def parse_arguments(strs):
 def setup_logging():
     numeric_level = getattr(logging, Args.loglevel, None)
     if not isinstance(numeric_level, int):
-        raise ValueError('Invalid log level: %s' % loglevel)
+        raise ValueError('Invalid log level: %s' % Args.loglevel)
     logging.basicConfig(level=numeric_level, format="%(module)s:%(levelname)s: %(message)s")
 # end setup_logging()
 
@@ -87,10 +87,12 @@ class CoreAgent(object):
     def close(self, quit_federation=False):
         if not self._broadcasted:
             self._broadcasted = True
-            self.transport.broadcast({"text": "QUIT", "type": "QUIT"}) # application-level quit
+            self.transport.broadcast({"text": "QUIT", "type": "QUIT"}, priority=PRIORITY_CONTROL) # application-level quit
 
         if quit_federation:
-            time.sleep(0.5)
+            # Make sure the application-level quit is out before the
+            # transport shuts everyone down.
+            self.transport.sync(timeout=0.5)
             self.transport.quit_federation() # transport-level quit
 
         self._keep_alive = False
@@ -15,6 +15,8 @@ except:
     from xmlrpc.client import ServerProxy, Fault
 
 from nluas.feature import StructJSONEncoder, as_featurestruct
+from nluas.language.instrumentation import instrumentation
+import json
 import os
 
 class Analyzer(object):
@@ -32,14 +34,17 @@ class Analyzer(object):
         return [as_featurestruct(r, s) for r, s in parse]
 
     def full_parse(self, sentence):
-        total = self.analyzer.parse(sentence)
-        parse = [as_featurestruct(r, s) for r, s in total['parse']]
+        with instrumentation.timer("analyzer_rpc"):
+            total = self.analyzer.parse(sentence)
+        with instrumentation.timer("as_featurestruct"):
+            parse = [as_featurestruct(r, s) for r, s in total['parse']]
         spans = total['spans']
         return {'spans': spans, 'parse': parse, 'original': total['parse'], 'costs':total['costs']}
 
     def issubtype(self, typesystem, child, parent):
         try:
-          return self.analyzer.issubtype(typesystem, child, parent)
+          with instrumentation.timer("issubtype"):
+            return self.analyzer.issubtype(typesystem, child, parent)
         except Exception as e:
           print(e)
           return False
@@ -55,3 +60,54 @@ class Analyzer(object):
 
     def get_utterances(self):
         return self.analyzer.get_utterances()
+
+
+class _RecordingProxy(object):
+    """Wraps an XML-RPC ServerProxy and remembers the result of every call, keyed by
+    method name and JSON-encoded arguments. Used by RecordingAnalyzer. """
+    def __init__(self, proxy):
+        self.proxy = proxy
+        self.calls = dict()
+
+    def __getattr__(self, method):
+        remote = getattr(self.proxy, method)
+        def call(*args):
+            result = remote(*args)
+            self.calls.setdefault(method, dict())[json.dumps(args)] = result
+            return result
+        return call
+
+
+class _ReplayProxy(object):
+    """Serves results recorded by a _RecordingProxy, without contacting an analyzer. """
+    def __init__(self, calls):
+        self.calls = calls
+
+    def __getattr__(self, method):
+        recorded = self.calls.get(method, dict())
+        def call(*args):
+            key = json.dumps(args)
+            if key not in recorded:
+                raise Fault(1, "No recorded result for {}{}".format(method, args))
+            return recorded[key]
+        return call
+
+
+class RecordingAnalyzer(Analyzer):
+    """An Analyzer that records every response from the server, so that they can be
+    replayed later by a ReplayAnalyzer (e.g. for benchmarks). """
+    def __init__(self, url):
+        Analyzer.__init__(self, url)
+        self.analyzer = _RecordingProxy(self.analyzer)
+
+    def save(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.analyzer.calls, f)
+
+
+class ReplayAnalyzer(Analyzer):
+    """An Analyzer that answers from a fixture file written by RecordingAnalyzer.save().
+    Raises a Fault for any call that was not recorded. """
+    def __init__(self, filename):
+        with open(filename, "r") as f:
+            self.analyzer = _ReplayProxy(json.load(f))
@@ -32,8 +32,10 @@ See LICENSE.txt for licensing information.
 
 from nluas.language.specializer_utils import *
 from nluas.language.analyzer_proxy import *
+from nluas.language.instrumentation import instrumentation
 from nluas.utils import *
 from collections import OrderedDict
+import hashlib
 import json
 import os
 import pprint
@@ -52,6 +54,7 @@ class CoreSpecializer(UtilitySpecializer):
         self.initialize_templates()
 
         self.protagonist = None
+        self._previous_protagonist = None
 
         self.negated = {'yes': True,
                         'no': False,
@@ -95,11 +98,45 @@ class CoreSpecializer(UtilitySpecializer):
 
     def initialize_templates(self):
         """ Initializes templates from path, set above. """
+        self.template_files = [path + name for name in ["parameter_templates.json", "mood_templates.json",
+                                                        "descriptors.json", "event_templates.json"]]
         self.parameter_templates = self.read_templates(path+"parameter_templates.json")
         self.mood_templates = self.read_templates(path+"mood_templates.json")
         self.descriptor_templates = self.read_templates(path+"descriptors.json")
         self.event_templates = self.read_templates(path + "event_templates.json")
 
+    def version(self):
+        """ Returns a digest of the templates and ontology mappings. It changes whenever they do, so that
+        n-tuples produced with older templates can be told apart. """
+        digest = hashlib.sha1()
+        for filename in self.template_files:
+            with open(filename, "rb") as f:
+                digest.update(f.read())
+        digest.update(json.dumps(sorted(self.mappings.items())).encode("utf-8"))
+        return digest.hexdigest()
+
+    def start_context(self):
+        UtilitySpecializer.start_context(self)
+        self._previous_protagonist = self.protagonist
+
+    def context_effects(self):
+        effects = UtilitySpecializer.context_effects(self)
+        if self.protagonist is not self._previous_protagonist:
+            effects['protagonist'] = self.protagonist
+        return effects
+
+    def replay_context(self, effects):
+        UtilitySpecializer.replay_context(self, effects)
+        if 'protagonist' in effects:
+            self.protagonist = effects['protagonist']
+
+    def uses_previous_protagonist(self):
+        """ True if the protagonist was carried over from an earlier utterance (which makes this one context-dependent). """
+        if self.protagonist is not None and self.protagonist is self._previous_protagonist:
+            self._context_used = True
+            return True
+        return False
+
     def read_templates(self, filename):
         """ Sets each template to ordered dict."""
         base = OrderedDict()
@@ -169,7 +206,8 @@ class CoreSpecializer(UtilitySpecializer):
                     ntuple['return_type'], ntuple['eventDescriptor']['eventProcess']['specificWh'] = self.get_return_type(parameters)
 
         if ntuple:
-            ntuple = self.map_ontologies(ntuple)
+            with instrumentation.timer("map_ontologies"):
+                ntuple = self.map_ontologies(ntuple)
 
             if self.debug_mode:
                 pprint.pprint(ntuple)
@@ -358,6 +396,7 @@ class CoreSpecializer(UtilitySpecializer):
 
     def check_compatibility(self, predication):
         """ Checks that a protagonist is compatible with some predication, e.g. "the weight of the box is 2 pounds / red*". """
+        self.uses_previous_protagonist()
         if self.protagonist and "property" in self.protagonist['objectDescriptor']:
             prop1, prop2  = predication['property'], self.protagonist['objectDescriptor']['property']['objectDescriptor']['type']
             if not self.is_compatible('ONTOLOGY', prop1, prop2):
@@ -478,6 +517,7 @@ class CoreSpecializer(UtilitySpecializer):
                         returned.update(filler)
                         if "property" in filler:
                             if self.protagonist is not None:
+                                self.uses_previous_protagonist()
                                 if not "type" in self.protagonist["objectDescriptor"]:
                                     self.protagonist["objectDescriptor"].update(
                                         filler["property"]["objectDescriptor"])
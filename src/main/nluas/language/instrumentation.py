@@ -0,0 +1,169 @@
+"""
+Opt-in timers and counters for the language pipeline (word checking, parsing,
+specializing, ...). Instrumentation is off by default; when it is off, timer()
+returns a shared no-op context manager, so instrumented code pays for a single
+attribute check.
+
+Usage:
+    from nluas.language.instrumentation import instrumentation
+    instrumentation.enable()
+    with instrumentation.timer("specialize"):
+        ...
+    instrumentation.dump()
+
+Timings are aggregated into per-stage histograms. A caller can also collect the
+timings of a single sentence with begin()/end(); the UserAgent attaches these to
+the n-tuple's "metadata" field.
+
+------
+See LICENSE.txt for licensing information.
+------
+"""
+
+from collections import OrderedDict
+import threading
+import time
+import sys
+
+# Upper bounds (in ms) of the histogram buckets. The last bucket is unbounded.
+BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+
+class _NullTimer(object):
+    """ Returned by Instrumentation.timer() when instrumentation is disabled. """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer(object):
+    def __init__(self, instrumentation, stage):
+        self.instrumentation = instrumentation
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.instrumentation.record(self.stage, (time.perf_counter() - self.start) * 1000)
+        return False
+
+
+class Histogram(object):
+    """ Aggregate timings (in ms) for one stage. """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, ms):
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+        for i, bound in enumerate(BUCKETS):
+            if ms <= bound:
+                self.buckets[i] += 1
+                return
+        self.buckets[-1] += 1
+
+    def percentile(self, p):
+        """ Upper bound of the bucket holding the p-th percentile, capped at the largest timing seen. """
+        target, seen = p / 100.0 * self.count, 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= target:
+                return min(BUCKETS[i], self.max) if i < len(BUCKETS) else self.max
+        return self.max
+
+    def as_dict(self):
+        return OrderedDict([('count', self.count),
+                            ('total_ms', self.total),
+                            ('mean_ms', self.total / self.count if self.count else 0.0),
+                            ('p50_ms', self.percentile(50)),
+                            ('p99_ms', self.percentile(99)),
+                            ('max_ms', self.max),
+                            ('buckets', OrderedDict(zip([str(b) for b in BUCKETS] + ["inf"], self.buckets)))])
+
+
+class Instrumentation(object):
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def reset(self):
+        """ Clears all histograms and counters. """
+        with self._lock:
+            self.histograms = OrderedDict()
+            self.counters = OrderedDict()
+
+    def timer(self, stage):
+        """ Returns a context manager timing the enclosed block as STAGE. """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, stage)
+
+    def record(self, stage, ms):
+        """ Adds a timing (in ms) to STAGE's histogram, and to the current sentence, if any. """
+        with self._lock:
+            if stage not in self.histograms:
+                self.histograms[stage] = Histogram()
+            self.histograms[stage].add(ms)
+        current = getattr(self._local, "current", None)
+        if current is not None:
+            current['timings'][stage] = current['timings'].get(stage, 0.0) + ms
+            current['counts'][stage] = current['counts'].get(stage, 0) + 1
+
+    def count(self, name, n=1):
+        """ Increments counter NAME. """
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def begin(self):
+        """ Starts collecting the timings of a single sentence in this thread, and returns the (empty) record. """
+        if self.enabled:
+            self._local.current = {'timings': OrderedDict(), 'counts': OrderedDict()}
+            return self._local.current
+
+    def resume(self, current):
+        """ Continues collecting into a record returned by begin(), e.g. in another thread. """
+        self._local.current = current
+
+    def end(self):
+        """ Returns the timings collected since begin() (or None if disabled). """
+        current = getattr(self._local, "current", None)
+        self._local.current = None
+        return current
+
+    def summary(self):
+        """ Returns histograms and counters as a (JSON-serializable) dict. """
+        with self._lock:
+            return {'stages': OrderedDict((k, v.as_dict()) for k, v in self.histograms.items()),
+                    'counters': OrderedDict(self.counters)}
+
+    def dump(self, stream=sys.stdout):
+        """ Prints a table of the per-stage histograms and the counters to STREAM. """
+        summary = self.summary()
+        stream.write("{:<18} {:>8} {:>11} {:>9} {:>9} {:>9}\n".format("stage", "count", "total ms", "mean ms", "p99 ms", "max ms"))
+        for stage, h in summary['stages'].items():
+            stream.write("{:<18} {:>8} {:>11.2f} {:>9.3f} {:>9.3f} {:>9.3f}\n".format(
+                         stage, h['count'], h['total_ms'], h['mean_ms'], h['p99_ms'], h['max_ms']))
+        for name, n in summary['counters'].items():
+            stream.write("{:<18} {:>8}\n".format(name, n))
+        stream.flush()
+
+
+# The instance used throughout the language pipeline.
+instrumentation = Instrumentation()
@@ -0,0 +1,222 @@
+"""
+A bounded cache from (word-checked) utterances to the n-tuples they specialize to.
+Used by the UserAgent to skip the analyzer and specializer for utterances it has
+already seen.
+
+Each entry also keeps the utterance's effects on the specializer's discourse
+context (see UtilitySpecializer.context_effects), so that a cache hit leaves the
+discourse stack exactly as a full specialization would have. Utterances whose
+specialization read the discourse context (e.g. resolving "it") are never cached.
+
+The cache is labelled with the grammar/template version it was created for (see
+CoreSpecializer.version). The version is fixed at startup: nothing reloads the
+templates or grammar while an agent runs, so a cache lives and dies with it.
+
+TemplateCache extends this to utterances that differ only in numbers or named
+entities ("move to location 3 4" / "move to location 7 1"): it remembers where
+each such value ended up in the n-tuple, and fills in the new values. Named
+entities are recognized by form (identifiers with a digit, such as "robot2" or
+"box_1a") or because they are known names (e.g. the keys of the specializer's
+ontology mappings); other words are always matched literally.
+
+------
+See LICENSE.txt for licensing information.
+------
+"""
+
+from collections import OrderedDict, namedtuple
+import copy
+import re
+import threading
+
+# Placeholders for the canonicalized slots of an utterance.
+NUMBER = "<NUM>"
+NAME = "<NAME>"
+
+# Numbers ("3", "2.5"), identifier-like names ("robot2", "box_1a", "r2-d2"), and
+# other words, which are only slots if they are known names.
+_SLOT = re.compile(r"\b(?:(\d+(?:\.\d+)?)|([A-Za-z][\w-]*\d[\w-]*)|([A-Za-z][\w-]*))\b")
+
+
+class NtupleCache(object):
+    def __init__(self, size=1024, version=None):
+        self.size = size
+        self.version = version
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits, self.misses, self.uncacheable = 0, 0, 0
+
+    def normalize(self, sentence):
+        """ Returns the key for SENTENCE: whitespace is collapsed, case and punctuation are kept,
+        since both can change the parse. """
+        return " ".join(sentence.split())
+
+    def get(self, sentence):
+        """ Returns a copy of the (ntuple, context effects) pair stored for SENTENCE, or None. """
+        if self.size <= 0:
+            return None
+        key = self.normalize(sentence)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return copy.deepcopy(entry)
+
+    def put(self, sentence, ntuple, effects):
+        """ Stores a copy of NTUPLE and its context EFFECTS for SENTENCE, evicting the least recently used entry if full. """
+        if self.size <= 0:
+            return
+        # Copied together, so that descriptors shared between the n-tuple and the
+        # discourse stack stay shared.
+        entry = copy.deepcopy((ntuple, effects))
+        key = self.normalize(sentence)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def reject(self):
+        """ Records that an utterance could not be cached because it depended on context. """
+        with self._lock:
+            self.uncacheable += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'size': self.size, 'hits': self.hits,
+                    'misses': self.misses, 'uncacheable': self.uncacheable}
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def canonicalize(sentence, names=()):
+    """ Replaces numbers and names in SENTENCE with placeholders. Names are identifier-like
+    tokens and any word in NAMES. Returns the skeleton and the list of (placeholder, token)
+    slots, in order. """
+    slots = []
+    def replace(match):
+        if match.group(1):
+            slots.append((NUMBER, match.group(1)))
+            return NUMBER
+        token = match.group(2) or match.group(3)
+        if match.group(3) and token not in names:
+            return token
+        slots.append((NAME, token))
+        return NAME
+    return _SLOT.sub(replace, " ".join(sentence.split())), slots
+
+
+# Where a slot's value sits in a cached (ntuple, effects) pair, and how it was written there:
+# "float", "int" or "text" for the token itself, "mapped" for its ontology mapping.
+Slot = namedtuple("Slot", ["kind", "token", "path", "form"])
+
+
+class TemplateCache(NtupleCache):
+    """ Caches n-tuples by the skeleton of their utterance (see canonicalize()). A skeleton is only
+    cached if every slot's value occurs exactly once in the n-tuple; a hit is only used if every
+    new value can stand in for the old one, otherwise get() returns None and the caller should
+    do a full parse.
+
+    mappings are the specializer's ontology mappings. names are words that are slots even though
+    they don't look like identifiers (e.g. the keys of mappings). compatible(kind, old, new), if
+    given, decides whether token NEW may replace OLD (e.g. whether two names belong to the same
+    lexical category). """
+
+    def __init__(self, size=1024, version=None, mappings=None, compatible=None, names=()):
+        NtupleCache.__init__(self, size, version)
+        self.mappings = mappings if mappings is not None else dict()
+        self.compatible = compatible
+        self.names = frozenset(names)
+
+    def normalize(self, sentence):
+        return canonicalize(sentence, self.names)[0]
+
+    def get(self, sentence):
+        """ Returns a copy of the (ntuple, effects) pair for SENTENCE's skeleton, with this sentence's values
+        substituted, or None. """
+        tokens = canonicalize(sentence, self.names)[1]
+        if not tokens:
+            return None
+        cached = NtupleCache.get(self, sentence)
+        if cached is None:
+            return None
+        (ntuple, effects), slots = cached
+        root = [ntuple, effects]
+        for slot, (kind, token) in zip(slots, tokens):
+            value = self.substitute(slot, token)
+            if value is None:
+                return None
+            container = root
+            for step in slot.path[:-1]:
+                container = container[step]
+            container[slot.path[-1]] = value
+        return ntuple, effects
+
+    def substitute(self, slot, token):
+        """ Returns the value token should take at slot's position, or None if the substitution is not type-safe. """
+        if self.compatible is not None and not self.compatible(slot.kind, slot.token, token):
+            return None
+        if slot.kind == NUMBER:
+            if ("." in slot.token) != ("." in token):
+                return None
+            return {'float': float, 'int': int, 'text': str}[slot.form](token)
+        if slot.form == "mapped":
+            return self.mappings.get(token)
+        return token if token not in self.mappings else None
+
+    def put(self, sentence, ntuple, effects):
+        """ Caches ntuple and effects under sentence's skeleton, if each slot's value can be located unambiguously. """
+        tokens = canonicalize(sentence, self.names)[1]
+        if not tokens:
+            return
+        root = [ntuple, effects]
+        slots, taken = [], set()
+        for kind, token in tokens:
+            found = []
+            self._find(root, lambda value: self._form(kind, token, value), [], found, set(), False)
+            if len(found) != 1 or found[0][0] is None or tuple(found[0][0]) in taken:
+                return
+            path, form = found[0]
+            taken.add(tuple(path))
+            slots.append(Slot(kind, token, path, form))
+        NtupleCache.put(self, sentence, (ntuple, effects), slots)
+
+    def _form(self, kind, token, value):
+        """ How value was derived from token, if it was: "float", "int", "text", "mapped" or None. """
+        if isinstance(value, bool):
+            return None
+        if kind == NUMBER:
+            if isinstance(value, (int, float)) and value == float(token):
+                return "float" if isinstance(value, float) else "int"
+            return "text" if value == token else None
+        if value == token:
+            return "text"
+        if token in self.mappings and value == self.mappings[token]:
+            return "mapped"
+        return None
+
+    def _find(self, obj, form, path, found, seen, frozen):
+        """ Appends (path, form) for each value under obj whose form is not None. Containers shared
+        by several paths are visited once; values inside tuples get a path of None. """
+        if isinstance(obj, (dict, list)):
+            if id(obj) in seen:
+                return
+            seen.add(id(obj))
+            items = obj.items() if isinstance(obj, dict) else enumerate(obj)
+            for key, value in items:
+                self._find(value, form, path + [key], found, seen, frozen)
+        elif isinstance(obj, tuple):
+            for index, value in enumerate(obj):
+                self._find(value, form, path + [index], found, seen, True)
+        else:
+            f = form(obj)
+            if f is not None:
+                found.append((None if frozen else path, f))
@@ -0,0 +1,136 @@
+"""
+A staged, multi-threaded pipeline for processing utterances.
+
+Each Stage has its own bounded input queue and pool of worker threads. Jobs are
+numbered when they are submitted; an "ordered" stage (e.g. the specializer, which
+keeps discourse context, or sending the result) sees jobs strictly in that order,
+even if an earlier, parallel stage finished them out of order. A job that fails
+in one stage is carried along (without running the later stages, except those
+created with always=True, which get None as its value) so that the ordered
+stages never wait for it.
+
+Usage:
+    pipeline = Pipeline([Stage("parse", parse, workers=4),
+                         Stage("specialize", specialize, ordered=True),
+                         Stage("send", send, ordered=True)])
+    pipeline.submit("TextAgent", "move to the box")
+
+------
+See LICENSE.txt for licensing information.
+------
+"""
+
+try:
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
+import threading
+
+
+class Job(object):
+    def __init__(self, seq, source, value, context):
+        self.seq = seq
+        self.source = source
+        self.value = value
+        self.context = context
+        self.failed = False
+
+
+class Stage(object):
+    def __init__(self, name, func, workers=1, ordered=False, max_queue=64, always=False):
+        """ func(value, job) takes the job's current value (and the job itself) and returns its new value.
+        If always, func is also called (with value None) for jobs that failed in an earlier stage. """
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.ordered = ordered
+        self.always = always
+        self.queue = queue.Queue(max_queue)
+        self.next = None
+        self._lock = threading.Lock()
+        self._pending = dict()
+        self._expected = 0
+        self._threads = []
+        self._stopped = threading.Event()
+
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self._work, name="{}-{}".format(self.name, i))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def put(self, job):
+        """ Queues job for this stage; blocks while the queue is full, unless the stage is stopped. Ordered
+        stages hold jobs back until all earlier ones arrived. """
+        if not self.ordered:
+            self._offer(job)
+            return
+        with self._lock:
+            self._pending[job.seq] = job
+            while self._expected in self._pending:
+                self._offer(self._pending.pop(self._expected))
+                self._expected += 1
+
+    def stop(self):
+        """ Stops the worker threads without blocking. Queued jobs are dropped. """
+        self._stopped.set()
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+        for t in self._threads:
+            try:
+                self.queue.put_nowait(None)
+            except queue.Full:
+                # The workers see _stopped once they take the next job.
+                break
+
+    def _offer(self, job):
+        # Like queue.put(job), but gives up once the stage is stopped.
+        while not self._stopped.is_set():
+            try:
+                self.queue.put(job, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None or self._stopped.is_set():
+                break
+            if not job.failed or self.always:
+                try:
+                    job.value = self.func(None if job.failed else job.value, job)
+                except Exception as e:
+                    print(e)
+                    job.failed = True
+            if self.next is not None:
+                self.next.put(job)
+
+
+class Pipeline(object):
+    def __init__(self, stages):
+        self.stages = stages
+        for stage, following in zip(stages, stages[1:]):
+            stage.next = following
+        self._lock = threading.Lock()
+        self._seq = 0
+        for stage in stages:
+            stage.start()
+
+    def submit(self, source, value, context=None):
+        """ Ingests value from source. Returns immediately unless the first stage's queue is full. """
+        with self._lock:
+            job = Job(self._seq, source, value, context)
+            self._seq += 1
+            # Queued while holding the lock, so that ordered stages see seq numbers in order.
+            self.stages[0].put(job)
+
+    def stop(self):
+        """ Stops all worker threads without blocking. Jobs that are still in flight are dropped. """
+        for stage in self.stages:
+            stage.stop()
@@ -66,7 +66,28 @@ class UtilitySpecializer(DebuggingSpecializer):
         self.mappings = self.analyzer.get_mappings()
         self.event = True
         self.addressees = list() # For discourse analysis, distinct from _stacked list, which is used for general referent resolution
+        self._context_used = False
+        self._context_start = (0, 0)
 
+    def start_context(self):
+        """ Marks the start of a new utterance. Afterwards, context_used() says whether specializing it
+        read the discourse context (e.g. referent resolution), and context_effects() returns what it
+        added to that context. """
+        self._context_used = False
+        self._context_start = (len(self._stacked), len(self.addressees))
+
+    def context_used(self):
+        return self._context_used
+
+    def context_effects(self):
+        stacked, addressees = self._context_start
+        return {'stacked': self._stacked[stacked:], 'addressees': self.addressees[addressees:]}
+
+    def replay_context(self, effects):
+        """ Re-applies the context_effects() of an earlier utterance, e.g. when its n-tuple was cached.
+        The caller is responsible for passing a copy. """
+        self._stacked.extend(effects['stacked'])
+        self.addressees.extend(effects['addressees'])
 
 
     def is_compatible(self, typesystem, role1, role2):
@@ -158,6 +179,7 @@ class UtilitySpecializer(DebuggingSpecializer):
     'He likes the painting by Picasso, and I like the one by Dali.' Not yet entirely clear what information to encode
     besides object type. """
     def resolve_anaphoricOne(self, item):
+        self._context_used = True
         popper = list(self._stacked)
         while len(popper) > 0:
             ref = popper.pop()
@@ -189,6 +211,7 @@ class UtilitySpecializer(DebuggingSpecializer):
     antecedents. """
     def resolve_referents(self, item, antecedents = None, actionary=None, pred=None):
         #self.find_closest_antecedent([7,8])
+        self._context_used = True
         if antecedents is None:
             antecedents = self._stacked
         popper = list(antecedents)
@@ -23,8 +23,14 @@ from nluas.language.core_specializer import *
 from nluas.language.word_checker import WordChecker
 from nluas.core_agent import *
 from nluas.language.analyzer_proxy import *
+from nluas.language.instrumentation import instrumentation
+from nluas.language.ntuple_cache import NtupleCache, TemplateCache, NUMBER
+from nluas.language.pipeline import Pipeline, Stage
 from nluas.ntuple_decoder import NtupleDecoder
 import sys, traceback, time
+import hashlib
+import signal
+import threading
 import json
 import time
 from collections import OrderedDict
@@ -37,7 +43,12 @@ class UserAgent(CoreAgent):
         """args are execpted to be a prefs_path followed by the CoreAgent args"""
         self.prefs_path = args[0]
         CoreAgent.__init__(self, args[1:])
+        self.ui_parser = self.setup_ui_parser()
+        ui_args = self.ui_parser.parse_known_args(self.unknown)[0]
+        self.initialize_instrumentation(ui_args.instrument)
         self.initialize_UI()
+        self.initialize_cache(ui_args.cache)
+        self.initialize_pipeline(ui_args.pipeline)
         self.solve_destination = "{}_{}".format(self.federation, "ProblemSolver")
         self.speech_address = "{}_{}".format(self.federation, "SpeechAgent")
         self.text_address = "{}_{}".format(self.federation, "TextAgent")
@@ -49,8 +60,52 @@ class UserAgent(CoreAgent):
         parser = argparse.ArgumentParser()
         parser.add_argument("-port", type=str, help="indicate host to connect to",
                             default="http://localhost:8090")
+        parser.add_argument("-instrument", action="store_true",
+                            help="time each pipeline stage; send SIGUSR1 to print the histograms")
+        parser.add_argument("-cache", type=int, default=1024,
+                            help="number of utterances (and of utterance templates) to cache; 0 disables the caches")
+        parser.add_argument("-pipeline", type=int, default=0,
+                            help="number of parser threads; 0 processes each input on the Transport thread")
         return parser
 
+    def initialize_cache(self, size):
+        """ Sets up the utterance and template caches, labelled with the template/grammar version, which is fixed
+        for the life of the agent: nothing reloads the templates or grammar while it runs. """
+        digest = hashlib.sha1(self.specializer.version().encode("utf-8"))
+        digest.update(json.dumps(sorted(self.lexicon)).encode("utf-8"))
+        self.cache = NtupleCache(size, digest.hexdigest())
+        self.templates = TemplateCache(size, digest.hexdigest(), self.specializer.mappings, self.compatible_tokens,
+                                       self.specializer.mappings.keys())
+
+    def initialize_pipeline(self, parsers):
+        """ With parsers > 0, input is word-checked, parsed (by that many threads), specialized and sent
+        on a staged Pipeline instead of on the Transport thread. Specializing and sending stay in input order. """
+        self.pipeline = None
+        if parsers > 0:
+            # XML-RPC proxies can't be shared between threads; each parser thread gets its own.
+            self.local = threading.local()
+            self.pipeline = Pipeline([Stage("word_check", self.check_stage),
+                                      Stage("parse", self.parse_stage, workers=parsers),
+                                      Stage("specialize", self.specialize_stage, ordered=True),
+                                      Stage("send", self.send_stage, ordered=True, always=True)])
+
+    def compatible_tokens(self, kind, old, new):
+        """ Numbers can always replace each other in a cached template. Names only if the grammar's
+        token files describe both the same way. """
+        if kind == NUMBER:
+            return True
+        info = self.word_checker.tokens_info
+        if old not in info or new not in info:
+            return False
+        return [field.replace(old, "") for field in info[old]] == [field.replace(new, "") for field in info[new]]
+
+    def initialize_instrumentation(self, enabled):
+        """ Enables per-stage timers if requested (or if NLUAS_INSTRUMENT is set in the environment). """
+        if enabled or os.environ.get("NLUAS_INSTRUMENT"):
+            instrumentation.enable()
+            if hasattr(signal, "SIGUSR1"):
+                signal.signal(signal.SIGUSR1, lambda signum, frame: instrumentation.dump())
+
     def initialize_UI(self):
         self.clarification = False
         self.analyzer_port = "http://localhost:8090"
@@ -82,7 +137,8 @@ class UserAgent(CoreAgent):
             quit()
 
     def initialize_wordchecker(self):
-        self.word_checker = WordChecker(self.prefs_path, self.analyzer.get_lexicon())
+        self.lexicon = self.analyzer.get_lexicon()
+        self.word_checker = WordChecker(self.prefs_path, self.lexicon)
 
     def match_spans(self, spans, sentence):
         sentence = sentence.replace(".", " . ").replace(",", " , ").replace("?", " ? ").replace("!", " ! ").split()
@@ -93,31 +149,87 @@ class UserAgent(CoreAgent):
         return final
 
     def process_input(self, msg):
+        instrumentation.begin()
         try:
+            msg = self.check_input(msg)
+            cached = self.lookup(msg)
+            if cached:
+                ntuple, effects = cached
+                self.specializer.replay_context(effects)
+                return self.attach_timings(ntuple)
+            full_parse = self.parse_input(msg)
+            return self.attach_timings(self.specialize_parse(msg, full_parse))
+        except Exception as e:
+            print(e)
+        finally:
+            instrumentation.end()
+
+    def lookup(self, msg):
+        """ Returns the cached (ntuple, context effects) for msg, from the utterance cache or else the
+        template cache, or None. The caches are bypassed in debug mode. """
+        if self.specializer.debug_mode:
+            return None
+        cached = self.cache.get(msg)
+        if cached is not None:
+            instrumentation.count("cache_hits")
+            return cached
+        cached = self.templates.get(msg)
+        if cached is not None:
+            instrumentation.count("template_hits")
+        return cached
+
+    def check_input(self, msg):
+        """ Runs msg through the WordChecker, and returns the corrected sentence. Raises an exception for unknown tokens. """
+        with instrumentation.timer("word_check"):
             table = self.word_checker.check(msg)
-            if any(table['failed']):
-                failures = self.word_checker.get_failed(table)
-                raise Exception("Unknown tokens in inputs: {}".format(failures))
-
-            msg = self.word_checker.join_checked(table['checked'])
-            full_parse = self.analyzer.full_parse(msg)
-            semspecs = full_parse['parse']
-            spans = full_parse['spans']
-            index = 0
-            for fs in semspecs:
-                try:
-                    span = spans[index]
-                    matched = self.match_spans(span, msg)
+        if any(table['failed']):
+            failures = self.word_checker.get_failed(table)
+            raise Exception("Unknown tokens in inputs: {}".format(failures))
+        return self.word_checker.join_checked(table['checked'])
+
+    def parse_input(self, msg):
+        with instrumentation.timer("full_parse"):
+            return self.analyzer.full_parse(msg)
+
+    def specialize_parse(self, msg, full_parse):
+        """ Returns the n-tuple for the first SemSpec in full_parse that can be specialized, and caches it
+        unless specializing it depended on the discourse context. """
+        semspecs = full_parse['parse']
+        spans = full_parse['spans']
+        index = 0
+        self.specializer.start_context()
+        for fs in semspecs:
+            try:
+                span = spans[index]
+                matched = self.match_spans(span, msg)
+                with instrumentation.timer("specialize"):
                     self.specializer.set_spans(matched)
                     ntuple = self.specializer.specialize(fs)
-                    return ntuple
-                except Exception as e:
-                    if self.verbose:
-                        traceback.print_exc()
-                        self.output_stream(self.name, e)
-                    index += 1
-        except Exception as e:
-            print(e)
+                self.cache_ntuple(msg, ntuple)
+                return ntuple
+            except Exception as e:
+                instrumentation.count("specialize_failures")
+                if self.verbose:
+                    traceback.print_exc()
+                    self.output_stream(self.name, e)
+                index += 1
+
+    def cache_ntuple(self, msg, ntuple):
+        if not ntuple:
+            return
+        if self.specializer.context_used():
+            self.cache.reject()
+        else:
+            effects = self.specializer.context_effects()
+            self.cache.put(msg, ntuple, effects)
+            self.templates.put(msg, ntuple, effects)
+
+    def attach_timings(self, ntuple):
+        """ If instrumentation is enabled, adds this sentence's stage timings to the n-tuple's metadata. """
+        timings = instrumentation.end()
+        if timings and ntuple:
+            ntuple.setdefault('metadata', dict())['timings'] = timings['timings']
+        return ntuple
 
     def output_stream(self, tag, message):
         print("{}: {}".format(tag, message))
@@ -128,9 +240,7 @@ class UserAgent(CoreAgent):
         text = ntuple['text'].lower()
         if self.verbose:
             print("Got {}".format(text))
-        new_ntuple = self.process_input(text)
-        if new_ntuple and new_ntuple != "null" and "predicate_type" in new_ntuple:
-            self.transport.send(self.solve_destination, new_ntuple)
+        self.submit_input(self.speech_address, text, self.send_ntuple)
 
 
     def text_callback(self, ntuple):
@@ -138,6 +248,8 @@ class UserAgent(CoreAgent):
         specialize = True
         msg = ntuple['text']
         if self.is_quit(ntuple):
+            if self.pipeline:
+                self.pipeline.stop()
             self.close()
         elif ntuple['type'] == "standard":
             if msg == None or msg == "":
@@ -146,16 +258,59 @@ class UserAgent(CoreAgent):
                 self.specializer.set_debug()
                 specialize = False
             elif specialize:
-                new_ntuple = self.process_input(ntuple['text'])
-                if new_ntuple and new_ntuple != "null" and "predicate_type" in new_ntuple:
-                    self.transport.send(self.solve_destination, new_ntuple)
+                self.submit_input(self.text_address, ntuple['text'], self.send_ntuple)
         elif ntuple['type'] == "clarification":
-            descriptor = self.process_input(msg)
-            self.clarification = False
-            new_ntuple = self.clarify_ntuple(ntuple['original'], descriptor)
+            original = ntuple['original']
+            def send_clarified(descriptor):
+                self.clarification = False
+                new_ntuple = self.clarify_ntuple(original, descriptor)
+                self.transport.send(self.solve_destination, new_ntuple)
+            self.submit_input(self.text_address, msg, send_clarified)
+
+    def send_ntuple(self, new_ntuple):
+        if new_ntuple and new_ntuple != "null" and "predicate_type" in new_ntuple:
             self.transport.send(self.solve_destination, new_ntuple)
-            self.clarification = False
 
+    def submit_input(self, source, msg, done):
+        """ Processes msg from source and calls done with the resulting n-tuple: on a pipeline if one is
+        running, otherwise right away (on the Transport thread). """
+        if self.pipeline is None:
+            done(self.process_input(msg))
+        else:
+            context = {'done': done, 'timings': instrumentation.begin()}
+            instrumentation.end()
+            self.pipeline.submit(source, msg, context)
+
+    # Pipeline stages. See initialize_pipeline.
+
+    def check_stage(self, msg, job):
+        instrumentation.resume(job.context['timings'])
+        return self.check_input(msg)
+
+    def parse_stage(self, msg, job):
+        """ Looks msg up in the caches, and only parses it (with this thread's own analyzer proxy) on a miss. """
+        instrumentation.resume(job.context['timings'])
+        cached = self.lookup(msg)
+        if cached:
+            return msg, cached, None
+        if not hasattr(self.local, "analyzer"):
+            self.local.analyzer = Analyzer(self.analyzer_port)
+        with instrumentation.timer("full_parse"):
+            return msg, None, self.local.analyzer.full_parse(msg)
+
+    def specialize_stage(self, value, job):
+        instrumentation.resume(job.context['timings'])
+        msg, cached, full_parse = value
+        if cached:
+            ntuple, effects = cached
+            self.specializer.replay_context(effects)
+        else:
+            ntuple = self.specialize_parse(msg, full_parse)
+        return self.attach_timings(ntuple)
+
+    def send_stage(self, ntuple, job):
+        """ Calls the job's done callback, with None if an earlier stage failed (as process_input would return). """
+        job.context['done'](ntuple)
 
     def callback(self, ntuple):
         call_type = ntuple['type']
@@ -0,0 +1,216 @@
+######################################################################
+#
+# File: loopback_transport.py
+#
+# An in-process Transport backend.
+#
+# LoopbackTransports only talk to other LoopbackTransports in the same
+# process. Messages are handed over as Python objects through
+# in-memory queues, with no serialization, sockets or pyre discovery,
+# so agents can talk as soon as they're created. Useful for running a
+# whole application (e.g. ProblemSolver, AgentUI and TextAgent) in one
+# process, and for tests.
+#
+# Get one with Transport(name, loopback=True), or by setting the
+# environment variable NLUAS_TRANSPORT=loopback before creating
+# Transports (see Transport.__new__()).
+#
+# Like a decoded pyre message, an object sent to several agents is
+# shared between them, and it isn't copied on send either. Don't
+# modify an ntuple after sending it.
+#
+# Each LoopbackTransport delivers queued messages most urgent priority
+# first (see Transport.send()), and in the order they were sent within
+# a priority.
+#
+
+# ------
+# See LICENSE.txt for licensing information.
+# ------
+
+import datetime
+import itertools
+import threading
+import uuid
+
+try:
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
+
+from nluas.Transport import *
+from nluas.Transport import _Envelope, logger
+
+######################################################################
+#
+# The process-wide table of which LoopbackTransports are listening on
+# which channels (their own name, and their federation's global
+# channel).
+#
+
+class _Hub(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._channels = {}
+    # __init__()
+
+    def join(self, transport, channel):
+        with self._lock:
+            self._channels.setdefault(channel, []).append(transport)
+            others = set(t for members in self._channels.values() for t in members)
+        # Wake anything waiting for transport (see
+        # Transport.wait_for_peers()).
+        for t in others:
+            if t._peerwaiters:
+                t._peers_changed()
+    # join()
+
+    def leave(self, transport, channel):
+        with self._lock:
+            members = self._channels.get(channel, [])
+            if transport in members:
+                members.remove(transport)
+            if not members:
+                self._channels.pop(channel, None)
+    # leave()
+
+    def members(self, channel):
+        with self._lock:
+            return list(self._channels.get(channel, ()))
+    # members()
+
+    def shout(self, sender, channel, kind, obj, priority=PRIORITY_NORMAL):
+        '''Queue obj for every Transport on channel except sender. kind is 'message', 'control' or 'quit'.'''
+        for t in self.members(channel):
+            if t is not sender:
+                t._put(priority, (sender, channel, kind, obj))
+    # shout()
+# class _Hub
+
+_hub = _Hub()
+
+# Stands in for the Pyre object, which Transport and TransportError use
+# for the node's name and UUID.
+
+class _Node(object):
+    def __init__(self, name):
+        self._name = name
+        self._uuid = uuid.uuid4()
+    # __init__()
+
+    def name(self):
+        return self._name
+
+    def uuid(self):
+        return self._uuid
+# class _Node
+
+class LoopbackTransport(Transport):
+    '''A Transport that exchanges messages with other LoopbackTransports in the same process.'''
+
+    def send(self, dest, ntuple, priority=PRIORITY_NORMAL):
+        '''Send given ntuple to Transport named dest.'''
+        if self._prefix is not None:
+            dest = self._prefix + dest
+        # Nothing is encoded, so stats() count messages but not bytes.
+        self._metrics.sent(dest, 0, 0.0, set(t._pyre.name() for t in _hub.members(dest)))
+        _hub.shout(self, dest, 'message', ntuple, priority)
+    # send()
+
+    def broadcast(self, ntuple, priority=PRIORITY_NORMAL):
+        '''Send given ntuple to all Transports.'''
+        self._metrics.sent(self._globalchannel, 0, 0.0, set(t._pyre.name() for t in _hub.members(self._globalchannel) if t is not self))
+        _hub.shout(self, self._globalchannel, 'message', ntuple, priority)
+    # broadcast()
+
+    def quit_federation(self):
+        '''Send a quit message to all agents in this federation, and then close down the Transport.'''
+        if self._run:
+            _hub.shout(self, self._globalchannel, 'quit', None, PRIORITY_CONTROL)
+            self.close()
+    # quit_federation()
+
+    def close(self):
+        '''Close down this Transport, without telling the rest of the federation to quit.'''
+        if self._run:
+            self._stop()
+            # Callbacks run on the read thread, and may be what's
+            # closing us; it finishes once they return.
+            if threading.current_thread() is not self._readthread:
+                self._readthread.join()
+    # close()
+
+    ######################################################################
+    # All private methods below here
+
+    def _start(self, myname, codecs, whisper):
+        '''Register as myname with the in-process hub and start the delivery thread.'''
+        self._pyre = _Node(myname)
+        # Entries are (priority, arrival number, item); the arrival
+        # number keeps each priority in order, and items from being
+        # compared.
+        self._queue = queue.PriorityQueue()
+        self._arrival = itertools.count()
+        _hub.join(self, myname)
+        _hub.join(self, self._globalchannel)
+        self._readthread = threading.Thread(target=self._readworker)
+        self._readthread.daemon = True
+        self._readthread.start()
+    # _start()
+
+    def _readworker(self):
+        '''Deliver queued messages, and expire requests, until stopped.'''
+        while self._run:
+            try:
+                priority, n, item = self._queue.get(timeout=self._tick() / 1000.0)
+            except queue.Empty:
+                continue
+            if item is None:
+                break
+            sender, channel, kind, obj = item
+            if kind == 'quit':
+                self._stop()
+                break
+            self._metrics.received(channel, sender._pyre.name(), 0)
+            envelope = _Envelope(sender._pyre.uuid(), sender._pyre.name(), '127.0.0.1', channel, None, datetime.datetime.now(), obj)
+            try:
+                if kind == 'control':
+                    self._control(envelope)
+                else:
+                    self._dispatch(envelope)
+            except Exception:
+                logger.exception('Exception handling message from %s', sender._pyre.name())
+        self._cleanup()
+    # _readworker()
+
+    def _stop(self):
+        self._run = False
+        _hub.leave(self, self._pyre.name())
+        _hub.leave(self, self._globalchannel)
+        self._put(PRIORITY_CONTROL - 1, None)
+    # _stop()
+
+    def _peer_ready(self, name):
+        members = _hub.members(self._globalchannel)
+        return any(t in members for t in _hub.members(name))
+    # _peer_ready()
+
+    def _sync(self, names, timeout):
+        if names is None:
+            names = set(t._pyre.name() for t in _hub.members(self._globalchannel) if t is not self)
+            if self._prefix is not None:
+                names = [name[len(self._prefix):] for name in names]
+        return Transport._sync(self, names, timeout)
+    # _sync()
+
+    def _put(self, priority, item):
+        self._queue.put((priority, next(self._arrival), item))
+    # _put()
+
+    def _send_control(self, dest, body):
+        # dest already includes the prefix, if any. Reliable messages
+        # are data; requests, replies, acks and the rest go first.
+        _hub.shout(self, dest, 'control', body, PRIORITY_NORMAL if 'rel' in body else PRIORITY_CONTROL)
+    # _send_control()
+# class LoopbackTransport
@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+######################################################################
+#
+# File: transport_codecs.py
+#
+# Message codecs for Transport.
+#
+# A Transport frame is one header byte naming the codec, followed by
+# the encoded message. The header bytes are ASCII control characters
+# that JSON text can't start with, so a frame without a header -- as
+# sent by Transports that predate codecs -- is plain JSON text and is
+# decoded as such.
+#
+# Each Transport advertises the codecs it can decode in its Pyre
+# headers (see Transport.__init__), and a sender uses the best codec
+# all of the receivers share, or plain JSON if any of them is an old
+# Transport.
+#
+# Control frames (e.g. RPC requests and replies, see
+# Transport.request()) are a CONTROL byte followed by an ordinary frame,
+# so they're never mistaken for a message to a subscribe() callback.
+#
+# Priority frames (see Transport.send()) are a PRIORITY byte and a
+# priority byte followed by any other frame. Only messages that aren't
+# of normal priority are wrapped, and only for receivers that advertise
+# support for it.
+#
+# Batch frames (see Transport's batch_delay) are a BATCH byte followed
+# by any number of frames, each preceded by its length as 4 big-endian
+# bytes.
+#
+# Compressed frames (see Transport's compress_threshold) are a
+# COMPRESSED byte and a dictionary byte followed by an ordinary frame
+# compressed with zlib: with no preset dictionary if the dictionary
+# byte is 0, or with ZDICT if it's 1. ZDICT is the key vocabulary of
+# the ntuple templates (templates.json and friends), which most
+# ntuples repeat at every level; a sender only uses it with receivers
+# whose ZDICT_ID matches its own. In a control frame, the ordinary
+# frame after the CONTROL byte is what's compressed.
+#
+# Bridge clients don't advertise COMPRESS_FEATURE, so frames sent to a
+# channel a bridge client has joined aren't compressed this way; the
+# bridge client compresses big messages on the bridge link itself (see
+# bridge_client.py).
+#
+# Running this file benchmarks each available codec:
+#   python3 -m nluas.transport_codecs [ntuple.json]
+#
+
+# ------
+# See LICENSE.txt for licensing information.
+# ------
+
+from __future__ import print_function
+
+import collections
+import json
+import os
+import struct
+import sys
+import timeit
+import zlib
+
+class Codec():
+    '''Base class for codecs. Subclasses set name and header, and define encode() (object to bytes) and decode() (bytes to object).'''
+    name = None
+    header = None
+# class Codec
+
+class JSONCodec(Codec):
+    '''The standard library json module. Always available.'''
+    name = 'json'
+    header = 0x01
+
+    def encode(self, obj):
+        return json.dumps(obj).encode('utf-8')
+
+    def decode(self, data):
+        return json.loads(bytes(data).decode('utf-8'))
+# class JSONCodec
+
+class FastJSONCodec(Codec):
+    '''orjson, if installed. Same wire format as JSONCodec, but much faster.'''
+    name = 'orjson'
+    header = 0x02
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+
+    def encode(self, obj):
+        return self._orjson.dumps(obj)
+
+    def decode(self, data):
+        return self._orjson.loads(bytes(data))
+# class FastJSONCodec
+
+class MsgpackCodec(Codec):
+    '''msgpack, if installed. A compact binary format.'''
+    name = 'msgpack'
+    header = 0x03
+
+    def __init__(self):
+        import msgpack
+        self._msgpack = msgpack
+
+    def encode(self, obj):
+        return self._msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, data):
+        try:
+            return self._msgpack.unpackb(data, raw=False)
+        except ValueError:
+            # A map with keys that aren't strings. JSON would have sent
+            # them as strings, so give the receiver the same ntuple.
+            return self._msgpack.unpackb(data, raw=False, strict_map_key=False, object_pairs_hook=_json_keys)
+# class MsgpackCodec
+
+def _json_keys(pairs):
+    '''Return a dict of pairs, with keys that aren't strings converted the way json.dumps() does.'''
+    return dict((key if isinstance(key, type(u'')) else json.dumps(key), value) for key, value in pairs)
+# _json_keys()
+
+# Registered codecs, most preferred first, and the same indexed by
+# header byte. Codecs whose module isn't installed are left out.
+
+CODECS = collections.OrderedDict()
+_BY_HEADER = {}
+
+def register(codec, preferred=False):
+    '''Add a codec instance to the registry. If preferred, it's tried before all the others.'''
+    if codec.header in _BY_HEADER and _BY_HEADER[codec.header].name != codec.name:
+        raise ValueError('Codec header 0x%02x is already used by %s'%(codec.header, _BY_HEADER[codec.header].name))
+    CODECS[codec.name] = codec
+    _BY_HEADER[codec.header] = codec
+    if preferred:
+        CODECS.move_to_end(codec.name, last=False)
+# register()
+
+for _cls in (MsgpackCodec, FastJSONCodec, JSONCodec):
+    try:
+        register(_cls())
+    except ImportError:
+        pass
+
+def available():
+    '''Names of the registered codecs, most preferred first.'''
+    return list(CODECS.keys())
+
+def best_common(offers):
+    '''Return the name of the most preferred registered codec that every list in offers contains, or None if there isn't one (in which case the sender should use plain JSON).'''
+    for name in CODECS:
+        if all(name in offer for offer in offers):
+            return name
+    return None
+
+def encode(obj, codec=None):
+    '''Encode obj as a frame using the named codec, or as plain (header-less) JSON if codec is None. Falls back to the json codec if the named codec can't handle obj.'''
+    if codec is None:
+        return json.dumps(obj).encode('utf-8')
+    c = CODECS[codec]
+    try:
+        data = c.encode(obj)
+    except (TypeError, ValueError, OverflowError):
+        c = CODECS[JSONCodec.name]
+        data = c.encode(obj)
+    return bytes(bytearray([c.header])) + data
+
+def is_framed(data):
+    '''True if data starts with a codec header byte.'''
+    header = bytearray(data[:1])
+    return len(header) > 0 and header[0] in _BY_HEADER
+
+def decode(data):
+    '''Decode a frame produced by encode(), or plain JSON text (bytes or unicode) from an old Transport.'''
+    if isinstance(data, type(u'')):
+        return json.loads(data)
+    if data[:1] == _COMPRESSED_BYTE:
+        data = decompress(data)
+    if is_framed(data):
+        return _BY_HEADER[bytearray(data[:1])[0]].decode(memoryview(data)[1:])
+    return json.loads(bytes(data).decode('utf-8'))
+
+# Header byte of control frames. Not a codec header.
+CONTROL = 0x10
+_CONTROL_BYTE = bytes(bytearray([CONTROL]))
+
+def encode_control(obj, codec=None):
+    '''Encode obj as a control frame.'''
+    return _CONTROL_BYTE + encode(obj, codec)
+
+def is_control(data):
+    '''True if data is a control frame. decode(data[1:]) gives its contents.'''
+    return data[:1] == _CONTROL_BYTE
+
+# Header byte of priority frames. Not a codec header.
+PRIORITY = 0x12
+_PRIORITY_BYTE = bytes(bytearray([PRIORITY]))
+
+def encode_priority(frame, priority):
+    '''Wrap frame as a priority frame.'''
+    return _PRIORITY_BYTE + bytes(bytearray([priority])) + frame
+
+def split_priority(data, default):
+    '''Return the priority of data (default if it isn't a priority frame) and the frame it wraps.'''
+    if data[:1] == _PRIORITY_BYTE:
+        return bytearray(data[1:2])[0], memoryview(data)[2:]
+    return default, data
+
+# Header byte of batch frames. Not a codec header.
+BATCH = 0x13
+_BATCH_BYTE = bytes(bytearray([BATCH]))
+_LENGTH = struct.Struct('>I')
+
+def encode_batch(frames):
+    '''Pack a list of frames into one batch frame.'''
+    parts = [_BATCH_BYTE]
+    for frame in frames:
+        parts.append(_LENGTH.pack(len(frame)))
+        parts.append(bytes(frame))
+    return b''.join(parts)
+
+def is_batch(data):
+    '''True if data is a batch frame.'''
+    return data[:1] == _BATCH_BYTE
+
+def split_batch(data):
+    '''Return the list of frames packed in batch frame data.'''
+    view = memoryview(data)
+    frames = []
+    i = 1
+    while i < len(view):
+        n = _LENGTH.unpack_from(view, i)[0]
+        frames.append(view[i + 4:i + 4 + n])
+        i += 4 + n
+    return frames
+
+# Header byte of compressed frames. Not a codec header.
+COMPRESSED = 0x14
+_COMPRESSED_BYTE = bytes(bytearray([COMPRESSED]))
+
+# The template files ZDICT is built from, in this directory.
+TEMPLATE_FILES = ['templates.json', 'event_templates.json', 'parameter_templates.json', 'descriptors.json', 'mood_templates.json']
+
+def template_vocabulary(paths):
+    '''Return a zlib preset dictionary of the keys and string values in the JSON files at paths, least common first.'''
+    counts = collections.Counter()
+    def walk(obj):
+        if isinstance(obj, dict):
+            for key, value in obj.items():
+                counts[key] += 1
+                walk(value)
+        elif isinstance(obj, list):
+            for value in obj:
+                walk(value)
+        elif isinstance(obj, type(u'')) and len(obj) > 2:
+            counts[obj] += 1
+    # walk()
+    for path in paths:
+        with open(path) as f:
+            walk(json.load(f))
+    # zlib finds matches near the end of the dictionary most cheaply,
+    # so the most common words go last.
+    words = sorted(counts, key=lambda word: (counts[word], word))
+    return ''.join('"%s":'%(word) for word in words).encode('utf-8')[-32768:]
+# template_vocabulary()
+
+# The preset dictionary and its id, or None if the template files
+# can't be read.
+try:
+    ZDICT = template_vocabulary([os.path.join(os.path.dirname(os.path.abspath(__file__)), name) for name in TEMPLATE_FILES])
+    ZDICT_ID = '%08x'%(zlib.crc32(ZDICT) & 0xffffffff)
+except (IOError, ValueError):
+    ZDICT = None
+    ZDICT_ID = None
+
+def compress(frame, zdict=False, level=6):
+    '''Compress an ordinary or control frame, with ZDICT if zdict is true. Returns frame unchanged if compressing doesn't make it smaller.'''
+    control = is_control(frame)
+    data = frame[1:] if control else frame
+    if zdict and ZDICT is not None:
+        c = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, ZDICT)
+        header = _COMPRESSED_BYTE + b'\x01'
+    else:
+        c = zlib.compressobj(level)
+        header = _COMPRESSED_BYTE + b'\x00'
+    compressed = header + c.compress(bytes(data)) + c.flush()
+    if len(compressed) + (1 if control else 0) >= len(frame):
+        return frame
+    return _CONTROL_BYTE + compressed if control else compressed
+
+def is_compressed(data):
+    '''True if data is a compressed frame (not counting a CONTROL byte).'''
+    return data[:1] == _COMPRESSED_BYTE
+
+def decompress(data):
+    '''Return the frame compressed in compressed frame data.'''
+    if bytearray(data[1:2])[0]:
+        if ZDICT is None:
+            raise ValueError('Compressed frame needs the template dictionary, which is not available')
+        d = zlib.decompressobj(zlib.MAX_WBITS, ZDICT)
+    else:
+        d = zlib.decompressobj()
+    return d.decompress(bytes(data[2:])) + d.flush()
+
+def benchmark(obj, number=2000):
+    '''Print encode and decode time and frame size of obj for each codec.'''
+    print('%-10s %10s %12s %12s'%('codec', 'bytes', 'encode us', 'decode us'))
+    for name in CODECS:
+        frame = encode(obj, name)
+        enc = timeit.timeit(lambda: encode(obj, name), number=number) / number * 1e6
+        dec = timeit.timeit(lambda: decode(frame), number=number) / number * 1e6
+        print('%-10s %10d %12.1f %12.1f'%(name, len(frame), enc, dec))
+        for zdict in (False, True):
+            small = compress(frame, zdict)
+            enc = timeit.timeit(lambda: compress(encode(obj, name), zdict), number=number) / number * 1e6
+            dec = timeit.timeit(lambda: decode(small), number=number) / number * 1e6
+            print('%-10s %10d %12.1f %12.1f'%('+zdict' if zdict else '+zlib', len(small), enc, dec))
+# benchmark()
+
+# A typical command ntuple, used if no file is given to the benchmark.
+SAMPLE_NTUPLE = {
+    'predicate_type': 'command', 'return_type': 'error_descriptor', 'speechAct': 'Command',
+    'eventDescriptor': {
+        'e_features': {'eventFeatures': {'tense': 'present', 'negated': False, 'lexicalAspect': 'encapsulated'}},
+        'eventProcess': {
+            'template': 'MotionPath', 'schema': 'MotionPath', 'actionary': 'move', 'negated': False,
+            'p_features': {'processFeatures': {'voice': 'active', 'tense': 'present'}},
+            'protagonist': {'objectDescriptor': {'referent': 'robot1_instance', 'type': 'robot'}},
+            'heading': None, 'distance': {'value': 3.0, 'units': 'inch', 'property': 'distance'},
+            'speed': 0.5, 'direction': None, 'collaborative': False,
+            'spg': {'goal': {'objectDescriptor': {'type': 'box', 'color': 'red', 'size': 'big',
+                                                  'givenness': 'uniquelyIdentifiable', 'number': 'singular',
+                                                  'locationDescriptor': {'relation': 'near',
+                                                                         'objectDescriptor': {'type': 'room', 'givenness': 'uniquelyIdentifiable'}}}},
+                    'source': None, 'path': None}}}}
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        with open(sys.argv[1]) as f:
+            benchmark(json.load(f))
+    else:
+        benchmark(SAMPLE_NTUPLE)
@@ -0,0 +1,153 @@
+######################################################################
+#
+# File: transport_metrics.py
+#
+# Counters for Transport.stats().
+#
+# A Metrics object counts the messages and bytes a Transport sends and
+# receives, per channel and per peer, and times encoding, decoding and
+# callbacks. It's updated from the read, dispatch, callback and sending
+# threads, so everything is done under one lock, and each update is a
+# few additions.
+#
+# Rates are messages (and bytes) per second over the last RATE_WINDOW
+# to 2 * RATE_WINDOW seconds: snapshot() starts a new window when the
+# current one is RATE_WINDOW old, and reports the rate since the start
+# of the previous one. Until a window has passed, it's the rate since
+# the Transport started.
+#
+
+# ------
+# See LICENSE.txt for licensing information.
+# ------
+
+import threading
+import time
+
+RATE_WINDOW = 10.0
+
+# Indexes of the traffic counts kept per channel and per peer.
+_MSGS_IN, _BYTES_IN, _MSGS_OUT, _BYTES_OUT = range(4)
+
+class Metrics(object):
+    '''Traffic counts and timings for one Transport.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        # channel or peer name => [msgs in, bytes in, msgs out, bytes out]
+        self._channels = {}
+        self._peers = {}
+        # 'encode', 'decode' => [count, total seconds, max seconds], and
+        # the same for callbacks per sender name.
+        self._timings = {'encode': [0, 0.0, 0.0], 'decode': [0, 0.0, 0.0]}
+        self._callbacks = {}
+        # Messages nobody was subscribed to, and messages dropped by
+        # full subscription queues.
+        self.ignored = 0
+        self.dropped = 0
+        # Frames sent compressed, and the bytes that saved.
+        self.compressed = 0
+        self.saved = 0
+        # (time, channel totals, peer totals) at the start of the
+        # previous and current rate windows.
+        self._window = (self.started, {}, {})
+        self._previous = None
+
+    def sent(self, channel, size, seconds, names=()):
+        '''Count a frame of size bytes sent to channel, and to each of the peers called names, which took seconds to encode.'''
+        with self._lock:
+            for table, key in [(self._channels, channel)] + [(self._peers, name) for name in names]:
+                counts = table.get(key)
+                if counts is None:
+                    counts = table[key] = [0, 0, 0, 0]
+                counts[_MSGS_OUT] += 1
+                counts[_BYTES_OUT] += size
+            _time(self._timings['encode'], seconds)
+
+    def received(self, channel, name, size):
+        '''Count a frame of size bytes received on channel from the peer called name.'''
+        with self._lock:
+            for table, key in ((self._channels, channel), (self._peers, name)):
+                counts = table.get(key)
+                if counts is None:
+                    counts = table[key] = [0, 0, 0, 0]
+                counts[_MSGS_IN] += 1
+                counts[_BYTES_IN] += size
+
+    def decoder(self, decode):
+        '''Return decode wrapped to time each call.'''
+        def timed(data):
+            start = time.time()
+            try:
+                return decode(data)
+            finally:
+                seconds = time.time() - start
+                with self._lock:
+                    _time(self._timings['decode'], seconds)
+        # timed()
+        return timed
+
+    def callback(self, name, seconds):
+        '''Record a callback for a message from name that ran for seconds.'''
+        with self._lock:
+            timing = self._callbacks.get(name)
+            if timing is None:
+                timing = self._callbacks[name] = [0, 0.0, 0.0]
+            _time(timing, seconds)
+
+    def count(self, attr, n=1):
+        '''Add n to the ignored, dropped, compressed or saved count.'''
+        with self._lock:
+            setattr(self, attr, getattr(self, attr) + n)
+
+    def snapshot(self, now=None):
+        '''Return the counts, rates and timings as a dict of plain values.'''
+        if now is None:
+            now = time.time()
+        with self._lock:
+            if now - self._window[0] >= RATE_WINDOW:
+                self._previous = self._window
+                self._window = (now, _copy(self._channels), _copy(self._peers))
+            since, channels, peers = self._previous if self._previous is not None else (self.started, {}, {})
+            elapsed = max(now - since, 1e-9)
+            return {
+                'uptime': now - self.started,
+                'channels': _traffic(self._channels, channels, elapsed),
+                'peers': _traffic(self._peers, peers, elapsed),
+                'encode': _timing(self._timings['encode']),
+                'decode': _timing(self._timings['decode']),
+                'callbacks': dict((name, _timing(t)) for name, t in self._callbacks.items()),
+                'ignored': self.ignored,
+                'dropped': self.dropped,
+                'compressed': self.compressed,
+                'saved': self.saved,
+            }
+# class Metrics
+
+def _time(timing, seconds):
+    timing[0] += 1
+    timing[1] += seconds
+    if seconds > timing[2]:
+        timing[2] = seconds
+
+def _timing(timing):
+    count, total, longest = timing
+    return {'count': count, 'total': total, 'mean': total / count if count else 0.0, 'max': longest}
+
+def _copy(table):
+    return dict((key, list(counts)) for key, counts in table.items())
+
+def _traffic(table, before, elapsed):
+    result = {}
+    for key, counts in table.items():
+        old = before.get(key, (0, 0, 0, 0))
+        result[key] = {
+            'msgs_in': counts[_MSGS_IN], 'bytes_in': counts[_BYTES_IN],
+            'msgs_out': counts[_MSGS_OUT], 'bytes_out': counts[_BYTES_OUT],
+            'msgs_in_rate': (counts[_MSGS_IN] - old[_MSGS_IN]) / elapsed,
+            'bytes_in_rate': (counts[_BYTES_IN] - old[_BYTES_IN]) / elapsed,
+            'msgs_out_rate': (counts[_MSGS_OUT] - old[_MSGS_OUT]) / elapsed,
+            'bytes_out_rate': (counts[_BYTES_OUT] - old[_BYTES_OUT]) / elapsed,
+        }
+    return result
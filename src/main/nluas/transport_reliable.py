@@ -0,0 +1,137 @@
+######################################################################
+#
+# File: transport_reliable.py
+#
+# Bookkeeping for Transport's reliable delivery mode (see
+# Transport.send_reliable()).
+#
+# The sender numbers the messages to each destination 1, 2, 3, ... and
+# keeps each one until the receiver acknowledges it. Unacknowledged
+# messages are resent with exponential backoff, up to a bounded number
+# of attempts, and the buffer of them is bounded too. Each message also
+# carries the sender's "base", the lowest sequence number it still
+# holds, so a receiver that joined late doesn't wait for messages that
+# were given up on (or acknowledged by an earlier receiver).
+#
+# The receiver delivers messages in order, holding back any that
+# arrive after a gap, drops duplicates, and acknowledges cumulatively:
+# an ack of n covers every message up to n.
+#
+# The classes here only keep state; Transport does the sending, and
+# calls them with the current time.
+#
+
+# ------
+# See LICENSE.txt for licensing information.
+# ------
+
+import collections
+
+# Delivery statuses passed to send_reliable() status callbacks.
+DELIVERED = 'delivered'
+FAILED = 'failed'
+
+# Defaults: unacknowledged messages kept per destination, attempts per
+# message, and the first retransmit timeout in seconds.
+WINDOW = 256
+RETRIES = 8
+TIMEOUT = 0.5
+
+class Sender(object):
+    '''The unacknowledged messages to one destination.'''
+
+    def __init__(self, window=WINDOW, retries=RETRIES, timeout=TIMEOUT):
+        self.window = window
+        self.retries = retries
+        self.timeout = timeout
+        self.next = 1
+        # seq => [obj, status callback, attempts, time of next resend]
+        self.pending = collections.OrderedDict()
+
+    def add(self, obj, status, now):
+        '''Buffer obj, which is about to be sent for the first time. Returns its sequence number, and a list of (seq, status callback) for messages pushed out of a full buffer.'''
+        seq = self.next
+        self.next += 1
+        self.pending[seq] = [obj, status, 1, now + self.timeout]
+        dropped = []
+        while len(self.pending) > self.window:
+            old, entry = self.pending.popitem(last=False)
+            dropped.append((old, entry[1]))
+        return seq, dropped
+
+    def base(self):
+        '''The lowest sequence number the receiver should still wait for.'''
+        return next(iter(self.pending)) if self.pending else self.next
+
+    def ack(self, seq):
+        '''Handle a cumulative ack. Returns a list of (seq, status callback) for newly delivered messages.'''
+        delivered = []
+        while self.pending and next(iter(self.pending)) <= seq:
+            old, entry = self.pending.popitem(last=False)
+            delivered.append((old, entry[1]))
+        return delivered
+
+    def due(self, now):
+        '''Returns a list of (seq, obj) to resend now, and a list of (seq, status callback) for messages that ran out of attempts.'''
+        resend, failed = [], []
+        for seq, entry in list(self.pending.items()):
+            if entry[3] > now:
+                continue
+            if entry[2] >= self.retries:
+                del self.pending[seq]
+                failed.append((seq, entry[1]))
+            else:
+                entry[2] += 1
+                entry[3] = now + self.timeout * (2 ** (entry[2] - 1))
+                resend.append((seq, entry[0]))
+        return resend, failed
+
+    def resend_all(self, now):
+        '''Returns (seq, obj) for every pending message, e.g. because the destination just appeared. Doesn't count as an attempt.'''
+        for entry in self.pending.values():
+            entry[3] = now + self.timeout
+        return [(seq, entry[0]) for seq, entry in self.pending.items()]
+
+    def next_due(self):
+        '''The earliest time a resend is due, or None.'''
+        return min(entry[3] for entry in self.pending.values()) if self.pending else None
+# class Sender
+
+class Receiver(object):
+    '''The messages received from one sender.'''
+
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self.expected = 1
+        self.held = {}
+
+    def receive(self, seq, base, obj):
+        '''Handle message seq. Returns the list of messages now deliverable, in order, and whether seq was a duplicate.'''
+        ready = []
+        if base > self.expected:
+            # The sender gave up on (or another receiver acknowledged)
+            # everything before base. What was held waiting for those
+            # may be deliverable now.
+            for old in [s for s in self.held if s < base]:
+                del self.held[old]
+            self.expected = base
+            self._drain(ready)
+        if seq < self.expected or seq in self.held:
+            return ready, True
+        if seq - self.expected >= self.window:
+            # Too far ahead to hold; the sender will resend it.
+            return ready, False
+        self.held[seq] = obj
+        self._drain(ready)
+        return ready, False
+
+    def _drain(self, ready):
+        # Move held messages that are next in order to ready.
+        while self.expected in self.held:
+            ready.append(self.held.pop(self.expected))
+            self.expected += 1
+
+    def acked(self):
+        '''The cumulative ack for everything delivered so far.'''
+        return self.expected - 1
+# class Receiver
@@ -0,0 +1,151 @@
+######################################################################
+#
+# File: transport_routes.py
+#
+# The routing table behind Transport.subscribe().
+#
+# Each route is a pattern for sender names and a handler (a Transport
+# _Subscription). A pattern is either an exact name, a prefix ending in
+# a single '*' (e.g. 'FED1_Solver*'), or any other fnmatch-style glob
+# (e.g. 'FED1_Solver[0-9]'). Exact names and prefixes are kept in a
+# character trie, so finding the routes for a name takes one walk down
+# the trie, however many routes there are; other globs are tried one by
+# one. Either way the result, the handlers in the order they were
+# added, is cached per name, so each sender's name is only resolved
+# once until the routes change.
+#
+# Lookups take no lock unless the name isn't cached yet. Changes take
+# the lock and start a new cache.
+#
+
+# ------
+# See LICENSE.txt for licensing information.
+# ------
+
+import fnmatch
+import itertools
+import re
+import threading
+
+# Characters that make a pattern a glob.
+_GLOB = re.compile(r'[*?\[]')
+
+class _Node(object):
+    __slots__ = ('children', 'exact', 'prefix')
+
+    def __init__(self):
+        self.children = {}
+        # (order, pattern, handler) for routes whose pattern is the
+        # path to this node, or the path followed by '*'.
+        self.exact = []
+        self.prefix = []
+# class _Node
+
+class Routes(object):
+    '''Handlers for sender names, looked up by exact name, prefix* or glob.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._root = _Node()
+        # (order, pattern, handler) for globs that aren't plain prefixes.
+        self._globs = []
+        self._order = itertools.count()
+        self._cache = {}
+
+    def add(self, pattern, handler):
+        '''Route messages from names matching pattern to handler.'''
+        with self._lock:
+            entry = (next(self._order), pattern, handler)
+            kind, key = _classify(pattern)
+            if kind == 'glob':
+                self._globs.append(entry)
+            else:
+                getattr(self._walk(key, True), kind).append(entry)
+            self._cache = {}
+
+    def remove(self, pattern, which=None):
+        '''Remove the routes for pattern (only those whose handler h has which(h) true, if which is given). Returns the handlers removed.'''
+        keep = lambda entry: entry[1] != pattern or (which is not None and not which(entry[2]))
+        with self._lock:
+            kind, key = _classify(pattern)
+            if kind == 'glob':
+                entries = self._globs
+            else:
+                node = self._walk(key, False)
+                entries = getattr(node, kind) if node is not None else []
+            removed = [entry[2] for entry in entries if not keep(entry)]
+            entries[:] = [entry for entry in entries if keep(entry)]
+            if removed and kind != 'glob':
+                self._prune(key)
+            self._cache = {}
+        return removed
+
+    def match(self, name):
+        '''Return a tuple of the handlers for messages from name, in the order they were added.'''
+        handlers = self._cache.get(name)
+        if handlers is None:
+            with self._lock:
+                handlers = self._resolve(name)
+                self._cache[name] = handlers
+        return handlers
+
+    def items(self):
+        '''Return a list of (pattern, handler) for every route.'''
+        with self._lock:
+            entries = list(self._globs)
+            nodes = [self._root]
+            while nodes:
+                node = nodes.pop()
+                entries.extend(node.exact)
+                entries.extend(node.prefix)
+                nodes.extend(node.children.values())
+        return [(pattern, handler) for order, pattern, handler in sorted(entries, key=lambda entry: entry[0])]
+
+    def _walk(self, key, create):
+        node = self._root
+        for c in key:
+            child = node.children.get(c)
+            if child is None:
+                if not create:
+                    return None
+                child = node.children[c] = _Node()
+            node = child
+        return node
+
+    def _prune(self, key):
+        # Drop the nodes along key that no longer lead to any route,
+        # from the bottom up.
+        path = [self._root]
+        for c in key:
+            path.append(path[-1].children[c])
+        for i in range(len(key), 0, -1):
+            node = path[i]
+            if node.children or node.exact or node.prefix:
+                break
+            del path[i - 1].children[key[i - 1]]
+
+    def _resolve(self, name):
+        entries = list(self._root.prefix)
+        node = self._root
+        for c in name:
+            node = node.children.get(c)
+            if node is None:
+                break
+            entries.extend(node.prefix)
+        else:
+            entries.extend(node.exact)
+        entries.extend(entry for entry in self._globs if fnmatch.fnmatchcase(name, entry[1]))
+        return tuple(handler for order, pattern, handler in sorted(entries, key=lambda entry: entry[0]))
+# class Routes
+
+def is_pattern(name):
+    '''True if name is a glob rather than an exact name.'''
+    return _GLOB.search(name) is not None
+
+def _classify(pattern):
+    # Returns ('exact', name), ('prefix', prefix) or ('glob', pattern).
+    if not is_pattern(pattern):
+        return 'exact', pattern
+    if pattern.endswith('*') and not is_pattern(pattern[:-1]):
+        return 'prefix', pattern[:-1]
+    return 'glob', pattern
@@ -0,0 +1,161 @@
+######################################################################
+#
+# File: transport_shm.py
+#
+# Shared-memory handoff of large Transport messages between peers on
+# the same host.
+#
+# When a Transport is created with shm_threshold, a frame at least
+# that big, whose receivers are all Transports on this host that
+# advertise the 'shm' feature, is copied once into a new shared-memory
+# segment, and only a small descriptor frame travels over pyre: a
+# SHARED header byte followed by the JSON {"shm": segment name,
+# "size": frame size}. Receivers decode straight from the segment,
+# and tell the sender when they're done with it (a 'release' control
+# message). The sender unlinks the segment once every receiver has
+# released it or has EXITed, and unlinks any that are left when it
+# shuts down.
+#
+# Needs python 3.8 or later (multiprocessing.shared_memory). Without
+# it, available is False and Transports neither send nor advertise
+# shared-memory frames.
+#
+
+# ------
+# See LICENSE.txt for licensing information.
+# ------
+
+import json
+import socket
+import threading
+import uuid
+
+try:
+    from multiprocessing import shared_memory
+    from multiprocessing import resource_tracker
+    available = True
+except ImportError:
+    available = False
+
+from nluas import transport_codecs
+
+# Identifies this host. Peers whose X-TRANSPORT-HOST header matches can
+# share memory with us.
+HOST_ID = '%s-%012x'%(socket.gethostname(), uuid.getnode())
+
+# Header byte of descriptor frames. Not a codec header.
+SHARED = 0x11
+_SHARED_BYTE = bytes(bytearray([SHARED]))
+
+def is_descriptor(data):
+    '''True if data is a shared-memory descriptor frame.'''
+    return data[:1] == _SHARED_BYTE
+
+def _attach(name):
+    # Attach to an existing segment without registering it with this
+    # process's resource tracker, which would otherwise unlink it when
+    # this process exits, even though the sender owns it.
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before python 3.13
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+class Segments(object):
+    '''The shared-memory segments a Transport has sent, and which peers still hold each one.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # segment name => (SharedMemory, set of holder ids)
+        self._segments = {}
+        self.created = 0
+        self.bytes = 0
+
+    def put(self, frame, holders):
+        '''Copy frame into a new segment held by holders (e.g. peer UUIDs). Returns the descriptor frame to send instead.'''
+        shm = shared_memory.SharedMemory(create=True, size=len(frame))
+        shm.buf[:len(frame)] = frame
+        with self._lock:
+            self._segments[shm.name] = (shm, set(holders))
+            self.created += 1
+            self.bytes += len(frame)
+        return _SHARED_BYTE + json.dumps({'shm': shm.name, 'size': len(frame)}).encode('utf-8')
+
+    def release(self, name, holder):
+        '''Record that holder is done with segment name, unlinking it if nobody else holds it.'''
+        with self._lock:
+            entry = self._segments.get(name)
+            if entry is None:
+                return
+            entry[1].discard(holder)
+            if entry[1]:
+                return
+            del self._segments[name]
+        self._unlink(entry[0])
+
+    def drop_holder(self, holder):
+        '''Release every segment held by holder, e.g. because it EXITed.'''
+        with self._lock:
+            names = [name for name, (shm, holders) in self._segments.items() if holder in holders]
+        for name in names:
+            self.release(name, holder)
+
+    def close(self):
+        '''Unlink all segments.'''
+        with self._lock:
+            entries = list(self._segments.values())
+            self._segments.clear()
+        for shm, holders in entries:
+            self._unlink(shm)
+
+    def in_use(self):
+        '''Return the number of segments and bytes still held.'''
+        with self._lock:
+            return len(self._segments), sum(shm.size for shm, holders in self._segments.values())
+
+    def _unlink(self, shm):
+        shm.close()
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+# class Segments
+
+class SharedPayload(object):
+    '''The receiving end of a descriptor frame. Attaches to the segment; decode() decodes the frame in it and releases it.'''
+
+    def __init__(self, descriptor, release):
+        # release(segment name) is called once the segment is no
+        # longer needed.
+        d = json.loads(bytes(descriptor[1:]).decode('utf-8'))
+        self.name = d['shm']
+        self.size = d['size']
+        self._release = release
+        self._shm = _attach(self.name)
+        self._lock = threading.Lock()
+
+    def is_control(self):
+        '''True if the shared frame is a control frame.'''
+        return transport_codecs.is_control(bytes(self._shm.buf[:1]))
+
+    def decode(self):
+        '''Decode the shared frame (without its control byte, if any) and release the segment.'''
+        with self._lock:
+            view = self._shm.buf[:self.size]
+            try:
+                if transport_codecs.is_control(bytes(view[:1])):
+                    return transport_codecs.decode(view[1:])
+                return transport_codecs.decode(view)
+            finally:
+                view.release()
+                self.release()
+
+    def release(self):
+        '''Detach from the segment and tell the sender, unless already done.'''
+        if self._shm is not None:
+            self._shm.close()
+            self._shm = None
+            self._release(self.name)
+# class SharedPayload
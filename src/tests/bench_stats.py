@@ -0,0 +1,32 @@
+"""
+Statistics and baseline comparison shared by the pipeline and Transport benchmarks.
+"""
+
+import json
+
+
+def percentile(values, p):
+    """ Nearest-rank percentile of values, with p between 0 and 100. """
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    rank = int(round(p / 100.0 * (len(ordered) - 1)))
+    return ordered[rank]
+
+
+def compare(results, baseline_file, tolerance, keys):
+    """ Returns a description of each stat in keys (lower is better) or throughput that is worse
+    than in the baseline by more than tolerance. Stats that are None on either side are skipped. """
+    with open(baseline_file, "r") as f:
+        baseline = json.load(f)['results']
+    regressions = []
+    for name, stats in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        for key in keys:
+            if old.get(key) and stats.get(key) and stats[key] > old[key] * (1 + tolerance):
+                regressions.append("{} {} {:.3f} -> {:.3f}".format(name, key, old[key], stats[key]))
+        if old.get('throughput') and stats.get('throughput') and stats['throughput'] < old['throughput'] * (1 - tolerance):
+            regressions.append("{} throughput {:.1f} -> {:.1f}".format(name, old['throughput'], stats['throughput']))
+    return regressions
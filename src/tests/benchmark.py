@@ -0,0 +1,179 @@
+"""
+author: <seantrott@icsi.berkeley.edu>
+
+Benchmarks the language pipeline (as_featurestruct, CoreSpecializer.specialize, map_ontologies,
+WordChecker.check and UserAgent.process_input) against recorded analyzer fixtures, so that
+no analyzer needs to be running.
+
+Recording fixtures requires the Jython analyzer to be running (see tests.sh):
+    python3 src/tests/benchmark.py record -corpus src/tests/sentences.txt
+
+Running the benchmark (from the top of the repository):
+    python3 src/tests/benchmark.py run -output bench.json -baseline src/tests/fixtures/baseline.json
+
+Results are written as JSON. When a baseline is given, any benchmark whose latency, throughput
+or peak memory got worse than the tolerance is reported, and the exit status is 1.
+
+"""
+
+from nluas.language.core_specializer import *
+from nluas.language.analyzer_proxy import RecordingAnalyzer, ReplayAnalyzer
+from nluas.feature import as_featurestruct
+import argparse
+import copy
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+from bench_stats import percentile, compare
+from corpus import sentences
+
+FIXTURE = "src/tests/fixtures/analyzer_fixture.json"
+CORPORA = ["src/tests/sentences.txt"]
+
+
+def read_corpus(filenames):
+    """ Returns the specializer_test sentences, plus each non-empty line in filenames. """
+    corpus = list(sentences)
+    for filename in filenames:
+        with open(filename, "r") as f:
+            for line in f:
+                line = line.strip()
+                if line and line not in corpus:
+                    corpus.append(line)
+    return corpus
+
+
+def measure(func, inputs, repeat):
+    """ Runs func over every input, repeat times. Returns throughput (calls/sec), p50 and p99
+    latency (ms), and peak traced memory (bytes) of a separate, untimed pass. All but calls are
+    None if there are no inputs. """
+    if not inputs:
+        return {'calls': 0, 'throughput': None, 'p50_ms': None, 'p99_ms': None, 'peak_memory': None}
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for item in inputs:
+            t0 = time.perf_counter()
+            func(item)
+            latencies.append(time.perf_counter() - t0)
+    total = time.perf_counter() - start
+
+    tracemalloc.start()
+    for item in inputs:
+        func(item)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {'calls': len(latencies),
+            'throughput': len(latencies) / total if total else None,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'peak_memory': peak}
+
+
+def specialize_first(specializer, full_parse):
+    """ Mirrors UserAgent.process_input: returns the n-tuple of the first SemSpec that specializes.
+    The discourse stack is reset first, so that every pass over the corpus does the same work. """
+    specializer._stacked, specializer.addressees = [], []
+    for fs, spans in zip(full_parse['parse'], full_parse['spans']):
+        try:
+            specializer.set_spans([[span['type'], None, span['span'], span['id']] for span in spans])
+            return specializer.specialize(fs)
+        except Exception:
+            continue
+
+
+def record(args):
+    analyzer = RecordingAnalyzer(args.port)
+    try:
+        specializer = CoreSpecializer(analyzer)
+        analyzer.get_lexicon()
+        analyzer.get_utterances()
+    except OSError as e:
+        print("Can't reach the analyzer at {}: {}".format(args.port, e))
+        return 1
+    for sentence in read_corpus(args.corpus):
+        try:
+            specialize_first(specializer, analyzer.full_parse(sentence))
+        except Exception as e:
+            print("Skipping '{}': {}".format(sentence, e))
+    if not os.path.isdir(os.path.dirname(args.fixture)):
+        os.makedirs(os.path.dirname(args.fixture))
+    analyzer.save(args.fixture)
+    print("Wrote {}".format(args.fixture))
+    return 0
+
+
+def run(args):
+    if not os.path.exists(args.fixture):
+        print("No analyzer fixture {}; start the analyzer and run 'benchmark.py record' first.".format(args.fixture))
+        return 2
+    analyzer = ReplayAnalyzer(args.fixture)
+    specializer = CoreSpecializer(analyzer)
+    recorded = analyzer.analyzer.calls.get("parse", dict())
+    corpus = [s for s in read_corpus(args.corpus) if json.dumps([s]) in recorded]
+    raw = [recorded[json.dumps([s])]['parse'] for s in corpus]
+    parses = [analyzer.full_parse(s) for s in corpus]
+    ntuples = [n for n in (specialize_first(specializer, p) for p in parses) if n]
+
+    results = dict()
+    results['as_featurestruct'] = measure(lambda parse: [as_featurestruct(r, s) for r, s in parse], raw, args.repeat)
+    results['specialize'] = measure(lambda p: specialize_first(specializer, p), parses, args.repeat)
+    results['map_ontologies'] = measure(lambda n: specializer.map_ontologies(copy.deepcopy(n)), ntuples, args.repeat)
+
+    if args.prefs:
+        # WordChecker and UserAgent need the grammar's prefs file (and enchant/nltk).
+        from nluas.language.word_checker import WordChecker
+        from nluas.language.user_agent import UserAgent
+        from nluas.language.ntuple_cache import NtupleCache, TemplateCache
+        checker = WordChecker(args.prefs, analyzer.get_lexicon())
+        results['word_checker'] = measure(checker.check, corpus, args.repeat)
+
+        agent = UserAgent.__new__(UserAgent)
+        agent.analyzer, agent.specializer, agent.word_checker = analyzer, specializer, checker
+        agent.verbose = False
+        # The caches would turn every pass after the first into a lookup.
+        agent.cache, agent.templates = NtupleCache(0), TemplateCache(0)
+        results['process_input'] = measure(agent.process_input, corpus, args.repeat)
+
+    report = {'sentences': len(corpus), 'repeat': args.repeat, 'results': results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    for name, stats in sorted(results.items()):
+        if not stats['calls']:
+            print("{:<18} no recorded sentences".format(name))
+            continue
+        print("{:<18} {:>10.1f}/s  p50 {:>8.3f}ms  p99 {:>8.3f}ms  peak {:>10d}B".format(
+              name, stats['throughput'], stats['p50_ms'], stats['p99_ms'], stats['peak_memory']))
+
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance, ['p50_ms', 'p99_ms', 'peak_memory'])
+        for regression in regressions:
+            print("REGRESSION: {}".format(regression))
+        return 1 if regressions else 0
+    return 0
+
+
+def setup_parser():
+    parser = argparse.ArgumentParser(description="Benchmark the language pipeline against recorded analyzer fixtures.")
+    parser.add_argument("command", choices=["record", "run"], help="record fixtures from a running analyzer, or run the benchmark")
+    parser.add_argument("-fixture", type=str, default=FIXTURE, help="analyzer fixture file (default %(default)s)")
+    parser.add_argument("-corpus", type=str, nargs="*", default=CORPORA, help="extra sentence files, one sentence per line")
+    parser.add_argument("-port", type=str, default="http://localhost:8090", help="analyzer to record from")
+    parser.add_argument("-prefs", type=str, help="grammar prefs file; enables the WordChecker and UserAgent benchmarks")
+    parser.add_argument("-repeat", type=int, default=20, help="number of passes over the corpus (default %(default)s)")
+    parser.add_argument("-output", type=str, default="bench.json", help="where to write the results (default %(default)s)")
+    parser.add_argument("-baseline", type=str, help="results file to compare against")
+    parser.add_argument("-tolerance", type=float, default=0.10, help="allowed relative slowdown before flagging a regression (default %(default)s)")
+    return parser
+
+
+if __name__ == "__main__":
+    args = setup_parser().parse_args(sys.argv[1:])
+    if args.command == "record":
+        sys.exit(record(args))
+    else:
+        sys.exit(run(args))
@@ -0,0 +1,178 @@
+"""
+Tests the bridge client's connection to the bridge server (nluas.bridge_client).
+Requires pyre and zmq to be importable, but not a network.
+"""
+
+from nluas import bridge_client
+from nluas import bridge_server
+import asyncio
+import json
+import socket
+import threading
+import unittest
+
+
+class LegacyServer(object):
+    """ Behaves like a bridge server older than the BINARY wire format: sends every message it gets
+    from one client, HELLOs included, to every other client. """
+
+    def __init__(self, clients):
+        self.listener = socket.socket()
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(clients)
+        self.address = self.listener.getsockname()
+        self.socks = []
+        self.thread = threading.Thread(target=self.serve, args=(clients,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self, clients):
+        for i in range(clients):
+            self.socks.append(self.listener.accept()[0])
+        for sock in self.socks:
+            relay = threading.Thread(target=self.relay, args=(sock,))
+            relay.daemon = True
+            relay.start()
+
+    def relay(self, sock):
+        buf = b""
+        while True:
+            try:
+                data = sock.recv(65536)
+            except OSError:
+                return
+            if not data:
+                return
+            buf += data
+            found = bridge_server.next_frame(buf)
+            while found is not None:
+                start, end, priority, compressed = found
+                for other in self.socks:
+                    if other is not sock:
+                        other.sendall(buf[:end])
+                buf = buf[end:]
+                found = bridge_server.next_frame(buf)
+
+    def close(self):
+        for sock in self.socks + [self.listener]:
+            sock.close()
+
+
+class Server(object):
+    """ Runs a bridge server on an event loop of its own. """
+
+    def __init__(self):
+        bridge_server.parse_arguments([])
+        bridge_server.Clients = bridge_server.Bridge()
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(asyncio.start_server(bridge_server.serve_client, "127.0.0.1", 0))
+        self.address = self.server.sockets[0].getsockname()[:2]
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        async def stop():
+            self.server.close()
+            tasks = asyncio.all_tasks() - set([asyncio.current_task()])
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.server.wait_closed()
+        asyncio.run_coroutine_threadsafe(stop(), self.loop).result(5)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(5)
+        self.loop.close()
+
+
+class HandshakeTests(unittest.TestCase):
+
+    def test_server_answers_our_hello(self):
+        server = Server()
+        try:
+            connection = bridge_client.BridgeConnection(socket.create_connection(server.address))
+            self.assertEqual(connection.handshake(5), [])
+            self.assertEqual(connection.version, bridge_server.PROTOCOL_VERSION)
+            connection.sock.close()
+        finally:
+            server.close()
+
+    def test_legacy_server_forwarding_hellos(self):
+        server = LegacyServer(2)
+        try:
+            connections = [bridge_client.BridgeConnection(socket.create_connection(server.address)) for i in range(2)]
+            received = [None, None]
+            def handshake(i):
+                received[i] = connections[i].handshake(0.5)
+            threads = [threading.Thread(target=handshake, args=(i,)) for i in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(5)
+            # Each saw the other's HELLO, but neither took it for the
+            # server's answer.
+            self.assertEqual([c.version for c in connections], [bridge_server.LEGACY] * 2)
+            self.assertEqual(received, [[], []])
+            connections[0].send(["SHOUT", "UI", "Solver", {"x": 1}])
+            self.assertEqual(connections[1].recv(), [(["SHOUT", "UI", "Solver", {"x": 1}], bridge_server.NORMAL)])
+            for c in connections:
+                c.sock.close()
+        finally:
+            server.close()
+
+
+class CompressionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Server()
+
+    def tearDown(self):
+        self.server.close()
+
+    def connect(self):
+        connection = bridge_client.BridgeConnection(socket.create_connection(self.server.address))
+        connection.sock.settimeout(5)
+        connection.handshake(5)
+        self.addCleanup(connection.sock.close)
+        return connection
+
+    def recv(self, connection, count, kind="SHOUT"):
+        """ Returns the next count messages of type kind that connection receives. """
+        messages = []
+        while len(messages) < count:
+            messages.extend(m for m, priority in connection.recv() if m[0] == kind)
+        return messages
+
+    def test_big_messages_are_compressed(self):
+        a, b = self.connect(), self.connect()
+        self.assertEqual(a.version, bridge_server.COMPRESSED)
+        # An old client, which never sends a HELLO.
+        legacy = bridge_client.BridgeConnection(socket.create_connection(self.server.address))
+        legacy.sock.settimeout(5)
+        self.addCleanup(legacy.sock.close)
+        b.send(["JOIN", "Solver"])
+        legacy.send(["JOIN", "Solver"])
+        self.assertEqual(self.recv(a, 2, "JOIN"), [["JOIN", "Solver"]] * 2)
+        shout = ["SHOUT", "UI", "Solver", {"text": "move " * 1000}]
+        size = len(json.dumps(shout))
+        a.send(shout)
+        self.assertEqual(a.compressed, 1)
+        self.assertGreater(a.saved, size / 2)
+        self.assertEqual(self.recv(b, 1), [shout])
+        self.assertEqual(self.recv(legacy, 1), [shout])
+        # b was sent the compressed message, the old client all of it.
+        sent = dict((c.address[1], c.sent_bytes) for c in bridge_server.Clients.clients)
+        self.assertLess(sent[b.sock.getsockname()[1]], size / 2)
+        self.assertGreater(sent[legacy.sock.getsockname()[1]], size)
+
+    def test_small_messages_are_not_compressed(self):
+        a, b = self.connect(), self.connect()
+        b.send(["JOIN", "Solver"])
+        self.assertEqual(self.recv(a, 1, "JOIN"), [["JOIN", "Solver"]])
+        a.send(["SHOUT", "UI", "Solver", "move"])
+        self.assertEqual(a.compressed, 0)
+        self.assertEqual(self.recv(b, 1), [["SHOUT", "UI", "Solver", "move"]])
+
+
+if __name__ == "__main__":
+    unittest.main()
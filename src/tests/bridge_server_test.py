@@ -0,0 +1,260 @@
+"""
+Tests the bridge server's framing and channel routing (nluas.bridge_server).
+Does not require pyre.
+"""
+
+from nluas import bridge_server
+import asyncio
+import json
+import unittest
+import zlib
+
+
+def frame(message, version=bridge_server.LEGACY, priority=bridge_server.NORMAL):
+    return bridge_server.encode_frame(json.dumps(message).encode("utf-8"), version, priority)
+
+
+def route(bridge, client, message):
+    f = frame(message)
+    return bridge.route(client, f, f.index(b"\n") + 1)[0]
+
+
+class FakeClient(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.channels = set()
+        self.version = bridge_server.LEGACY
+
+    def __str__(self):
+        return self.name
+
+
+class FakeWriter(object):
+
+    def __init__(self):
+        self.written = []
+        self.closed = False
+
+    def get_extra_info(self, name):
+        return ("127.0.0.1", 1234)
+
+    def writelines(self, frames):
+        self.written.extend(frames)
+
+    def close(self):
+        self.closed = True
+
+
+class FramingTests(unittest.TestCase):
+
+    def test_partial_frames(self):
+        for version in (bridge_server.LEGACY, bridge_server.BINARY):
+            join, shout = frame(["JOIN", "A"], version), frame(["SHOUT", "B", "A", {"x": 1}], version, bridge_server.BULK)
+            data = join + shout
+            start, end, priority, compressed = bridge_server.next_frame(data, 0, version=version)
+            self.assertEqual(data[:end], join)
+            self.assertEqual(json.loads(data[start:end].decode("utf-8")), ["JOIN", "A"])
+            self.assertIsNone(bridge_server.next_frame(data, end, len(data) - 3, version))
+            start, end, priority, compressed = bridge_server.next_frame(data, end, version=version)
+            self.assertEqual(data[end - len(shout):end], shout)
+            self.assertEqual(priority, bridge_server.BULK if version == bridge_server.BINARY else bridge_server.NORMAL)
+            self.assertIsNone(bridge_server.next_frame(data, end, version=version))
+
+    def test_bad_frames(self):
+        self.assertRaises(ValueError, bridge_server.next_frame, b"x" * 30)
+        self.assertRaises(ValueError, bridge_server.next_frame, b"-3\nabc")
+        self.assertRaises(ValueError, bridge_server.next_frame, b"\0\0\0\1\7x", version=bridge_server.BINARY)
+        # Only the COMPRESSED format has compressed messages.
+        self.assertRaises(ValueError, bridge_server.next_frame, b"\0\0\0\1\x81x", version=bridge_server.BINARY)
+        self.assertRaises(ValueError, bridge_server.decompress, b"not zlib")
+
+    def test_compressed_frames(self):
+        message = zlib.compress(json.dumps(["SHOUT", "B", "A", "x" * 100]).encode("utf-8"))
+        data = bridge_server.encode_frame(message, bridge_server.COMPRESSED, bridge_server.BULK, True)
+        start, end, priority, compressed = bridge_server.next_frame(data, version=bridge_server.COMPRESSED)
+        self.assertEqual((priority, compressed), (bridge_server.BULK, True))
+        self.assertEqual(bridge_server.decompress(data[start:end], 20), b'["SHOUT", "B", "A", ')
+
+    def test_parse_header(self):
+        self.assertEqual(bridge_server.parse_header(frame(["SHOUT", "B", "A\"1", {"x": 1}]), 3), ("SHOUT", "A\"1"))
+        # Compact JSON, as sent by TransportBridge.cpp.
+        self.assertEqual(bridge_server.parse_header(b'["JOIN","Agent"]'), ("JOIN", "Agent"))
+        self.assertEqual(bridge_server.parse_header(b'{"JOIN": 1}'), (None, None))
+        self.assertEqual(bridge_server.parse_header(b'["HELLO", 2]'), ("HELLO", 2))
+        self.assertEqual(bridge_server.parse_header(b'["CONTROL","UI","Solver",{}]'), ("CONTROL", "Solver"))
+
+
+class BridgeTests(unittest.TestCase):
+
+    def test_shouts_go_only_to_joined_clients(self):
+        bridge = bridge_server.Bridge()
+        a, b, c = FakeClient("a"), FakeClient("b"), FakeClient("c")
+        for client in (a, b, c):
+            bridge.connect(client)
+        self.assertEqual(set(route(bridge, b, ["JOIN", "Solver"])), {a, c})
+        shout = ["SHOUT", "UI", "Solver", {"x": 1}]
+        self.assertEqual(route(bridge, a, shout), [b])
+        self.assertEqual(route(bridge, b, shout), [])
+        self.assertEqual(route(bridge, a, ["CONTROL", "UI", "Solver", {"request": "1", "payload": None}]), [b])
+        route(bridge, b, ["LEAVE", "Solver"])
+        self.assertEqual(route(bridge, a, shout), [])
+
+    def test_new_client_gets_existing_joins(self):
+        bridge = bridge_server.Bridge()
+        a = FakeClient("a")
+        bridge.connect(a)
+        route(bridge, a, ["JOIN", "Solver"])
+        self.assertEqual(bridge.connect(FakeClient("b")), [frame(["JOIN", "Solver"])])
+        bridge.disconnect(a)
+        self.assertEqual(bridge.connect(FakeClient("c")), [])
+
+
+class QueueTests(unittest.TestCase):
+
+    def queued(self, client):
+        return [list(lane) for lane in client.queue]
+
+    def test_most_urgent_first(self):
+        client = bridge_server.Client(None, FakeWriter())
+        client.send(b"bulk", bridge_server.BULK)
+        client.send(b"normal")
+        client.send(b"join", bridge_server.CONTROL)
+        self.assertEqual(client._take(100), [b"join", b"normal", b"bulk"])
+        self.assertEqual(client.stats()["sent_bytes"], 14)
+
+    def test_shed_lowest_priority_first(self):
+        client = bridge_server.Client(None, FakeWriter(), max_queue_bytes=8, overflow="shed")
+        client.send(b"b1", bridge_server.BULK)
+        client.send(b"n1")
+        client.send(b"b2", bridge_server.BULK)
+        client.send(b"n2")
+        client.send(b"n3")
+        self.assertEqual(self.queued(client), [[], [b"n1", b"n2", b"n3"], [b"b2"]])
+        client.send(b"b3", bridge_server.BULK)
+        self.assertEqual(self.queued(client), [[], [b"n1", b"n2", b"n3"], [b"b3"]])
+        client.send(b"JOIN", bridge_server.CONTROL)
+        self.assertEqual(client.stats()["dropped"], 2)
+        self.assertEqual(client.stats()["queued_bytes"], 12)
+
+    def test_drop_oldest_and_reject(self):
+        client = bridge_server.Client(None, FakeWriter(), max_queue_bytes=4, overflow="drop_oldest")
+        for frame in (b"b1", b"n1", b"n2"):
+            client.send(frame, bridge_server.BULK if frame[:1] == b"b" else bridge_server.NORMAL)
+        self.assertEqual(self.queued(client), [[], [b"n2"], [b"b1"]])
+        client = bridge_server.Client(None, FakeWriter(), max_queue_bytes=4, overflow="reject")
+        for frame in (b"n1", b"n2", b"n3"):
+            client.send(frame)
+        self.assertEqual(self.queued(client), [[], [b"n1", b"n2"], []])
+        self.assertEqual(client.stats()["dropped"], 1)
+
+    def test_disconnect(self):
+        writer = FakeWriter()
+        client = bridge_server.Client(None, writer, max_queue_bytes=4, overflow="disconnect")
+        client.send(b"n1")
+        client.send(b"n2")
+        client.send(b"n3")
+        self.assertTrue(writer.closed)
+        self.assertEqual(client.stats()["queued"], 0)
+
+
+class ServerTests(unittest.TestCase):
+
+    def test_forwarding(self):
+        bridge_server.parse_arguments([])
+        bridge_server.Clients = bridge_server.Bridge()
+
+        async def run():
+            server = await asyncio.start_server(bridge_server.serve_client, "127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            (r1, w1), (r2, w2), (r3, w3) = [await asyncio.open_connection("127.0.0.1", port) for i in range(3)]
+            w2.write(frame(["JOIN", "Solver"]))
+            self.assertEqual(await r1.readexactly(len(frame(["JOIN", "Solver"]))), frame(["JOIN", "Solver"]))
+            self.assertEqual(await r3.readexactly(len(frame(["JOIN", "Solver"]))), frame(["JOIN", "Solver"]))
+            shout = frame(["SHOUT", "UI", "Solver", {"x": 1}])
+            # Split across writes.
+            w1.write(shout[:5])
+            await w1.drain()
+            await asyncio.sleep(0.01)
+            w1.write(shout[5:] + frame(["SHOUT", "UI", "Other", {}]))
+            self.assertEqual(await r2.readexactly(len(shout)), shout)
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(r3.read(1), 0.1)
+            for w in (w1, w2, w3):
+                w.close()
+            await asyncio.sleep(0.1)
+            server.close()
+            await server.wait_closed()
+
+        asyncio.run(run())
+
+    def test_hello_switches_to_binary(self):
+        bridge_server.parse_arguments([])
+        bridge_server.Clients = bridge_server.Bridge()
+
+        async def run():
+            server = await asyncio.start_server(bridge_server.serve_client, "127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            (r1, w1), (r2, w2) = [await asyncio.open_connection("127.0.0.1", port) for i in range(2)]
+            w1.write(frame(["JOIN", "UI"]))
+            # Everything before the server's HELLO is LEGACY.
+            w2.write(frame(["HELLO", 99, "n2"]))
+            self.assertEqual(await r2.readexactly(len(frame(["JOIN", "UI"]))), frame(["JOIN", "UI"]))
+            hello = frame(["HELLO", bridge_server.PROTOCOL_VERSION, "n2"])
+            self.assertEqual(await r2.readexactly(len(hello)), hello)
+            w2.write(frame(["JOIN", "Solver"], bridge_server.BINARY, bridge_server.CONTROL))
+            self.assertEqual(await r1.readexactly(len(frame(["JOIN", "Solver"]))), frame(["JOIN", "Solver"]))
+            w1.write(frame(["SHOUT", "UI", "Solver", {"x": 1}]))
+            shout = frame(["SHOUT", "UI", "Solver", {"x": 1}], bridge_server.BINARY)
+            self.assertEqual(await r2.readexactly(len(shout)), shout)
+            w2.write(frame(["SHOUT", "Solver", "UI", {"y": 2}], bridge_server.BINARY, bridge_server.BULK))
+            self.assertEqual(await r1.readexactly(len(frame(["SHOUT", "Solver", "UI", {"y": 2}]))),
+                             frame(["SHOUT", "Solver", "UI", {"y": 2}]))
+            for w in (w1, w2):
+                w.close()
+            await asyncio.sleep(0.1)
+            server.close()
+            await server.wait_closed()
+
+        asyncio.run(run())
+
+    def test_slow_client_does_not_stall_others(self):
+        bridge_server.parse_arguments(["-max_queue_bytes", "100000"])
+        bridge_server.Clients = bridge_server.Bridge()
+        shout = frame(["SHOUT", "UI", "Solver", "x" * 10000])
+        count = 2000
+
+        async def run():
+            server = await asyncio.start_server(bridge_server.serve_client, "127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            (r1, w1), (r2, w2), (r3, w3) = [await asyncio.open_connection("127.0.0.1", port) for i in range(3)]
+            # Client 3 joins but never reads.
+            w2.write(frame(["JOIN", "Solver"]))
+            w3.write(frame(["JOIN", "Solver"]))
+            await asyncio.sleep(0.05)
+            # Client 2 gets client 3's JOIN and every SHOUT. The
+            # sender keeps no more than a few frames ahead of it.
+            await r2.readexactly(len(frame(["JOIN", "Solver"])))
+            got = 0
+            for i in range(count):
+                w1.write(shout)
+                await w1.drain()
+                while got < (i - 4) * len(shout):
+                    got += len(await asyncio.wait_for(r2.read(1 << 20), 5))
+            while got < count * len(shout):
+                got += len(await asyncio.wait_for(r2.read(1 << 20), 5))
+            self.assertEqual(got, count * len(shout))
+            stats = bridge_server.Clients.stats()["clients"]
+            self.assertGreater(sum(s["dropped"] for s in stats.values()), 0)
+            self.assertLessEqual(max(s["max_queued_bytes"] for s in stats.values()), 100000)
+            for w in (w1, w2, w3):
+                w.close()
+            await asyncio.sleep(0.1)
+            server.close()
+            await server.wait_closed()
+
+        asyncio.run(run())
+
+
+if __name__ == "__main__":
+    unittest.main()
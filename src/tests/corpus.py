@@ -0,0 +1,16 @@
+"""
+Sentences shared by the specializer tests and the pipeline benchmarks.
+"""
+
+sentences = ["boxes are big.",
+             "he moved.",
+             "the box is big.",
+             "he pushed the box.",
+             "he pushed the box into the room.",
+             "he saw the block.",
+             "he sprinted into the room.",
+             "he moved the box 3 inches.",
+             "the box costs 3 pounds.",
+             "the box weighs 3 pounds.",
+             "he painted the room blue.",
+             "he made the box bigger."]
@@ -0,0 +1,300 @@
+"""
+Tests Transport's delivery machinery (subscriptions, inboxes, priorities, rendezvous and so on)
+over in-process LoopbackTransports (nluas.loopback_transport), so no network is needed.
+Requires pyre and zmq to be importable.
+"""
+
+from nluas.Transport import *
+import concurrent.futures
+import itertools
+import os
+import threading
+import time
+import unittest
+
+_federations = itertools.count()
+
+
+class LoopbackTestCase(unittest.TestCase):
+    """ Creates LoopbackTransports in a federation of their own, and shuts them down afterwards. """
+
+    def setUp(self):
+        self.prefix = "TEST{}_".format(next(_federations))
+        self.transports = []
+
+    def tearDown(self):
+        for t in self.transports:
+            if t.is_running():
+                t.quit_federation()
+
+    def transport(self, name, **kw):
+        t = Transport(name, prefix=self.prefix, loopback=True, **kw)
+        self.transports.append(t)
+        return t
+
+    def wait_until(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition():
+            if time.time() > deadline:
+                return False
+            time.sleep(0.005)
+        return True
+
+
+class LoopbackTests(LoopbackTestCase):
+
+    def test_backend_selection(self):
+        from nluas.loopback_transport import LoopbackTransport
+        self.assertIsInstance(self.transport("A"), LoopbackTransport)
+        os.environ[BACKEND_ENV] = "loopback"
+        try:
+            t = Transport("B", prefix=self.prefix)
+            self.transports.append(t)
+        finally:
+            del os.environ[BACKEND_ENV]
+        self.assertIsInstance(t, LoopbackTransport)
+
+    def test_send_broadcast_and_metadata(self):
+        a, b, c = self.transport("A"), self.transport("B"), self.transport("C")
+        got = {"B": [], "C": []}
+        b.subscribe("A", lambda ntuple, **kw: got["B"].append((ntuple, kw["name"])))
+        c.subscribe("A", lambda ntuple, **kw: got["C"].append((ntuple, kw["name"])))
+        a.send("B", {'text': "to B"})
+        a.broadcast({'text': "to all"})
+        self.assertTrue(self.wait_until(lambda: len(got["B"]) == 2 and len(got["C"]) == 1))
+        name = self.prefix + "A"
+        self.assertEqual(got["B"], [({'text': "to B"}, name), ({'text': "to all"}, name)])
+        self.assertEqual(got["C"], [({'text': "to all"}, name)])
+
+    def test_request_and_quit(self):
+        a, b = self.transport("A"), self.transport("B")
+        b.respond(lambda payload: payload * 2)
+        self.assertEqual(a.request("B", 21).result(5), 42)
+        self.assertRaises(TransportRemoteError, b.request("A", 1).result, 5)
+        self.assertTrue(a.remote_stats("B").result(5)['uptime'] >= 0)
+        pending = a.request("B", 1)
+        a.quit_federation()
+        self.assertTrue(self.wait_until(lambda: not b.is_running()))
+        self.assertFalse(a.is_running())
+        # Either answered before the quit, or failed by it.
+        self.assertTrue(pending.done())
+
+    def test_quit_from_a_callback(self):
+        a, b = self.transport("A"), self.transport("B")
+        errors = []
+        def stop(ntuple):
+            try:
+                b.quit_federation()
+            except Exception as e:
+                errors.append(e)
+        b.subscribe("A", stop)
+        a.send("B", "stop")
+        self.assertTrue(self.wait_until(lambda: not a.is_running() and not b.is_running()))
+        self.assertEqual(errors, [])
+        self.assertTrue(self.wait_until(lambda: not b._readthread.is_alive()))
+
+    def test_close_leaves_the_others_running(self):
+        a, b = self.transport("A"), self.transport("B")
+        a.close()
+        self.assertFalse(a.is_running())
+        time.sleep(0.05)
+        self.assertTrue(b.is_running())
+        self.assertFalse(b.wait_for_peers(["A"], timeout=0))
+
+
+class SubscriptionTests(LoopbackTestCase):
+
+    def test_thread_executor_keeps_order(self):
+        a, b = self.transport("A"), self.transport("B")
+        got = []
+        b.subscribe("A", got.append, executor="thread")
+        for i in range(50):
+            a.send("B", i)
+        self.assertTrue(self.wait_until(lambda: len(got) == 50))
+        self.assertEqual(got, list(range(50)))
+
+    def test_pool_executor_runs_one_at_a_time(self):
+        a, b = self.transport("A"), self.transport("B")
+        got, running = [], []
+        def slow(ntuple):
+            running.append(ntuple)
+            self.assertEqual(len(running), 1)
+            time.sleep(0.001)
+            got.append(running.pop())
+        with concurrent.futures.ThreadPoolExecutor(4) as pool:
+            b.subscribe("A", slow, executor=pool)
+            for i in range(20):
+                a.send("B", i)
+            self.assertTrue(self.wait_until(lambda: len(got) == 20))
+        self.assertEqual(got, list(range(20)))
+
+    def test_overflow_policies(self):
+        a, b = self.transport("A"), self.transport("B")
+        release = threading.Event()
+        kept = {DROP_OLDEST: [], REJECT: []}
+        started = []
+        for policy in kept:
+            def callback(ntuple, policy=policy):
+                started.append(ntuple)
+                release.wait(5)
+                kept[policy].append(ntuple)
+            b.subscribe("A", callback, executor="thread", max_queue=2, overflow=policy)
+        a.send("B", 0)
+        # Wait for both workers to be busy with message 0.
+        self.assertTrue(self.wait_until(lambda: len(started) == 2))
+        for i in range(1, 6):
+            a.send("B", i)
+        self.assertTrue(self.wait_until(lambda: b.stats()['dropped'] == 6))
+        release.set()
+        self.assertTrue(self.wait_until(lambda: len(kept[DROP_OLDEST]) == 3 and len(kept[REJECT]) == 3))
+        self.assertEqual(kept[DROP_OLDEST], [0, 4, 5])
+        self.assertEqual(kept[REJECT], [0, 1, 2])
+
+    def test_quit_closes_subscriptions(self):
+        a, b = self.transport("A"), self.transport("B")
+        b.subscribe("A", lambda ntuple: None, executor="thread")
+        b.subscribe_all(lambda ntuple: None, executor="thread")
+        b.respond(lambda payload: payload, executor="thread")
+        subs = [sub for pattern, sub in b._subscribers.items()] + [b._subscribe_all] + list(b._responders.values())
+        b.quit_federation()
+        for sub in subs:
+            sub._thread.join(5)
+            self.assertFalse(sub._thread.is_alive())
+
+
+class PriorityTests(LoopbackTestCase):
+
+    def test_control_overtakes_queued_messages(self):
+        a, b = self.transport("A"), self.transport("B")
+        started, release = threading.Event(), threading.Event()
+        got = []
+        def callback(ntuple):
+            if ntuple == "first":
+                started.set()
+                release.wait(5)
+            got.append(ntuple)
+        b.subscribe("A", callback)
+        a.send("B", "first")
+        self.assertTrue(started.wait(5))
+        a.send("B", "bulk", PRIORITY_BULK)
+        a.send("B", "normal")
+        a.send("B", "stop", PRIORITY_CONTROL)
+        release.set()
+        self.assertTrue(self.wait_until(lambda: len(got) == 4))
+        self.assertEqual(got, ["first", "stop", "normal", "bulk"])
+
+    def test_lanes_dispatch_most_urgent_first(self):
+        from nluas.Transport import _Lanes
+        lanes = _Lanes(PRIORITY_BULK + 1)
+        release = threading.Event()
+        got = []
+        lanes.put(PRIORITY_NORMAL, lambda arg: release.wait(5), None)
+        self.assertTrue(self.wait_until(lambda: lanes.depths() == [0, 0, 0]))
+        for priority in (PRIORITY_BULK, PRIORITY_NORMAL, PRIORITY_CONTROL):
+            lanes.put(priority, got.append, priority)
+        self.assertEqual(lanes.depths(), [1, 1, 1])
+        release.set()
+        self.assertTrue(self.wait_until(lambda: len(got) == 3))
+        self.assertEqual(got, [PRIORITY_CONTROL, PRIORITY_NORMAL, PRIORITY_BULK])
+        lanes.close()
+        lanes.join()
+
+    def test_lanes_close_counts_dropped_messages(self):
+        from nluas.Transport import _Lanes
+        lanes = _Lanes(PRIORITY_BULK + 1)
+        release = threading.Event()
+        got = []
+        lanes.put(PRIORITY_NORMAL, lambda arg: release.wait(5), None)
+        self.assertTrue(self.wait_until(lambda: lanes.depths() == [0, 0, 0]))
+        for priority in (PRIORITY_BULK, PRIORITY_NORMAL, PRIORITY_CONTROL):
+            lanes.put(priority, got.append, priority)
+        with self.assertLogs("Transport", "WARNING") as logs:
+            lanes.close()
+        self.assertIn("2 queued messages", logs.output[0])
+        release.set()
+        lanes.join()
+        self.assertFalse(lanes._thread.is_alive())
+        # Control messages are still handed over.
+        self.assertEqual(got, [PRIORITY_CONTROL])
+
+
+class RendezvousTests(LoopbackTestCase):
+
+    def test_wait_for_peers(self):
+        a = self.transport("A")
+        self.assertFalse(a.wait_for_peers(["B"], timeout=0.05))
+        threading.Timer(0.05, self.transport, ["B"]).start()
+        self.assertTrue(a.wait_for_peers(["B"], timeout=5))
+        self.assertTrue(a.wait_for_peers([], timeout=0))
+
+    def test_barrier(self):
+        a, b, c = self.transport("A"), self.transport("B"), self.transport("C")
+        passed = []
+        def arrive(t, name):
+            self.assertTrue(t.barrier("start", ["A", "B", "C"], timeout=5))
+            passed.append(name)
+        threads = [threading.Thread(target=arrive, args=(t, name)) for t, name in ((b, "B"), (c, "C"))]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.05)
+        # Nobody gets through until A arrives too.
+        self.assertEqual(passed, [])
+        arrive(a, "A")
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(sorted(passed), ["A", "B", "C"])
+        # The next round waits for everyone again.
+        self.assertFalse(a.barrier("start", ["A", "B"], timeout=0.05))
+
+    def test_sync(self):
+        a, b = self.transport("A"), self.transport("B")
+        got = []
+        b.subscribe("A", got.append)
+        for i in range(20):
+            a.send("B", i)
+        self.assertTrue(a.sync(["B"], timeout=5))
+        self.assertEqual(got, list(range(20)))
+        self.assertTrue(a.sync(timeout=5))
+        self.assertFalse(a.sync(["Nobody"], timeout=0.05))
+
+
+class InboxTests(LoopbackTestCase):
+
+    def test_recv_and_recv_batch(self):
+        a, b = self.transport("A"), self.transport("B")
+        b.open_inbox("A")
+        for i in range(5):
+            a.send("B", i)
+        envelope = b.recv("A", timeout=5)
+        self.assertEqual(envelope.object, 0)
+        self.assertEqual(envelope.name, self.prefix + "A")
+        self.assertTrue(self.wait_until(lambda: len(b._inboxes[self.prefix + "A"].queue) == 4))
+        self.assertEqual([e.object for e in b.recv_batch("A", 3)], [1, 2, 3])
+        self.assertEqual([e.object for e in b.recv_batch("A", 3)], [4])
+        self.assertEqual(b.recv_batch("A", 3), [])
+        self.assertIsNone(b.recv("A", timeout=0.05))
+
+    def test_recv_any_takes_the_oldest(self):
+        a, b, c = self.transport("A"), self.transport("B"), self.transport("C")
+        c.open_inbox("A")
+        c.open_inbox("B")
+        a.send("C", "a1")
+        self.assertTrue(self.wait_until(lambda: c._inboxes[self.prefix + "A"].queue))
+        b.send("C", "b1")
+        a.send("C", "a2")
+        self.assertEqual([c.recv_any(timeout=5).object for i in range(3)], ["a1", "b1", "a2"])
+        self.assertIsNone(c.recv_any(timeout=0.05))
+
+    def test_full_inbox_drops_the_oldest(self):
+        a, b = self.transport("A"), self.transport("B")
+        b.open_inbox("A", max_size=2)
+        for i in range(5):
+            a.send("B", i)
+        self.assertTrue(self.wait_until(lambda: b.inbox_dropped("A") == 3))
+        self.assertEqual([e.object for e in b.recv_batch("A", 5)], [3, 4])
+        b.close_inbox("A")
+        self.assertEqual(b.inbox_dropped("A"), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
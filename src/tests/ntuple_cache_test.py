@@ -0,0 +1,89 @@
+"""
+Tests the UserAgent's utterance -> n-tuple cache (nluas.language.ntuple_cache).
+Does not require the analyzer.
+"""
+
+from nluas.language.ntuple_cache import NtupleCache, TemplateCache, canonicalize
+import unittest
+
+
+class NtupleCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = NtupleCache(size=2, version="v1")
+        self.ntuple = {'predicate_type': "command", 'eventDescriptor': {'eventProcess': {'actionary': "move"}}}
+
+    def test_hit_returns_copy(self):
+        self.cache.put("move  the box", self.ntuple, {'stacked': [], 'addressees': []})
+        ntuple, effects = self.cache.get("move the box")
+        self.assertEqual(ntuple, self.ntuple)
+        ntuple['eventDescriptor']['eventProcess']['actionary'] = "push"
+        self.assertEqual(self.cache.get("move the box")[0], self.ntuple)
+
+    def test_shared_descriptors_stay_shared(self):
+        descriptor = {'objectDescriptor': {'type': "box"}}
+        self.ntuple['eventDescriptor']['eventProcess']['protagonist'] = descriptor
+        self.cache.put("move the box", self.ntuple, {'stacked': [descriptor], 'addressees': []})
+        ntuple, effects = self.cache.get("move the box")
+        self.assertIs(ntuple['eventDescriptor']['eventProcess']['protagonist'], effects['stacked'][0])
+
+    def test_lru_eviction(self):
+        for sentence in ["a", "b"]:
+            self.cache.put(sentence, self.ntuple, {})
+        self.cache.get("a")
+        self.cache.put("c", self.ntuple, {})
+        self.assertIsNone(self.cache.get("b"))
+        self.assertIsNotNone(self.cache.get("a"))
+
+    def test_disabled(self):
+        cache = NtupleCache(size=0)
+        cache.put("a", self.ntuple, {})
+        self.assertIsNone(cache.get("a"))
+
+
+class TemplateCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = TemplateCache(size=4, mappings={'robot1': "robot1_instance", 'robot2': "robot2_instance"})
+
+    def move(self, x, y, agent="robot1_instance"):
+        goal = {'objectDescriptor': {'type': "location", 'xCoord': x, 'yCoord': y}}
+        return {'predicate_type': "command", 'eventDescriptor': {'protagonist': {'objectDescriptor': {'referent': agent}},
+                                                                 'eventProcess': {'actionary': "move", 'goal': goal}}}
+
+    def test_canonicalize(self):
+        self.assertEqual(canonicalize("robot2, move to location 7 1.5"),
+                         ("<NAME>, move to location <NUM> <NUM>", [("<NAME>", "robot2"), ("<NUM>", "7"), ("<NUM>", "1.5")]))
+        self.assertEqual(canonicalize("move box_2a to r2-d2 and Alice", names={"Alice"}),
+                         ("move <NAME> to <NAME> and <NAME>", [("<NAME>", "box_2a"), ("<NAME>", "r2-d2"), ("<NAME>", "Alice")]))
+
+    def test_known_names_are_substituted(self):
+        mappings = {'Alice': "alice_instance", 'Bob': "bob_instance"}
+        cache = TemplateCache(size=4, mappings=mappings, names=mappings.keys())
+        cache.put("Alice, move to location 3 4", self.move(3.0, 4.0, "alice_instance"), {})
+        ntuple, effects = cache.get("Bob, move to location 3 5")
+        self.assertEqual(ntuple, self.move(3.0, 5.0, "bob_instance"))
+        self.assertIsNone(cache.get("Carol, move to location 3 5"))
+
+    def test_substitutes_values(self):
+        self.cache.put("robot1, move to location 3 4", self.move(3.0, 4.0), {'stacked': [], 'addressees': []})
+        ntuple, effects = self.cache.get("robot2, move to location 7 1")
+        self.assertEqual(ntuple, self.move(7.0, 1.0, "robot2_instance"))
+
+    def test_ambiguous_values_are_not_cached(self):
+        self.cache.put("move to location 3 3", self.move(3.0, 3.0), {})
+        self.assertIsNone(self.cache.get("move to location 7 1"))
+
+    def test_missing_values_are_not_cached(self):
+        self.cache.put("move to location 3 4", self.move(3.0, 3.0), {})
+        self.assertIsNone(self.cache.get("move to location 7 1"))
+
+    def test_unsafe_substitution_falls_back(self):
+        self.cache.put("move to location 3 4", self.move(3.0, 4.0), {})
+        self.assertIsNone(self.cache.get("move to location 7.5 1"))
+        self.cache.compatible = lambda kind, old, new: False
+        self.assertIsNone(self.cache.get("move to location 7 1"))
+
+
+if __name__ == "__main__":
+    unittest.main()
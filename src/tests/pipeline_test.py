@@ -0,0 +1,72 @@
+"""
+Tests the UserAgent's staged pipeline (nluas.language.pipeline).
+Does not require the analyzer.
+"""
+
+from nluas.language.pipeline import Pipeline, Stage
+import random
+import threading
+import time
+import unittest
+
+
+class PipelineTests(unittest.TestCase):
+
+    def test_ordered_stages_keep_input_order(self):
+        results, done = [], threading.Event()
+
+        def slow(value, job):
+            time.sleep(random.random() / 100)
+            if value == 3:
+                raise Exception("failed on purpose")
+            return value
+
+        def collect(value, job):
+            results.append(value)
+            if job.seq == 19:
+                done.set()
+
+        pipeline = Pipeline([Stage("slow", slow, workers=4),
+                             Stage("collect", collect, ordered=True),
+                             Stage("last", lambda value, job: value, ordered=True)])
+        for i in range(20):
+            pipeline.submit("source", i)
+        self.assertTrue(done.wait(5))
+        pipeline.stop()
+        self.assertEqual(results, [i for i in range(20) if i != 3])
+
+    def test_failed_jobs_reach_always_stages(self):
+        results, done = [], threading.Event()
+
+        def fail_odd(value, job):
+            if value % 2:
+                raise Exception("failed on purpose")
+            return value
+
+        def finish(value, job):
+            results.append((job.seq, value))
+            if job.seq == 5:
+                done.set()
+
+        pipeline = Pipeline([Stage("fail", fail_odd, workers=2),
+                             Stage("skipped", lambda value, job: value * 10, ordered=True),
+                             Stage("finish", finish, ordered=True, always=True)])
+        for i in range(6):
+            pipeline.submit("source", i)
+        self.assertTrue(done.wait(5))
+        pipeline.stop()
+        self.assertEqual(results, [(0, 0), (1, None), (2, 20), (3, None), (4, 40), (5, None)])
+
+    def test_stop_does_not_block_on_full_queues(self):
+        release = threading.Event()
+        pipeline = Pipeline([Stage("stuck", lambda value, job: release.wait(5), max_queue=2)])
+        for i in range(3):
+            pipeline.submit("source", i)
+        start = time.time()
+        pipeline.stop()
+        self.assertLess(time.time() - start, 1)
+        release.set()
+
+
+if __name__ == "__main__":
+    unittest.main()
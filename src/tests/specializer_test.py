@@ -12,23 +12,11 @@ from nluas.language.core_specializer import *
 import json
 import unittest
 from json import loads, dumps
+from corpus import sentences
 
 analyzer = Analyzer("http://localhost:8090")
 specializer = CoreSpecializer(analyzer)
 
-sentences = ["boxes are big.",
-             "he moved.",
-             "the box is big.",
-             "he pushed the box.",
-             "he pushed the box into the room.",
-             "he saw the block.",
-             "he sprinted into the room.",
-             "he moved the box 3 inches.",
-             "the box costs 3 pounds.",
-             "the box weighs 3 pounds.",
-             "he painted the room blue.",
-             "he made the box bigger."]
-
 def generate_ntuple(sentence):
     try:
         semspecs = analyzer.parse(sentence)
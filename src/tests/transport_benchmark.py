@@ -0,0 +1,225 @@
+"""
+Load generator and latency benchmark for Transport.
+
+Starts -senders sender agents and -receivers receiver agents, each in its own process, in a
+federation prefix of their own on this host, and runs three phases:
+    send        each sender send()s -count messages, round-robin over the receivers
+    request     each sender request()s -count round trips, round-robin over the receivers,
+                which echo the payload back
+    broadcast   each sender broadcast()s -count messages, which every receiver gets
+
+Messages carry -size bytes of padding and are sent at -rate messages per second per sender
+(0 for as fast as possible). For each phase it reports the messages delivered and lost,
+throughput, and p50/p99/p999 latency: one-way for send and broadcast (agents share this
+host's clock), round-trip for request. Senders wait_for_peers() on the receivers first.
+
+Running it (from the top of the repository, see transport_benchmark.sh):
+    python3 src/tests/transport_benchmark.py -senders 2 -receivers 4 -size 1024 -rate 500
+
+-batch_delay turns on send-side batching, and -compress_threshold compression. -backend loopback runs the agents as threads of one
+process, talking through LoopbackTransport, to separate Transport's own overhead from pyre's.
+
+Results are written as JSON. When a baseline is given, any phase whose latency or throughput
+got worse than the tolerance is reported, and the exit status is 1.
+
+"""
+
+from bench_stats import percentile, compare
+from nluas.Transport import Transport
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+
+PHASES = ["send", "request", "broadcast"]
+
+
+def connect(args, name, prefix):
+    """ Returns a Transport for the agent called name, subscribed to nothing yet. """
+    if args.backend == "loopback":
+        return Transport(name, prefix=prefix, loopback=True)
+    return Transport(name, prefix=prefix, batch_delay=args.batch_delay, compress_threshold=args.compress_threshold)
+
+
+def pace(start, i, rate):
+    """ Sleeps until message i of a run started at start is due. """
+    if rate > 0:
+        delay = start + float(i) / rate - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def sender(args, index, prefix, receivers, barrier, results):
+    name = "sender{}".format(index)
+    transport = connect(args, name, prefix)
+    # So that none of the first messages of a phase are lost to discovery.
+    if not transport.wait_for_peers(receivers, args.timeout):
+        raise RuntimeError("{} could not reach the receivers".format(name))
+    pad = "x" * args.size
+    barrier.wait()
+    for phase in PHASES:
+        latencies = []
+        futures = []
+        barrier.wait()
+        start = time.time()
+        for i in range(args.count):
+            pace(start, i, args.rate)
+            dest = receivers[(index + i) % len(receivers)]
+            payload = {"phase": phase, "seq": i, "sent": time.time(), "pad": pad}
+            if phase == "send":
+                transport.send(dest, payload)
+            elif phase == "broadcast":
+                transport.broadcast(payload)
+            else:
+                future = transport.request(dest, payload, timeout=args.timeout)
+                future.add_done_callback(lambda f, t0=payload["sent"]: f.exception() or latencies.append(time.time() - t0))
+                futures.append(future)
+        concurrent.futures.wait(futures, timeout=args.timeout)
+        results.put({"role": "sender", "phase": phase, "sent": args.count, "start": start, "end": time.time(),
+                     "latencies": list(latencies)})
+        barrier.wait()
+    results.put({"role": "sender", "phase": "stats", "stats": transport.stats()})
+    # Everyone has reported before anyone leaves.
+    barrier.wait()
+    transport.close()
+
+
+def receiver(args, index, prefix, senders, barrier, results):
+    name = "receiver{}".format(index)
+    transport = connect(args, name, prefix)
+    state = {"phase": None, "expected": 0, "latencies": [], "last": None}
+    done = threading.Event()
+
+    def got(ntuple):
+        if ntuple["phase"] == state["phase"]:
+            now = time.time()
+            state["latencies"].append(now - ntuple["sent"])
+            state["last"] = now
+            if len(state["latencies"]) >= state["expected"]:
+                done.set()
+
+    transport.subscribe_all(got)
+    transport.respond(lambda payload: payload)
+    barrier.wait()
+    for phase in PHASES:
+        state["latencies"], state["last"] = [], None
+        if phase == "send":
+            state["expected"] = sum(1 for s in range(senders) for i in range(args.count)
+                                    if (s + i) % args.receivers == index)
+        elif phase == "broadcast":
+            state["expected"] = senders * args.count
+        else:
+            state["expected"] = 0
+        done.clear()
+        state["phase"] = phase
+        barrier.wait()
+        if state["expected"]:
+            done.wait(args.timeout)
+        state["phase"] = None
+        results.put({"role": "receiver", "phase": phase, "expected": state["expected"], "last": state["last"],
+                     "latencies": list(state["latencies"])})
+        barrier.wait()
+    results.put({"role": "receiver", "phase": "stats", "stats": transport.stats()})
+    barrier.wait()
+    transport.close()
+
+
+def summarize(phase, reports, args):
+    """ Combines the senders' and receivers' reports for one phase. """
+    senders = [r for r in reports if r["role"] == "sender"]
+    receivers = [r for r in reports if r["role"] == "receiver"]
+    start = min(r["start"] for r in senders)
+    sent = sum(r["sent"] for r in senders)
+    if phase == "request":
+        latencies = [l for r in senders for l in r["latencies"]]
+        expected = sent
+        end = max(r["end"] for r in senders)
+    else:
+        latencies = [l for r in receivers for l in r["latencies"]]
+        expected = sum(r["expected"] for r in receivers)
+        end = max([r["last"] for r in receivers if r["last"] is not None] or [start])
+    duration = end - start
+    delivered = len(latencies)
+    return {"sent": sent,
+            "delivered": delivered,
+            "lost": expected - delivered,
+            "throughput": delivered / duration if duration > 0 else None,
+            "mb_per_sec": delivered * args.size / duration / 1e6 if duration > 0 else None,
+            "p50_ms": percentile(latencies, 50) * 1000 if latencies else None,
+            "p99_ms": percentile(latencies, 99) * 1000 if latencies else None,
+            "p999_ms": percentile(latencies, 99.9) * 1000 if latencies else None}
+
+
+def run(args):
+    prefix = "bench{}_".format(os.getpid())
+    senders = ["sender{}".format(i) for i in range(args.senders)]
+    receivers = ["receiver{}".format(i) for i in range(args.receivers)]
+    if args.backend == "loopback":
+        agent, barrier, results = threading.Thread, threading.Barrier, queue.Queue()
+    else:
+        agent, barrier, results = multiprocessing.Process, multiprocessing.Barrier, multiprocessing.Queue()
+    barrier = barrier(args.senders + args.receivers + 1, timeout=args.timeout * 2)
+    agents = [agent(target=receiver, args=(args, i, prefix, args.senders, barrier, results)) for i in range(args.receivers)]
+    agents += [agent(target=sender, args=(args, i, prefix, receivers, barrier, results)) for i in range(args.senders)]
+    for a in agents:
+        a.daemon = True
+        a.start()
+
+    summary = dict()
+    barrier.wait()
+    for phase in PHASES:
+        barrier.wait()
+        barrier.wait()
+        reports = [results.get(timeout=args.timeout) for a in agents]
+        summary[phase] = summarize(phase, reports, args)
+    stats = [results.get(timeout=args.timeout)["stats"] for a in agents]
+    barrier.wait()
+    for a in agents:
+        a.join(args.timeout)
+
+    report = {"senders": args.senders, "receivers": args.receivers, "count": args.count, "size": args.size,
+              "rate": args.rate, "backend": args.backend, "results": summary,
+              "dropped": sum(s["dropped"] for s in stats)}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print("{:<10} {:>8} {:>9} {:>6} {:>10} {:>8} {:>9} {:>9} {:>9}".format(
+          "phase", "sent", "delivered", "lost", "msgs/s", "MB/s", "p50 ms", "p99 ms", "p999 ms"))
+    for phase in PHASES:
+        s = summary[phase]
+        print("{:<10} {:>8} {:>9} {:>6} {:>10.1f} {:>8.2f} {:>9.3f} {:>9.3f} {:>9.3f}".format(
+              phase, s["sent"], s["delivered"], s["lost"], s["throughput"] or 0, s["mb_per_sec"] or 0,
+              s["p50_ms"] or 0, s["p99_ms"] or 0, s["p999_ms"] or 0))
+
+    if args.baseline:
+        regressions = compare(summary, args.baseline, args.tolerance, ["p50_ms", "p99_ms", "p999_ms"])
+        for regression in regressions:
+            print("REGRESSION: {}".format(regression))
+        return 1 if regressions else 0
+    return 0
+
+
+def setup_parser():
+    parser = argparse.ArgumentParser(description="Measure Transport throughput and latency on this host.")
+    parser.add_argument("-senders", type=int, default=1, help="number of sending agents (default %(default)s)")
+    parser.add_argument("-receivers", type=int, default=1, help="number of receiving agents (default %(default)s)")
+    parser.add_argument("-count", type=int, default=1000, help="messages per sender per phase (default %(default)s)")
+    parser.add_argument("-size", type=int, default=256, help="bytes of padding per message (default %(default)s)")
+    parser.add_argument("-rate", type=float, default=0, help="messages per second per sender, 0 for unthrottled (default %(default)s)")
+    parser.add_argument("-backend", choices=["pyre", "loopback"], default="pyre", help="agents as pyre processes, or LoopbackTransport threads (default %(default)s)")
+    parser.add_argument("-batch_delay", type=float, help="batch sends for up to this many seconds (see Transport.flush())")
+    parser.add_argument("-compress_threshold", type=int, help="compress messages of at least this many bytes")
+    parser.add_argument("-timeout", type=float, default=30, help="seconds to wait for agents and messages (default %(default)s)")
+    parser.add_argument("-output", type=str, default="transport_bench.json", help="where to write the results (default %(default)s)")
+    parser.add_argument("-baseline", type=str, help="results file to compare against")
+    parser.add_argument("-tolerance", type=float, default=0.10, help="allowed relative slowdown before flagging a regression (default %(default)s)")
+    return parser
+
+
+if __name__ == "__main__":
+    args = setup_parser().parse_args(sys.argv[1:])
+    sys.exit(run(args))
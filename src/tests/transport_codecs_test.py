@@ -0,0 +1,75 @@
+"""
+Tests the Transport message codecs (nluas.transport_codecs).
+Does not require pyre.
+"""
+
+from nluas import transport_codecs
+import unittest
+
+
+class TransportCodecsTests(unittest.TestCase):
+
+    def test_round_trip(self):
+        for name in transport_codecs.available():
+            frame = transport_codecs.encode(transport_codecs.SAMPLE_NTUPLE, name)
+            self.assertTrue(transport_codecs.is_framed(frame))
+            self.assertEqual(transport_codecs.decode(frame), transport_codecs.SAMPLE_NTUPLE)
+
+    def test_legacy_json(self):
+        frame = transport_codecs.encode({'text': "move"})
+        self.assertFalse(transport_codecs.is_framed(frame))
+        self.assertEqual(transport_codecs.decode(frame), {'text': "move"})
+        self.assertEqual(transport_codecs.decode(u'"move"'), "move")
+
+    def test_best_common(self):
+        self.assertEqual(transport_codecs.best_common([["json"], ["json"]]), "json")
+        self.assertEqual(transport_codecs.best_common([["json"], ["nosuchcodec"]]), None)
+        self.assertEqual(transport_codecs.best_common([transport_codecs.available()] * 2),
+                         transport_codecs.available()[0])
+
+    def test_fallback_to_json(self):
+        for name in transport_codecs.available():
+            # Keys json stringifies but msgpack/orjson may not. Every codec
+            # has to hand the receiver what json would.
+            frame = transport_codecs.encode({1: "one", "two": {None: [True]}}, name)
+            self.assertEqual(transport_codecs.decode(frame), {"1": "one", "two": {"null": [True]}})
+
+    def test_priority_frames(self):
+        frame = transport_codecs.encode_control("stop", "json")
+        priority, inner = transport_codecs.split_priority(transport_codecs.encode_priority(frame, 0), 1)
+        self.assertEqual(priority, 0)
+        self.assertTrue(transport_codecs.is_control(inner))
+        self.assertEqual(transport_codecs.decode(inner[1:]), "stop")
+        self.assertEqual(transport_codecs.split_priority(frame, 1), (1, frame))
+
+    def test_batch_frames(self):
+        frames = [transport_codecs.encode(n, "json") for n in ["a", {"b": 2}, []]]
+        batch = transport_codecs.encode_batch(frames)
+        self.assertTrue(transport_codecs.is_batch(batch))
+        self.assertFalse(transport_codecs.is_batch(frames[0]))
+        self.assertEqual([transport_codecs.decode(f) for f in transport_codecs.split_batch(batch)], ["a", {"b": 2}, []])
+
+    def test_compressed_frames(self):
+        frame = transport_codecs.encode({"pad": "x" * 1000, "ntuple": transport_codecs.SAMPLE_NTUPLE}, "json")
+        for zdict in (False, True):
+            compressed = transport_codecs.compress(frame, zdict)
+            self.assertTrue(transport_codecs.is_compressed(compressed))
+            self.assertLess(len(compressed), len(frame))
+            self.assertEqual(transport_codecs.decode(compressed), transport_codecs.decode(frame))
+        control = transport_codecs.encode_control(transport_codecs.SAMPLE_NTUPLE, "json")
+        compressed = transport_codecs.compress(control, True)
+        self.assertTrue(transport_codecs.is_control(compressed))
+        self.assertEqual(transport_codecs.decode(compressed[1:]), transport_codecs.SAMPLE_NTUPLE)
+
+    def test_incompressible_frame_is_unchanged(self):
+        frame = transport_codecs.encode("x", "json")
+        self.assertEqual(transport_codecs.compress(frame), frame)
+
+    def test_template_dictionary(self):
+        self.assertIsNotNone(transport_codecs.ZDICT)
+        frame = transport_codecs.encode(transport_codecs.SAMPLE_NTUPLE, "json")
+        self.assertLess(len(transport_codecs.compress(frame, True)), len(transport_codecs.compress(frame, False)))
+
+
+if __name__ == "__main__":
+    unittest.main()
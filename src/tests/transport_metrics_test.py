@@ -0,0 +1,51 @@
+"""
+Tests the Transport traffic counters (nluas.transport_metrics).
+Does not require pyre.
+"""
+
+from nluas import transport_metrics
+import unittest
+
+
+class MetricsTests(unittest.TestCase):
+
+    def test_traffic(self):
+        metrics = transport_metrics.Metrics()
+        metrics.sent("B", 10, 0.5, ["B"])
+        metrics.sent("B", 30, 1.5, ["B", "bridge"])
+        metrics.received("A", "B", 7)
+        stats = metrics.snapshot(metrics.started + 2)
+        self.assertEqual(stats["channels"]["B"]["msgs_out"], 2)
+        self.assertEqual(stats["channels"]["B"]["bytes_out"], 40)
+        self.assertEqual(stats["channels"]["B"]["bytes_out_rate"], 20)
+        self.assertEqual(stats["peers"]["B"]["bytes_in"], 7)
+        self.assertEqual(stats["peers"]["B"]["msgs_out"], 2)
+        self.assertEqual(stats["peers"]["B"]["bytes_out"], 40)
+        self.assertEqual(stats["peers"]["bridge"]["bytes_out"], 30)
+        self.assertEqual(stats["encode"], {"count": 2, "total": 2.0, "mean": 1.0, "max": 1.5})
+
+    def test_rate_window(self):
+        metrics = transport_metrics.Metrics()
+        metrics.received("A", "B", 100)
+        start = metrics.started
+        metrics.snapshot(start + transport_metrics.RATE_WINDOW)
+        metrics.received("A", "B", 100)
+        stats = metrics.snapshot(start + 2 * transport_metrics.RATE_WINDOW)
+        # Only the message since the previous window started counts.
+        self.assertEqual(stats["channels"]["A"]["msgs_in_rate"], 1 / transport_metrics.RATE_WINDOW)
+        self.assertEqual(stats["channels"]["A"]["msgs_in"], 2)
+
+    def test_decoder_and_callbacks(self):
+        metrics = transport_metrics.Metrics()
+        decode = metrics.decoder(lambda data: data * 2)
+        self.assertEqual(decode(21), 42)
+        metrics.callback("B", 0.25)
+        metrics.count("dropped", 3)
+        stats = metrics.snapshot()
+        self.assertEqual(stats["decode"]["count"], 1)
+        self.assertEqual(stats["callbacks"]["B"]["max"], 0.25)
+        self.assertEqual(stats["dropped"], 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+"""
+Tests the reliable delivery bookkeeping of Transport (nluas.transport_reliable).
+Does not require pyre.
+"""
+
+from nluas.transport_reliable import Sender, Receiver
+import unittest
+
+
+class SenderTests(unittest.TestCase):
+
+    def test_cumulative_ack(self):
+        sender = Sender()
+        for obj in ["a", "b", "c"]:
+            sender.add(obj, obj, 0)
+        self.assertEqual(sender.ack(2), [(1, "a"), (2, "b")])
+        self.assertEqual(sender.base(), 3)
+        self.assertEqual(sender.ack(2), [])
+
+    def test_backoff_and_give_up(self):
+        sender = Sender(retries=3, timeout=1)
+        sender.add("a", "status", 0)
+        self.assertEqual(sender.due(0.5), ([], []))
+        self.assertEqual(sender.due(1), ([(1, "a")], []))
+        self.assertEqual(sender.due(2), ([], []))
+        self.assertEqual(sender.due(3), ([(1, "a")], []))
+        self.assertEqual(sender.due(10), ([], [(1, "status")]))
+        self.assertEqual(sender.base(), 2)
+
+    def test_bounded_window(self):
+        sender = Sender(window=2)
+        sender.add("a", "sa", 0)
+        sender.add("b", "sb", 0)
+        seq, dropped = sender.add("c", "sc", 0)
+        self.assertEqual(seq, 3)
+        self.assertEqual(dropped, [(1, "sa")])
+        self.assertEqual(sender.base(), 2)
+
+
+class ReceiverTests(unittest.TestCase):
+
+    def test_in_order_and_duplicates(self):
+        receiver = Receiver()
+        self.assertEqual(receiver.receive(1, 1, "a"), (["a"], False))
+        self.assertEqual(receiver.receive(1, 1, "a"), ([], True))
+        self.assertEqual(receiver.acked(), 1)
+
+    def test_gap_is_held(self):
+        receiver = Receiver()
+        self.assertEqual(receiver.receive(2, 1, "b"), ([], False))
+        self.assertEqual(receiver.receive(1, 1, "a"), (["a", "b"], False))
+        self.assertEqual(receiver.acked(), 2)
+
+    def test_base_skips_abandoned(self):
+        receiver = Receiver()
+        self.assertEqual(receiver.receive(5, 5, "e"), (["e"], False))
+        self.assertEqual(receiver.acked(), 5)
+
+    def test_base_releases_held(self):
+        receiver = Receiver()
+        receiver.receive(1, 1, "a")
+        receiver.receive(2, 1, "b")
+        self.assertEqual(receiver.receive(5, 1, "e"), ([], False))
+        # The sender gives up on 3 and 4, and resends 5.
+        self.assertEqual(receiver.receive(5, 5, "e"), (["e"], True))
+        self.assertEqual(receiver.acked(), 5)
+        self.assertEqual(receiver.receive(5, 5, "e"), ([], True))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+"""
+Tests the routing table behind Transport.subscribe() (nluas.transport_routes).
+Does not require pyre.
+"""
+
+from nluas.transport_routes import Routes
+import unittest
+
+
+class RoutesTests(unittest.TestCase):
+
+    def test_exact_prefix_and_glob(self):
+        routes = Routes()
+        routes.add("FED1_Solver", "exact")
+        routes.add("FED1_Solver*", "prefix")
+        routes.add("FED1_Solver[0-9]", "glob")
+        routes.add("*", "all")
+        self.assertEqual(routes.match("FED1_Solver"), ("exact", "prefix", "all"))
+        self.assertEqual(routes.match("FED1_Solver3"), ("prefix", "glob", "all"))
+        self.assertEqual(routes.match("FED1_Solve"), ("all",))
+
+    def test_several_handlers_and_remove(self):
+        routes = Routes()
+        routes.add("A", "one")
+        routes.add("A", "two")
+        self.assertEqual(routes.match("A"), ("one", "two"))
+        self.assertEqual(routes.remove("A", lambda h: h == "one"), ["one"])
+        self.assertEqual(routes.match("A"), ("two",))
+        self.assertEqual(routes.remove("A"), ["two"])
+        self.assertEqual(routes.match("A"), ())
+        self.assertEqual(routes.remove("B*"), [])
+
+    def test_remove_prunes_the_trie(self):
+        routes = Routes()
+        routes.add("Solver", "exact")
+        routes.add("Solver1", "one")
+        routes.add("Sol*", "prefix")
+        routes.remove("Solver1")
+        self.assertEqual(routes.match("Solver"), ("exact", "prefix"))
+        routes.remove("Solver")
+        self.assertEqual(routes.match("Solver"), ("prefix",))
+        routes.remove("Sol*")
+        self.assertEqual(routes._root.children, {})
+        self.assertEqual(routes.items(), [])
+
+    def test_cache_follows_changes(self):
+        routes = Routes()
+        self.assertEqual(routes.match("Solver1"), ())
+        routes.add("Solver*", "shards")
+        self.assertEqual(routes.match("Solver1"), ("shards",))
+        self.assertEqual(routes.items(), [("Solver*", "shards")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,288 @@
+"""
+Tests how a Transport frames and addresses what it sends, and what it does with what it
+receives, by feeding it pyre events by hand and recording what it would have sent.
+Requires pyre and zmq to be importable, but not a network.
+"""
+
+from nluas.Transport import *
+from nluas.async_transport import AsyncTransport
+from nluas import transport_codecs
+from nluas import transport_shm
+import asyncio
+import collections
+import json
+import os
+import threading
+import unittest
+import uuid
+import zmq
+
+
+class RecordingSocket(object):
+    """ Stands in for the Pyre node's zmq socket, as far as AsyncTransport looks at it: a file
+    descriptor that never becomes readable, and events pending while the node has any. """
+
+    def __init__(self, node):
+        self.node = node
+        self.fds = os.pipe()
+
+    def getsockopt(self, option):
+        if option == zmq.FD:
+            return self.fds[0]
+        return zmq.POLLIN if option == zmq.EVENTS and self.node.incoming else 0
+
+    def close(self):
+        for fd in self.fds:
+            os.close(fd)
+
+
+class RecordingNode(object):
+    """ Stands in for the Pyre node: remembers every shout and whisper, and the thread they came from,
+    and hands out the events tests put in incoming. """
+
+    def __init__(self, name):
+        self._name = name
+        self._uuid = uuid.uuid4()
+        self._socket = None
+        self.sent = []
+        self.threads = set()
+        self.incoming = collections.deque()
+
+    def name(self):
+        return self._name
+
+    def uuid(self):
+        return self._uuid
+
+    def socket(self):
+        if self._socket is None:
+            self._socket = RecordingSocket(self)
+        return self._socket
+
+    def recv(self):
+        return self.incoming.popleft()
+
+    def shout(self, group, frame):
+        self.sent.append((group, frame))
+        self.threads.add(threading.current_thread())
+
+    def shouts(self, group, text):
+        self.shout(group, text.encode("utf-8"))
+
+    def whisper(self, sid, frame):
+        self.sent.append((sid, frame))
+        self.threads.add(threading.current_thread())
+
+    def stop(self):
+        if self._socket is not None:
+            self._socket.close()
+
+
+class RecordingTransport(Transport):
+    """ A Transport that handles no events of its own; tests pass them to _handle_event(). """
+    _threaded = False
+
+    def _start(self, myname, codecs, whisper):
+        self._codecs = list(codecs) if codecs is not None else transport_codecs.available()
+        self._pyre = RecordingNode(myname)
+
+
+class RecordingAsyncTransport(AsyncTransport):
+    """ An AsyncTransport on a RecordingNode. """
+
+    def _start(self, myname, codecs, whisper):
+        self._codecs = list(codecs) if codecs is not None else transport_codecs.available()
+        self._pyre = RecordingNode(myname)
+
+
+class RecordingTestCase(unittest.TestCase):
+    """ Gives each test a RecordingTransport named A, and ways to feed it events. """
+
+    def setUp(self):
+        self.t = RecordingTransport("A")
+
+    def enter(self, name, codecs=None, features=(), groups=(), sid=None, host=None, t=None):
+        """ Makes a peer named name known to the Transport (by default self.t), as its ENTER and JOIN events
+        would. Returns its UUID. """
+        t = t if t is not None else self.t
+        sid = sid if sid is not None else uuid.uuid4()
+        headers = {FEATURES_HEADER: ",".join(features)}
+        if codecs is not None:
+            headers[CODECS_HEADER] = ",".join(codecs)
+        if host is not None:
+            headers[HOST_HEADER] = host
+        t._handle_event([b"ENTER", sid.bytes, name.encode("utf-8"), json.dumps(headers).encode("utf-8"), b"tcp://127.0.0.1:5000"])
+        for group in groups:
+            t._handle_event([b"JOIN", sid.bytes, name.encode("utf-8"), group.encode("utf-8")])
+        return sid
+
+    def shout(self, sid, name, group, frame, t=None):
+        t = t if t is not None else self.t
+        t._handle_event([b"SHOUT", sid.bytes, name.encode("utf-8"), group.encode("utf-8"), frame])
+
+
+class TransportSendTests(RecordingTestCase):
+
+    def test_codec_covers_every_group_member(self):
+        self.enter("B", codecs=["json"], features=[WHISPER_FEATURE], groups=["B"])
+        self.t.send("B", {'text': "move"})
+        frame = self.t._pyre.sent.pop()[1]
+        self.assertTrue(transport_codecs.is_framed(frame))
+        # A bridge client (no codecs header) also listens on B's group.
+        self.enter("bridge", groups=["B"])
+        self.t.send("B", {'text': "move"})
+        group, frame = self.t._pyre.sent.pop()
+        self.assertEqual(group, "B")
+        self.assertFalse(transport_codecs.is_framed(frame))
+        self.assertEqual(json.loads(frame.decode("utf-8")), {'text': "move"})
+
+    def test_decoded_once_and_only_if_wanted(self):
+        sid = self.enter("B", codecs=["json"], groups=["B"])
+        frame = transport_codecs.encode({'text': "move"}, "json")
+        self.shout(sid, "B", "A", frame)
+        self.assertEqual(self.t.stats()['decode']['count'], 0)
+        self.assertEqual(self.t.stats()['ignored'], 1)
+        got = []
+        self.t.subscribe("B", got.append)
+        self.t.subscribe_all(got.append)
+        self.shout(sid, "B", "A", frame)
+        self.assertEqual(got, [{'text': "move"}] * 2)
+        self.assertIs(got[0], got[1])
+        self.assertEqual(self.t.stats()['decode']['count'], 1)
+
+
+class ProxyTests(RecordingTestCase):
+
+    def setUp(self):
+        self.t = RecordingTransport("A", proxy=True)
+
+    def test_leaves_requests_to_the_remote_transport(self):
+        sid = self.enter("B", codecs=["json"], groups=["B"])
+        self.t.respond(lambda payload: payload)
+        for payload in ("hello", PING_REQUEST, STATS_REQUEST):
+            frame = transport_codecs.encode_control({'request': "B-1", 'payload': payload}, "json")
+            self.shout(sid, "B", "A", frame)
+        self.assertEqual(self.t._pyre.sent, [])
+
+    def test_leaves_acks_to_the_remote_transport(self):
+        sender = RecordingTransport("S", codecs=["json"])
+        self.enter("A", codecs=["json"], groups=["A"], sid=self.t._pyre.uuid(), t=sender)
+        sid = self.enter("S", codecs=["json"], groups=["S"], sid=sender._pyre.uuid())
+        statuses = []
+        sender.send_reliable("A", {'text': "move"}, lambda seq, status: statuses.append(status))
+        group, frame = sender._pyre.sent.pop()
+        self.shout(sid, "S", group, frame)
+        # Even once an ack would be due, the proxy sends none: if the
+        # bridge drops the frame, the sender mustn't think it delivered.
+        self.t._ackdue = 0
+        self.t._tick()
+        self.assertEqual(self.t._pyre.sent, [])
+        self.assertEqual(statuses, [])
+        self.assertEqual(sender.reliable_stats()['delivered'], 0)
+
+
+@unittest.skipUnless(transport_shm.available, "needs multiprocessing.shared_memory")
+class SharedMemoryTests(RecordingTestCase):
+
+    def setUp(self):
+        self.t = RecordingTransport("A", shm_threshold=1000, codecs=["json"])
+        self.b = RecordingTransport("B", codecs=["json"])
+        # Each knows the other by its real UUID, so releases match.
+        self.enter("B", codecs=["json"], features=[SHM_FEATURE], groups=["B"], sid=self.b._pyre.uuid(), host=transport_shm.HOST_ID)
+        self.enter("A", codecs=["json"], features=[SHM_FEATURE], groups=["A"], sid=self.t._pyre.uuid(), host=transport_shm.HOST_ID, t=self.b)
+
+    def tearDown(self):
+        self.t._cleanup()
+
+    def hand_over(self, ntuple):
+        """ Sends ntuple from A to B, and B's answers (if any) back to A. Returns what B sent. """
+        self.t.send("B", ntuple)
+        group, frame = self.t._pyre.sent.pop()
+        self.assertTrue(transport_shm.is_descriptor(frame))
+        self.assertEqual(self.t.stats()['shm'][0], 1)
+        self.shout(self.t._pyre.uuid(), "A", group, frame, t=self.b)
+        answers = list(self.b._pyre.sent)
+        del self.b._pyre.sent[:]
+        for group, frame in answers:
+            self.shout(self.b._pyre.uuid(), "B", group, frame)
+        return answers
+
+    def test_segment_released_after_decoding(self):
+        got = []
+        self.b.subscribe("A", got.append)
+        big = {'pad': "x" * 5000}
+        self.assertEqual(len(self.hand_over(big)), 1)
+        self.assertEqual(got, [big])
+        self.assertEqual(self.t.stats()['shm'], (0, 0))
+
+    def test_segment_released_if_unwanted(self):
+        self.assertEqual(len(self.hand_over({'pad': "x" * 5000})), 1)
+        self.assertEqual(self.b.stats()['ignored'], 1)
+        self.assertEqual(self.t.stats()['shm'], (0, 0))
+
+    def test_small_frames_are_not_shared(self):
+        self.t.send("B", {'text': "move"})
+        self.assertFalse(transport_shm.is_descriptor(self.t._pyre.sent[-1][1]))
+
+
+class AsyncTransportTests(RecordingTestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.t = RecordingAsyncTransport("A", loop=self.loop, batch_delay=0.01)
+
+    def tearDown(self):
+        self.t.quit_federation()
+        self.loop.close()
+
+    def test_messages(self):
+        sid = self.enter("B", codecs=["json"], groups=["B"])
+        async def first_two():
+            got = []
+            async for envelope in self.t.messages("B"):
+                got.append(envelope.object)
+                if len(got) == 2:
+                    return got
+        task = self.loop.create_task(first_two())
+        self.loop.run_until_complete(asyncio.sleep(0))
+        for text in ("move", "stop"):
+            self.shout(sid, "B", "A", transport_codecs.encode(text, "json"))
+        self.assertEqual(self.loop.run_until_complete(task), ["move", "stop"])
+
+    def test_callback_exception_does_not_strand_events(self):
+        sid = self.enter("B", codecs=["json"], groups=["B"])
+        got = []
+        def callback(ntuple):
+            got.append(ntuple)
+            if ntuple == "bad":
+                raise ValueError(ntuple)
+        self.t.subscribe("B", callback)
+        for text in ("bad", "good"):
+            self.t._pyre.incoming.append([b"SHOUT", sid.bytes, b"B", b"A", transport_codecs.encode(text, "json")])
+        with self.assertLogs("Transport", "ERROR"):
+            self.t._on_readable()
+        self.assertEqual(got, ["bad", "good"])
+        self.assertFalse(self.t._pyre.incoming)
+
+    def test_batches_are_sent_from_the_loop(self):
+        self.enter("B", codecs=["json"], features=[BATCH_FEATURE], groups=["B"])
+        async def send():
+            await self.t.send("B", 1)
+            await self.t.send("B", 2)
+            self.assertEqual(self.t._pyre.sent, [])
+            await asyncio.sleep(0.05)
+        self.loop.run_until_complete(send())
+        self.assertEqual(len(self.t._pyre.sent), 1)
+        self.assertTrue(transport_codecs.is_batch(self.t._pyre.sent[0][1]))
+        self.assertEqual(self.t._pyre.threads, {threading.current_thread()})
+
+    def test_quit_sends_batches_first(self):
+        self.enter("B", codecs=["json"], features=[BATCH_FEATURE], groups=["B"])
+        self.loop.run_until_complete(self.t.send("B", 1))
+        self.t.quit_federation()
+        self.assertEqual([group for group, frame in self.t._pyre.sent], ["B", "GLOBAL"])
+        self.assertEqual(self.t._pyre.sent[1][1], b"QUIT")
+
+
+if __name__ == "__main__":
+    unittest.main()
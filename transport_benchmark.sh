@@ -0,0 +1,5 @@
+#!/bin/bash
+# Measures Transport throughput and latency with sender and receiver agents on this host.
+# For options (agents, message size and rate, backend, baseline), run:
+#python3 src/tests/transport_benchmark.py -h
+python3 src/tests/transport_benchmark.py "$@"